@@ -0,0 +1,63 @@
+from functools import lru_cache
+import numpy as np
+from scipy import signal
+
+
+@lru_cache(maxsize=64)
+def bandpass_sos(sampling_rate, f1, f2, order=4):
+    """Design a Butterworth bandpass filter as second order sections
+
+    The coefficients only depend on the arguments, so they are cached
+    and shared between all callers, which must not modify them. The
+    upper cutoff is kept below the Nyquist frequency.
+
+    :param sampling_rate: float of the sampling rate in Hz
+    :param f1: minimum frequency of bandpass filter
+    :param f2: maximum frequency of bandpass filter
+    :param order: order of the Butterworth filter
+
+    :returns: array of second order sections
+    """
+    f2 = min(f2, 0.99 * sampling_rate / 2)
+    sos = signal.butter(order, [f1, f2], btype='bandpass',
+                        fs=sampling_rate, output='sos')
+    return sos
+
+
+class BandpassFilter(object):
+    def __init__(self, sampling_rate, f1=3, f2=50, order=4):
+        self.sampling_rate = sampling_rate
+        self.sos = bandpass_sos(sampling_rate, f1, f2, order)
+        self.zi = None
+
+    def process(self, voltage):
+        """Filter the next block of samples
+
+        Causal filtering with scipy.signal.sosfilt. The filter state zi
+        is carried over from the previous block, so filtering a signal
+        block by block gives the same output as filtering it in one go,
+        at a constant cost per block. The state is started from the
+        first sample to avoid a step transient.
+
+        :param self: self
+        :param voltage: array of float of the new voltage samples
+
+        :returns: array of float of the filtered samples
+        """
+        voltage = np.asarray(voltage, dtype=np.float64)
+        if len(voltage) == 0:
+            return voltage
+        if self.zi is None:
+            self.zi = signal.sosfilt_zi(self.sos) * voltage[0]
+        voltage_filter, self.zi = signal.sosfilt(self.sos, voltage,
+                                                 zi=self.zi)
+        return voltage_filter
+
+    def reset(self):
+        """Forget the filter state before starting a new signal
+
+        :param self: self
+
+        :returns: None
+        """
+        self.zi = None
@@ -1,18 +1,165 @@
 import json
 import csv
 import logging
+import os
+import time
+import tracemalloc
+import warnings
+from functools import lru_cache, wraps
 import numpy as np
 import math
 from scipy import signal
-import matplotlib.pyplot as plt
-import json
-import matplotlib
-matplotlib.use('Agg')
+from BandpassFilter import BandpassFilter, bandpass_sos
+from ecg_plot import render_ecg
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+def open_log(filename, quiet=False):
+    """Create the logger for one ECG file
+
+    The logger is not registered with the logging module, so it is freed
+    along with the object that owns it, and its records still propagate
+    to the "ECG" logger. Unless quiet is set, the records are written
+    to filename.log, which is only opened on the first record.
+
+    :param filename: name of the ECG file being processed
+    :param quiet: if True, do not write a log file
+
+    :returns: logging.Logger
+    """
+    logger = logging.Logger("{}.{}".format(__name__, filename), logging.INFO)
+    logger.parent = logging.getLogger(__name__)
+    if not quiet:
+        log = os.path.splitext(filename)[0] + '.log'
+        handler = logging.FileHandler(log, mode="w", delay=True)
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        logger.addHandler(handler)
+    return logger
+
+
+def close_log(logger):
+    """Close and remove the handlers of a logger from open_log()
+
+    :param logger: logging.Logger
+
+    :returns: None
+    """
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+
+@lru_cache(maxsize=8)
+def fft_mask(n, sampling_rate, f1, f2):
+    """Bandpass mask for the shifted spectrum used by ECG.filter
+
+    Builds the same frequency axis and band as the original filter, so
+    the filtered output is unchanged, but only once per (length,
+    sampling rate, band). The mask is a boolean array shared between
+    callers, which must not modify it.
+
+    :param n: integer length of the signal
+    :param sampling_rate: float of the sampling rate
+    :param f1: minimum frequency of bandpass filter
+    :param f2: maximum frequency of bandpass filter
+
+    :returns: array of bool, True inside the band
+    """
+    f_max = 2*sampling_rate
+    f = np.linspace(-f_max, f_max, n)
+    return (abs(f) >= f1) & (abs(f) <= f2)
+
+
+@lru_cache(maxsize=8)
+def rfft_mask(n, sampling_rate, f1, f2):
+    """Bandpass mask for the one-sided spectrum of a real signal
+
+    :param n: integer length of the signal
+    :param sampling_rate: float of the sampling rate in Hz
+    :param f1: minimum frequency of bandpass filter in Hz
+    :param f2: maximum frequency of bandpass filter in Hz
+
+    :returns: array of bool, True inside the band
+    """
+    f = np.fft.rfftfreq(n, 1/sampling_rate)
+    return (f >= f1) & (f <= f2)
+
+
+def parse_csv_lines(lines):
+    """Converts lines of a time,voltage CSV file to numerical arrays
+
+    Parses all lines in one pass with numpy. Clean input goes through
+    np.loadtxt; if any row holds bad or empty data, the lines are parsed
+    again with np.genfromtxt, which turns bad entries into NaN. Rows with
+    a NaN time or voltage are dropped.
+
+    :param lines: list of strings, one CSV row per string
+
+    :returns: array of float32 for time
+    :returns: array of float32 for voltage
+    :returns: integer number of rows dropped
+    """
+    if len(lines) == 0:
+        empty = np.zeros((0,), dtype=np.float32)
+        return empty, empty.copy(), 0
+    try:
+        data = np.loadtxt(lines, delimiter=',', usecols=(0, 1), ndmin=2)
+    except ValueError:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            data = np.genfromtxt(lines, delimiter=',', usecols=(0, 1),
+                                 invalid_raise=False)
+        data = data.reshape(-1, 2)
+    valid = ~np.isnan(data).any(axis=1)
+    time = data[valid, 0].astype(np.float32)
+    voltage = data[valid, 1].astype(np.float32)
+    return time, voltage, len(lines) - len(time)
+
+
+def stage(func):
+    """Decorator that records an ECG method as an instrumented stage
+
+    When the ECG was created with instrument set, each call records the
+    wall time, CPU time and (with trace_memory) bytes allocated by the
+    method under its name, see ECG.record_stage. Otherwise the method is
+    called straight away.
+
+    :param func: ECG method
+
+    :returns: wrapped method
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if not self.instrument:
+            return func(self, *args, **kwargs)
+        return self.record_stage(func.__name__, func, *args, **kwargs)
+    return wrapper
+
+
+# "numpy": one-pass parse_csv_lines, "csv": read_csv and parse_string,
+# "memory": time and voltage set by from_arrays or from_buffer
+INGEST_MODES = ("numpy", "csv", "memory")
 
 
 class ECG(object):
-    def __init__(self, filename):
+    def __init__(self, filename, ingest="numpy", quiet=False,
+                 filter_method="fft", instrument=None, trace_memory=False):
+        if ingest not in INGEST_MODES:
+            raise ValueError("Unknown ingest mode {}".format(ingest))
         print("***Processing filename.{}***".format(filename))
+        self.instrument = instrument
+        self.stage_stats = {}
+        self._started_tracing = False
+        self._stage_stack = []
+        if instrument and trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self.ingest = ingest
+        self.quiet = quiet
+        self.filter_method = filter_method
+        self.bandpass = None
+        self.logger = None
         self.duration = -1
         self.voltage_extremes = ()
         self.filename = filename
@@ -27,37 +174,193 @@ class ECG(object):
 
         self.init_log()
 
+    @classmethod
+    def from_arrays(cls, time, voltage, name="memory", quiet=True,
+                    **kwargs):
+        """Create an ECG from time and voltage arrays already in memory
+
+        The ECG does not read any file, and by default does not write a
+        log file either. Rows with a NaN time or voltage are dropped and
+        logged, as when reading a CSV file.
+
+        :param time: array of float of time
+        :param voltage: array of float of voltage
+        :param name: str used in place of the filename in log messages
+        :param quiet: if True, do not write a log file
+        :param kwargs: other keyword arguments of ECG
+
+        :returns: ECG object ready for preprocess()
+        """
+        ECGobject = cls(name, ingest="memory", quiet=quiet, **kwargs)
+        time = np.asarray(time, dtype=np.float32)
+        voltage = np.asarray(voltage, dtype=np.float32)
+        valid = ~(np.isnan(time) | np.isnan(voltage))
+        for i in range(len(valid) - np.count_nonzero(valid)):
+            ECGobject.logger.error("Bad or empty entry")
+        ECGobject.time = time[valid]
+        ECGobject.voltage = voltage[valid]
+        return ECGobject
+
+    @classmethod
+    def from_buffer(cls, data, name="memory", quiet=True, **kwargs):
+        """Create an ECG from the contents of a CSV file
+
+        Parses the CSV text with parse_csv_lines(), without touching
+        the file system.
+
+        :param data: bytes or str of CSV text
+        :param name: str used in place of the filename in log messages
+        :param quiet: if True, do not write a log file
+        :param kwargs: other keyword arguments of ECG
+
+        :returns: ECG object ready for preprocess()
+        """
+        if isinstance(data, bytes):
+            data = data.decode()
+        ECGobject = cls(name, ingest="memory", quiet=quiet, **kwargs)
+        time, voltage, n_bad = parse_csv_lines(data.splitlines())
+        for i in range(n_bad):
+            ECGobject.logger.error("Bad or empty entry")
+        ECGobject.time = time
+        ECGobject.voltage = voltage
+        return ECGobject
+
+    @stage
     def preprocess(self):
         """Preprocess the CSV file
 
-        Calls init_log(), read_csv(), parse_string(), log_if_abnormal_range()
-        and filter() functions as a part of the preprocessing block
+        Calls load_csv() (or read_csv() and parse_string() when the "csv"
+        ingest mode is selected), log_if_abnormal_range() and filter()
+        functions as a part of the preprocessing block. Nothing is read
+        in the "memory" ingest mode, used by from_arrays() and
+        from_buffer(), where time and voltage are already loaded.
 
         :param self: self
 
         :returns: None
         """
-        self.init_log()
-        self.read_csv()
-        self.parse_string()
+        if self.ingest == "csv":
+            self.read_csv()
+            self.parse_string()
+        elif self.ingest != "memory":
+            self.load_csv()
         self.log_if_abnormal_range()
         self.filter()
 
     def init_log(self):
         """Initializes log file
 
-        Initalizes a log file for each ECG strip being processed.
+        Initalizes a logger for each ECG strip being processed, with a
+        log file of its own unless the ECG is quiet.
         Adds an INFO log indicating begin processing.
 
         :param self: self
 
         :returns: None
         """
-        log = self.filename.split('.')[0]+'.log'
-        logging.basicConfig(filename=log, filemode="w",
-                            level=logging.INFO)
-        logging.info("Begin processing of ECG {}".format(self.filename))
+        self.logger = open_log(self.filename, quiet=self.quiet)
+        self.logger.info("Begin processing of ECG {}".format(self.filename))
+
+    def close_log(self):
+        """Closes the log file
+
+        Closes the log file of this ECG strip once analysis is done, so
+        workers processing many strips do not leak file handles.
 
+        :param self: self
+
+        :returns: None
+        """
+        close_log(self.logger)
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def record_stage(self, name, func, *args, **kwargs):
+        """Run a stage and record what it cost
+
+        Records the wall time and CPU time of func. While tracemalloc is
+        tracing (trace_memory starts it, at a large cost in speed), the
+        net bytes allocated and the peak bytes allocated over what was
+        allocated when the stage began are recorded as well; otherwise
+        they are None. Peak bytes need Python 3.9 or later to be exact
+        per stage. The numbers are added up per stage name in
+        self.stage_stats and, if instrument is callable, passed to
+        instrument(name, record) after each call. Stages nested in
+        other stages count towards both.
+
+        :param self: self
+        :param name: str, name of the stage
+        :param func: ECG method to run
+        :param args: positional arguments of func
+        :param kwargs: keyword arguments of func
+
+        :returns: the return value of func
+        """
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stage_stack:
+                outer = self._stage_stack[-1]
+                outer[1] = max(outer[1], peak)
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            self._stage_stack.append([current, current])
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            record = {"wall_s": time.perf_counter() - wall,
+                      "cpu_s": time.process_time() - cpu,
+                      "alloc_bytes": None,
+                      "peak_bytes": None}
+            if tracing:
+                current, peak = tracemalloc.get_traced_memory()
+                start, top = self._stage_stack.pop()
+                top = max(top, peak)
+                if self._stage_stack:
+                    outer = self._stage_stack[-1]
+                    outer[1] = max(outer[1], top)
+                record["alloc_bytes"] = current - start
+                record["peak_bytes"] = top - start
+            total = self.stage_stats.setdefault(
+                name, {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0,
+                       "alloc_bytes": 0, "peak_bytes": 0})
+            total["calls"] += 1
+            total["wall_s"] += record["wall_s"]
+            total["cpu_s"] += record["cpu_s"]
+            if tracing:
+                total["alloc_bytes"] += record["alloc_bytes"]
+                total["peak_bytes"] = max(total["peak_bytes"],
+                                          record["peak_bytes"])
+            if callable(self.instrument):
+                self.instrument(name, record)
+
+    @stage
+    def load_csv(self):
+        """Reads in CSV file straight to numerical arrays
+
+        Reads the whole CSV file and parses it in one pass with
+        parse_csv_lines(). Rows with bad data, missing data or NaN are
+        dropped and an error is logged for each of them, as in
+        parse_string().
+
+        :param self: self
+
+        :returns: array of float for time
+        :returns: array of float for voltage
+        """
+        with open(self.filename) as csvfile:
+            lines = csvfile.read().splitlines()
+        time, voltage, n_bad = parse_csv_lines(lines)
+        for i in range(n_bad):
+            self.logger.error("Bad or empty entry")
+        self.time = time
+        self.voltage = voltage
+        return time, voltage
+
+    @stage
     def read_csv(self):
         """Reads in CSV file for time and voltage
 
@@ -80,6 +383,7 @@ class ECG(object):
         self.voltage = voltage
         return time, voltage
 
+    @stage
     def parse_string(self):
         """Converts list of strings to numerical arrays
 
@@ -101,9 +405,9 @@ class ECG(object):
                     temp_time.append(float(self.time[i]))
                     temp_voltage.append(float(self.voltage[i]))
                 else:
-                    logging.error("Bad or empty entry")
+                    self.logger.error("Bad or empty entry")
             except ValueError:
-                logging.error("Bad or empty entry")
+                self.logger.error("Bad or empty entry")
         self.time = np.asarray(temp_time, dtype=np.float32)
         self.voltage = np.asarray(temp_voltage, dtype=np.float32)
         return temp_time, temp_voltage
@@ -120,7 +424,7 @@ class ECG(object):
         """
         if (abs(self.voltage) > 300).any():
             log_msg = self.filename + ": Voltage exceeds normal range"
-            logging.warning(log_msg)
+            self.logger.warning(log_msg)
 
     def calculate_sampling_rate(self):
         """Calculate the average sampling rate
@@ -142,38 +446,63 @@ class ECG(object):
         the total duration by the numbered of sampled points
 
         :param self: self
+        :param f: array of float of frequencies, left unchanged
         :param f1: minimum frequency of bandpass filter
         :param f2: maximum frequency of bandpas filter
 
         :returns: Array of float of frequencies
         """
-        f[abs(f) < f1] = 0
-        f[abs(f) > f2] = 0
-        return f
+        return np.where((abs(f) < f1) | (abs(f) > f2), 0, f)
 
-    def filter(self, f1=3, f2=50):
+    @stage
+    def filter(self, f1=3, f2=50, method=None):
         """Apply the bandpass filter to the signal
 
-        Apply the bandpass filter to the voltage signal. This is done
-        by calculating the fourier transform of the signal and then
-        truncating the signal at the bands
+        Apply the bandpass filter to the voltage signal. The "fft"
+        method calculates the fourier transform of the signal and then
+        truncates the signal at the bands. The "rfft" method does the
+        same on the one-sided spectrum of the real signal, with the
+        band in Hz, in half the memory. The "sos" method applies a
+        Butterworth filter forwards and backwards (zero phase), and the
+        "sos_causal" method applies it forwards only, keeping the filter
+        state in self.bandpass so that later blocks of live samples can
+        be filtered with self.bandpass.process()
 
         :param self: self
         :param f1: minimum frequency of bandpass filter
         :param f2: maximum frequency of bandpas filter
+        :param method: "fft", "rfft", "sos" or "sos_causal", defaults to the
+                       filter_method given to the constructor
 
         :returns: array of the voltage filtered
         """
         sampling_rate = self.calculate_sampling_rate()
+        if method is None:
+            method = self.filter_method
+        if method == "sos":
+            sos = bandpass_sos(sampling_rate, f1, f2)
+            self.voltage_filter = abs(signal.sosfiltfilt(sos, self.voltage))
+            return self.voltage_filter
+        if method == "sos_causal":
+            self.bandpass = BandpassFilter(sampling_rate, f1, f2)
+            self.voltage_filter = abs(self.bandpass.process(self.voltage))
+            return self.voltage_filter
+        if method == "rfft":
+            n = len(self.voltage)
+            signal_fft = np.fft.rfft(self.voltage)
+            signal_fft *= rfft_mask(n, sampling_rate, f1, f2)
+            self.voltage_filter = abs(np.fft.irfft(signal_fft, n))
+            return self.voltage_filter
+        if method != "fft":
+            raise ValueError("Unknown filter method {}".format(method))
         signal_fft = np.fft.fftshift(np.fft.fft(self.voltage))
-        f_max = 2*self.sampling_rate
-        f = np.linspace(-f_max, f_max, len(self.time))
-        f = self.bandpass_filter(f, f1, f2)
-        signal_fft_filter = signal_fft * (f != 0).astype(float)
-        signal_denoise = np.fft.ifft(signal_fft_filter)
+        signal_fft = signal_fft.astype(np.complex128, copy=False)
+        signal_fft *= fft_mask(len(self.time), sampling_rate, f1, f2)
+        signal_denoise = np.fft.ifft(signal_fft)
         self.voltage_filter = abs(signal_denoise)
         return self.voltage_filter
 
+    @stage
     def calculate_metrics(self):
         """Calculate metrics
 
@@ -186,16 +515,16 @@ class ECG(object):
 
         :returns: None
         """
-        logging.info("calculating voltage extremes")
+        self.logger.info("calculating voltage extremes")
         self.calculate_voltage_extremes()
-        logging.info("calculating duration")
+        self.logger.info("calculating duration")
         self.calculate_duration()
         self.find_peaks()
-        logging.info("calculating num_beats")
+        self.logger.info("calculating num_beats")
         self.calculate_num_beats()
-        logging.info("calculating beats")
+        self.logger.info("calculating beats")
         self.calculate_beats()
-        logging.info("calculating mean_hr_bpm")
+        self.logger.info("calculating mean_hr_bpm")
         self.calculate_mean_hr_bpm()
 
     def calculate_voltage_extremes(self):
@@ -225,6 +554,7 @@ class ECG(object):
         self.duration = np.max(self.time)
         return self.duration
 
+    @stage
     def find_peaks(self):
         """Calculate the peaks of the ECG signal
 
@@ -284,6 +614,27 @@ class ECG(object):
         self.mean_hr_bpm = np.round(60/np.mean(dif_beats))
         return self.mean_hr_bpm
 
+    def metrics(self):
+        """Collect the metrics in a dictionary
+
+        Collects the duration, voltage extreme, number of beats,
+        mean heart rate, and beat times as plain python types, ready
+        to be written out as JSON
+
+        :param self: self
+
+        :returns: dict of the metrics
+        """
+        metrics = {
+            "duration": float(self.duration),
+            "voltage_extremes": [float(v) for v in self.voltage_extremes],
+            "num_beats": int(self.num_beats),
+            "mean_hr_bpm": float(self.mean_hr_bpm),
+            "beats": np.asarray(self.beats).tolist(),
+        }
+        return metrics
+
+    @stage
     def exportJSON(self):
         """Export the metrics as a json file
 
@@ -295,35 +646,51 @@ class ECG(object):
 
         :returns: None
         """
-        logging.info("exporting all metrics to json")
-        metrics = {
-            "duration": np.float64(self.duration),
-            "voltage_extremes": self.voltage_extremes,
-            "num_beats": self.num_beats,
-            "mean_hr_bpm": self.mean_hr_bpm,
-            "beats": self.beats.tolist(),
-        }
+        self.logger.info("exporting all metrics to json")
+        metrics = self.metrics()
         filename = self.filename.split('.')[0]+'.json'
         out_file = open(filename, 'w')
         json.dump(metrics, out_file)
         out_file.close()
         print("***Finished processing filename.{}***".format(self.filename))
 
-    def make_plots(self):
+    @stage
+    def make_plots(self, out='images/ecg.jpg', fmt=None, width=640,
+                   height=480):
         """Plot the voltages
 
-        Plots the unfiltered ECG and filtered ECG signals with the
-        detected peaks
+        Plots the unfiltered ECG signal with ecg_plot.render_ecg and
+        saves the image
 
         :param self: self
+        :param out: filename or binary file object to save the plot to
+        :param fmt: image format such as "jpg", taken from the extension
+                    of out if not given
+        :param width: integer width of the image in pixels
+        :param height: integer height of the image in pixels
 
         :returns: None
         """
+        if fmt is None and not hasattr(out, "write"):
+            fmt = os.path.splitext(out)[1][1:]
+        fmt = fmt or "png"
+        image = render_ecg(self.time, self.voltage, width=width,
+                           height=height, fmt=fmt)
+        if hasattr(out, "write"):
+            out.write(image)
+        else:
+            with open(out, "wb") as out_file:
+                out_file.write(image)
+
+    def plot_bytes(self, fmt="jpg", width=640, height=480):
+        """Plot the voltages to an encoded image in memory
 
-        plt.plot(self.time, self.voltage)
-        plt.title('Original ECG')
-        plt.axis('equal')
-        plt.xlabel('time (s)')
-        plt.ylabel('voltage (mV)')
-        plt.savefig('images/ecg.jpg', dpi=200)
-        plt.close()
+        :param self: self
+        :param fmt: image format such as "jpg" or "png"
+        :param width: integer width of the image in pixels
+        :param height: integer height of the image in pixels
+
+        :returns: bytes of the encoded image
+        """
+        return render_ecg(self.time, self.voltage, width=width,
+                          height=height, fmt=fmt)
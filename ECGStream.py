@@ -0,0 +1,282 @@
+from itertools import islice
+import numpy as np
+from scipy import signal
+from ECG import parse_csv_lines, open_log, close_log
+
+
+class ECGStream(object):
+    def __init__(self, filename, chunk_size=10000, f1=3, f2=50,
+                 quiet=False, startup_samples=1000):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.startup_samples = startup_samples
+        self.f1 = f1
+        self.f2 = f2
+        self.duration = -1
+        self.voltage_extremes = ()
+        self.num_beats = 0
+        self.mean_hr_bpm = -1
+        self.sampling_rate = -1
+        self.beats = []
+        self.num_samples = 0
+
+        self.taps = None
+        self._kernel_fft = {}
+        self._history = None
+        self._pending_time = np.zeros((0,))
+        self._startup_time = np.zeros((0,))
+        self._startup_voltage = np.zeros((0,))
+        self._skip = 0
+        self._peak_buffer = np.zeros((0,))
+        self._peak_time = np.zeros((0,))
+        self._peak_offset = 0
+        self._decided = 0
+        self._last_peak = None
+        self._height = None
+        self._abnormal = False
+
+        self.logger = open_log(filename, quiet=quiet)
+
+    def run(self):
+        """Process the whole CSV file chunk by chunk
+
+        Reads chunk_size rows at a time, parses them with
+        parse_csv_lines() and feeds them to process_chunk(). Only one
+        chunk of the recording is held in memory at any time.
+
+        :param self: self
+
+        :returns: integer of heart rate in bpm
+        """
+        self.logger.info("Begin streaming of ECG {}".format(self.filename))
+        try:
+            with open(self.filename) as csvfile:
+                while True:
+                    lines = [line.rstrip('\n')
+                             for line in islice(csvfile, self.chunk_size)]
+                    if len(lines) == 0:
+                        break
+                    time, voltage, n_bad = parse_csv_lines(lines)
+                    for i in range(n_bad):
+                        self.logger.error("Bad or empty entry")
+                    self.process_chunk(time, voltage)
+        finally:
+            self.finish()
+        return self.mean_hr_bpm
+
+    def design_filter(self, sampling_rate):
+        """Design the FIR bandpass filter used for overlap-save
+
+        The filter has about one second worth of taps (always an odd
+        number, so the delay is a whole number of samples). The upper
+        cutoff is kept below the Nyquist frequency.
+
+        :param self: self
+        :param sampling_rate: float of the sampling rate in Hz
+
+        :returns: array of float of filter taps
+        """
+        self.sampling_rate = sampling_rate
+        nyquist = sampling_rate / 2
+        f2 = min(self.f2, 0.99 * nyquist)
+        numtaps = int(sampling_rate) | 1
+        self.taps = signal.firwin(numtaps, [self.f1, f2], pass_zero=False,
+                                  fs=sampling_rate)
+        self._history = np.zeros((numtaps - 1,))
+        self._skip = (numtaps - 1) // 2
+        return self.taps
+
+    def filter_chunk(self, voltage):
+        """Filter one chunk of voltage with overlap-save
+
+        The last len(taps) - 1 input samples of the previous chunk are
+        saved and prepended, so the output is the same as filtering the
+        whole recording at once, with no edge effects at chunk seams.
+
+        :param self: self
+        :param voltage: array of float of the new voltage samples
+
+        :returns: array of float of the filtered samples
+        """
+        buf = np.concatenate((self._history, voltage))
+        n = 1 << (len(buf) - 1).bit_length()
+        if n not in self._kernel_fft:
+            self._kernel_fft[n] = np.fft.rfft(self.taps, n)
+        out = np.fft.irfft(np.fft.rfft(buf, n) * self._kernel_fft[n], n)
+        self._history = buf[len(buf) - len(self._history):]
+        return out[len(buf) - len(voltage):len(buf)]
+
+    def process_chunk(self, time, voltage):
+        """Filter a chunk and update the metrics
+
+        Filters the chunk, lines the output up with the input times
+        (the FIR filter delays the signal by half its length), then
+        updates the voltage extremes, duration and beats. The first
+        startup_samples rows are held back until the filter can be
+        designed from them, see start_filter, so the result does not
+        depend on the chunk size.
+
+        :param self: self
+        :param time: array of float of time
+        :param voltage: array of float of voltage
+
+        :returns: None
+        """
+        if len(time) == 0:
+            return
+        if self.taps is None:
+            self._startup_time = np.concatenate((self._startup_time, time))
+            self._startup_voltage = np.concatenate((self._startup_voltage,
+                                                    voltage))
+            if len(self._startup_time) >= self.startup_samples:
+                self.start_filter()
+            return
+        self._filter_samples(time, voltage)
+
+    def start_filter(self):
+        """Design the filter from the held back rows and filter them
+
+        The sampling rate is estimated from the first startup_samples
+        rows, or from all of them at the end of a shorter recording.
+        Nothing is done while they do not span any time.
+
+        :param self: self
+
+        :returns: True if the filter was designed
+        """
+        time = self._startup_time[:self.startup_samples]
+        if len(time) < 2 or time[-1] <= time[0]:
+            return False
+        self.design_filter((len(time) - 1) / (time[-1] - time[0]))
+        time, voltage = self._startup_time, self._startup_voltage
+        self._startup_time = np.zeros((0,))
+        self._startup_voltage = np.zeros((0,))
+        self._filter_samples(time, voltage)
+        return True
+
+    def _filter_samples(self, time, voltage):
+        """Filter samples once the filter is designed, see process_chunk
+
+        :param self: self
+        :param time: array of float of time
+        :param voltage: array of float of voltage
+
+        :returns: None
+        """
+        if not self._abnormal and (abs(voltage) > 300).any():
+            self._abnormal = True
+            self.logger.warning(self.filename +
+                                ": Voltage exceeds normal range")
+        self.num_samples += len(time)
+        self.duration = max(self.duration, np.max(time))
+        self._pending_time = np.concatenate((self._pending_time, time))
+        self._emit(abs(self.filter_chunk(voltage)), final=False)
+
+    def finish(self):
+        """Flush the filter and decide on the remaining peaks
+
+        Filters the held back rows of a recording shorter than
+        startup_samples, feeds zeros through the filter to get the
+        delayed output for the last samples, then accepts the peaks left
+        in the carried buffer. Closes the log file.
+
+        :param self: self
+
+        :returns: None
+        """
+        if self.taps is None and len(self._startup_time) > 0 and \
+                not self.start_filter():
+            self.logger.error(self.filename +
+                              ": Not enough samples to find the "
+                              "sampling rate")
+        if self.taps is not None:
+            flush = np.zeros((len(self._pending_time),))
+            self._emit(abs(self.filter_chunk(flush)), final=True)
+        self.logger.info("Finished streaming of ECG {}".format(
+            self.filename))
+        close_log(self.logger)
+
+    def _emit(self, voltage_filter, final):
+        """Hand filtered samples lined up with their times to the
+        peak detector
+
+        :param self: self
+        :param voltage_filter: array of float of rectified filter output
+        :param final: True if no more samples will follow
+
+        :returns: None
+        """
+        skip = min(self._skip, len(voltage_filter))
+        self._skip -= skip
+        voltage_filter = voltage_filter[skip:]
+        time = self._pending_time[:len(voltage_filter)]
+        self._pending_time = self._pending_time[len(voltage_filter):]
+        if len(voltage_filter) > 0:
+            low = np.min(voltage_filter)
+            high = np.max(voltage_filter)
+            if self.voltage_extremes:
+                low = min(low, self.voltage_extremes[0])
+                high = max(high, self.voltage_extremes[1])
+            self.voltage_extremes = (low, high)
+        self._find_peaks(voltage_filter, time, final)
+
+    def _find_peaks(self, voltage_filter, time, final):
+        """Find peaks across chunk seams
+
+        Runs scipy.signal.find_peaks on the new samples plus a carried
+        tail of the previous ones. Peaks in the last `margin` samples are
+        left undecided until the next chunk shows their right-hand side.
+        The minimum height is the 80th percentile of the buffer and the
+        minimum spacing is half the sampling rate, as in ECG.find_peaks.
+
+        :param self: self
+        :param voltage_filter: array of float of rectified filter output
+        :param time: array of float of the matching times
+        :param final: True if no more samples will follow
+
+        :returns: None
+        """
+        distance = self.sampling_rate / 2
+        margin = int(np.ceil(distance)) + 1
+        buf = np.concatenate((self._peak_buffer, voltage_filter))
+        buf_time = np.concatenate((self._peak_time, time))
+        if len(buf) == 0:
+            return
+        if self._height is None or len(voltage_filter) >= margin:
+            self._height = np.percentile(buf, 80)
+        pks, p = signal.find_peaks(buf, height=self._height,
+                                   distance=distance)
+        end = len(buf) if final else len(buf) - margin
+        for pk in pks:
+            index = self._peak_offset + pk
+            if pk >= end or index < self._decided:
+                continue
+            if self._last_peak is not None and \
+                    index - self._last_peak < distance:
+                continue
+            self._last_peak = index
+            self._add_beat(buf_time[pk])
+        end = max(end, 0)
+        self._decided = max(self._decided, self._peak_offset + end)
+        keep = max(end - margin, 0)
+        self._peak_buffer = buf[keep:]
+        self._peak_time = buf_time[keep:]
+        self._peak_offset += keep
+
+    def _add_beat(self, beat_time):
+        """Record a beat and update num_beats and mean_hr_bpm
+
+        The mean of the differences between beat times only depends on
+        the first and last beat, so the heart rate is updated in
+        constant time.
+
+        :param self: self
+        :param beat_time: float of the time of the beat
+
+        :returns: None
+        """
+        self.beats.append(float(beat_time))
+        self.num_beats = len(self.beats)
+        if self.num_beats > 1:
+            span = self.beats[-1] - self.beats[0]
+            self.mean_hr_bpm = np.round(60 * (self.num_beats - 1) / span)
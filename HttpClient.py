@@ -0,0 +1,174 @@
+import gzip
+import json
+import random
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+RETRY_STATUS = {429, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+
+class HttpClient(object):
+    """Shared HTTP client for talking to the cloud server
+
+    Wraps one requests.Session, so connections are pooled and kept
+    alive between calls instead of opened for every request. Every
+    call gets a timeout, and failed calls are retried with jittered
+    exponential backoff. Only requests that are safe to repeat are
+    retried after they may have reached the server: GET and the other
+    idempotent methods on connection errors, timeouts and 429/502/503/
+    504 responses, but POST only when the connection could not be made
+    (refused, unresolved host or connect timeout), so it was never sent.
+    JSON bodies can be sent gzip compressed, to servers that decompress
+    request bodies.
+    """
+
+    def __init__(self, timeout=(3.05, 10), retries=3, backoff=0.25,
+                 max_backoff=4.0, pool_size=10, gzip_min_size=None):
+        """Create a client with its own connection pool
+
+        :param timeout: float or (connect, read) tuple of seconds, the
+                        default timeout of each call
+        :param retries: int, times a failed call is tried again
+        :param backoff: float, seconds of the first backoff, doubled on
+                        each retry
+        :param max_backoff: float, most seconds to wait between tries
+        :param pool_size: int, connections kept open per host
+        :param gzip_min_size: int, JSON bodies of at least this many
+                              bytes are gzip compressed, None (the
+                              default) for only when post is asked to
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.gzip_min_size = gzip_min_size
+        self.sleep = time.sleep
+        self.random = random.random
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def backoff_delay(self, attempt):
+        """Seconds to wait before retry number attempt
+
+        Uses "full jitter": a random time up to the exponential backoff,
+        so clients that failed together do not retry together.
+
+        :param attempt: int, 0 for the first retry
+
+        :returns: float of seconds
+        """
+        return min(self.max_backoff, self.backoff * 2 ** attempt) * \
+            self.random()
+
+    def request(self, method, url, retries=None, timeout=None, **kwargs):
+        """Send a request, retrying failures
+
+        :param method: str, HTTP method such as "GET"
+        :param url: str, full url of the request
+        :param retries: int, overrides the client's retries for this call
+        :param timeout: float or (connect, read) tuple, overrides the
+                        client's timeout for this call
+        :param kwargs: other arguments of requests.Session.request
+
+        :returns: requests.Response, the last one if every try failed
+        :raises requests.RequestException: if the last try failed to
+                                           get a response
+        """
+        retries = self.retries if retries is None else retries
+        timeout = self.timeout if timeout is None else timeout
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        for attempt in range(retries + 1):
+            last = attempt == retries
+            try:
+                response = self.session.request(method, url,
+                                                timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                if last or not (idempotent or connection_not_made(error)):
+                    raise
+            else:
+                if last or not idempotent or \
+                        response.status_code not in RETRY_STATUS:
+                    return response
+                response.close()
+            self.sleep(self.backoff_delay(attempt))
+
+    def get(self, url, **kwargs):
+        """Send a GET request, see request
+
+        :param url: str, full url of the request
+        :param kwargs: other arguments of request
+
+        :returns: requests.Response
+        """
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, json=None, compress=None, **kwargs):
+        """Send a POST request, see request
+
+        A json body is gzip compressed, with a Content-Encoding: gzip
+        header, when compress is True, or when compress is None and the
+        body is at least gzip_min_size bytes.
+
+        :param url: str, full url of the request
+        :param json: object to send as the JSON body
+        :param compress: bool, whether to gzip the JSON body, None to
+                         decide by its size
+        :param kwargs: other arguments of request
+
+        :returns: requests.Response
+        """
+        if json is not None:
+            body = encode_json(json)
+            if compress is None:
+                compress = self.gzip_min_size is not None and \
+                    len(body) >= self.gzip_min_size
+            headers = dict(kwargs.pop("headers", None) or {})
+            headers["Content-Type"] = "application/json"
+            if compress:
+                body = gzip.compress(body)
+                headers["Content-Encoding"] = "gzip"
+            kwargs["data"] = body
+            kwargs["headers"] = headers
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        """Close the pooled connections
+
+        :returns: None
+        """
+        self.session.close()
+
+
+def connection_not_made(error):
+    """Check whether a request failed before reaching the server
+
+    :param error: requests.RequestException raised by a request
+
+    :returns: True if the connection was refused, the host could not be
+              resolved or connecting timed out, so nothing was sent
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    reason = getattr(reason, "reason", reason)
+    return isinstance(reason, NewConnectionError)
+
+
+def encode_json(obj):
+    """Encode an object as a JSON request body
+
+    :param obj: JSON serializable object
+
+    :returns: bytes of the UTF-8 JSON
+    """
+    return json.dumps(obj).encode("utf-8")
+
+
+# One client shared by patient_client and monitor_client
+session = HttpClient()
@@ -0,0 +1,39 @@
+from pymodm import MongoModel, fields
+from pymongo import ASCENDING, IndexModel
+
+
+class ImageBlob(MongoModel):
+    """Metadata of one stored image
+
+    The image bytes live in ImageChunk documents, so listing or
+    counting images never reads them. Smaller copies of an uploaded
+    image, such as its thumbnail, are ImageBlobs too, with the
+    ObjectId of the uploaded image in original and the name of the
+    size in variant.
+    """
+    mrn = fields.IntegerField()
+    kind = fields.CharField()
+    timestamp = fields.CharField(blank=True)
+    encoding = fields.CharField()
+    content_type = fields.CharField(blank=True)
+    length = fields.IntegerField()
+    chunk_count = fields.IntegerField()
+    original = fields.ObjectIdField(blank=True)
+    variant = fields.CharField(blank=True)
+
+    class Meta:
+        indexes = [IndexModel([("mrn", ASCENDING), ("kind", ASCENDING),
+                               ("timestamp", ASCENDING)]),
+                   IndexModel([("original", ASCENDING),
+                               ("variant", ASCENDING)])]
+
+
+class ImageChunk(MongoModel):
+    """One piece of the bytes of a stored image"""
+    blob = fields.ObjectIdField()
+    n = fields.IntegerField()
+    data = fields.BinaryField()
+
+    class Meta:
+        indexes = [IndexModel([("blob", ASCENDING), ("n", ASCENDING)],
+                              unique=True)]
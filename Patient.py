@@ -9,3 +9,5 @@ class Patient(MongoModel):
     ecg_image = fields.ListField()
     entry_time = fields.ListField()
     heart_rate = fields.ListField()
+    version = fields.IntegerField()
+    last_modified = fields.DateTimeField()
@@ -0,0 +1,112 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache(object):
+    """In-process LRU cache of route results with a time to live
+
+    Keys are tuples that start with the route name, followed by the
+    medical record number for per-patient routes, such as
+    ("most_recent", 101). Writes call invalidate with the MRN they
+    changed. Safe to share between the threads of the server.
+    """
+
+    def __init__(self, maxsize=1024, ttl=5.0, clock=time.monotonic):
+        """Create an empty cache
+
+        :param maxsize: int, most entries kept before the least recently
+                        used is evicted
+        :param ttl: float, seconds an entry stays valid
+        :param clock: function returning the current time in seconds
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get_or_call(self, key, func, *args):
+        """Return the cached result for key, or call func and cache it
+
+        If an invalidation happens while func runs, its result may
+        already be out of date and is returned without being cached.
+
+        :param key: tuple, (route, mrn, ...)
+        :param func: function computing the result on a miss
+        :param args: arguments for func
+
+        :returns: the cached or computed result
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+        value = func(*args)
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = (self.clock() + self.ttl, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def invalidate(self, mrn=None):
+        """Drop the entries of one patient
+
+        :param mrn: int, medical record number whose entries are dropped,
+                    None to drop only the entries of routes without one
+
+        :returns: int, number of entries dropped
+        """
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            keys = [key for key in self._entries
+                    if (key[1] if len(key) > 1 else None) == mrn]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def clear(self):
+        """Drop every entry and reset the counters
+
+        :returns: None
+        """
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self.hits = self.misses = 0
+            self.evictions = self.invalidations = 0
+
+    def stats(self):
+        """Counters of the cache
+
+        :returns: dict with entries:
+                `hits`: lookups served from the cache
+                `misses`: lookups that called the route
+                `hit_rate`: hits over all lookups
+                `evictions`: entries dropped for space
+                `invalidations`: invalidate calls
+                `size`: entries held
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "size": len(self._entries),
+            }
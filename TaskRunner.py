@@ -0,0 +1,74 @@
+import logging
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TaskRunner(object):
+    """Run slow work on background threads for a Tk application
+
+    Tk widgets may only be touched from the thread running mainloop,
+    and any callback that blocks it freezes the whole window. submit
+    runs a function, such as a server request and image decode, on a
+    thread pool. Its result is put on a queue, and process, called
+    periodically from the Tk loop with root.after, hands each finished
+    result to its callback on the Tk thread.
+    """
+
+    def __init__(self, max_workers=4):
+        """Create a runner with its own thread pool
+
+        :param max_workers: int, most functions run at the same time
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._finished = queue.Queue()
+
+    def submit(self, func, callback, *args, errback=None):
+        """Run func(*args) on a background thread
+
+        :param func: function to run, must not touch Tk widgets
+        :param callback: function called by process with the result
+        :param args: arguments for func
+        :param errback: function called by process with the exception
+                        if func raises, None to log it
+
+        :returns: concurrent.futures.Future of the call
+        """
+        return self._executor.submit(self._run, func, args, callback,
+                                     errback)
+
+    def _run(self, func, args, callback, errback):
+        """Call func on a pool thread and queue its outcome for process"""
+        try:
+            result = func(*args)
+        except Exception as error:
+            self._finished.put((errback, error, True))
+            raise
+        self._finished.put((callback, result, False))
+        return result
+
+    def process(self):
+        """Call the callbacks of the functions that have finished
+
+        Must be called from the Tk thread. Does not wait for functions
+        still running.
+
+        :returns: int, number of callbacks called
+        """
+        count = 0
+        while True:
+            try:
+                handler, value, failed = self._finished.get_nowait()
+            except queue.Empty:
+                return count
+            count += 1
+            if failed and handler is None:
+                logging.warning("Background task failed: %r", value)
+            else:
+                handler(value)
+
+    def shutdown(self):
+        """Stop the thread pool without waiting for running functions
+
+        :returns: None
+        """
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,75 @@
+import queue
+import threading
+
+
+class UpdateBroker(object):
+    """Fan patient update notifications out to live subscribers
+
+    Each subscriber, such as one /events stream, gets its own queue.
+    publish never blocks: when a subscriber falls so far behind that
+    its queue is full, the pending notifications are replaced with a
+    single {"type": "resync"}, telling it to reload everything.
+    """
+
+    def __init__(self, maxsize=100):
+        """Create a broker without subscribers
+
+        :param maxsize: int, notifications kept per subscriber
+        """
+        self.maxsize = maxsize
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        """Register a new subscriber
+
+        :returns: queue.Queue that receives each notification dict
+        """
+        subscriber = queue.Queue(maxsize=self.maxsize)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """Stop sending notifications to a subscriber
+
+        :param subscriber: queue.Queue from subscribe
+
+        :returns: None
+        """
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, event):
+        """Send a notification to every subscriber
+
+        :param event: dict describing the update, such as
+                      {"type": "patient", "mrn": 101}
+
+        :returns: int, number of subscribers notified
+        """
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                self._overflow(subscriber, event)
+        return len(subscribers)
+
+    def _overflow(self, subscriber, event):
+        """Make room in a full queue and ask the subscriber to resync"""
+        try:
+            while True:
+                subscriber.get_nowait()
+        except queue.Empty:
+            pass
+        for item in [{"type": "resync"}, event]:
+            try:
+                subscriber.put_nowait(item)
+            except queue.Full:
+                pass
+
+    def __len__(self):
+        with self._lock:
+            return len(self._subscribers)
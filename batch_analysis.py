@@ -0,0 +1,223 @@
+import argparse
+import glob
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from ECG import ECG
+
+
+def find_ecg_files(path):
+    """Find the ECG files to analyze
+
+    Accepts a directory, in which case every .csv file in it is used,
+    or a glob pattern such as "ecg_data/test_data*.csv".
+
+    :param path: str, directory or glob pattern
+
+    :returns: sorted list of filenames
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, "*.csv")
+    return sorted(glob.glob(path))
+
+
+def finite_or_none(value):
+    """Replace a NaN or infinite metric by None
+
+    Such metrics, like the mean heart rate of a file with fewer than
+    two beats, are not valid JSON numbers and are written as null.
+
+    :param value: float of the metric
+
+    :returns: the value, or None if it is not finite
+    """
+    return value if math.isfinite(value) else None
+
+
+def analyze_file(filename, quiet=False, profile=False, trace_memory=False):
+    """Analyze one ECG file and report the outcome
+
+    Runs the same steps as ecg_analysis.analyze (without the plot) and
+    collects the exportJSON metrics. Any exception is caught and
+    reported, so one bad file does not abort the batch.
+
+    :param filename: path to the CSV file
+    :param quiet: if True, do not write a log file
+    :param profile: if True, record the cost of each stage
+    :param trace_memory: if True, profile the bytes allocated as well
+
+    :returns: dict with entries:
+            `filename`: path to the CSV file
+            `status`: "ok" or "failed"
+            `metrics`: dict of metrics, None if failed; a metric that
+                       cannot be computed, like the mean heart rate of
+                       a file with fewer than two beats, is None
+            `error`: error message, None if ok
+            `num_samples`: number of samples read
+            `latency_s`: wall time spent on the file in seconds
+            `stages`: ECG.stage_stats if profile is set
+    """
+    start = time.perf_counter()
+    result = {"filename": filename, "status": "ok", "metrics": None,
+              "error": None, "num_samples": 0}
+    ECGobject = ECG(filename, quiet=quiet, instrument=profile,
+                    trace_memory=trace_memory)
+    try:
+        ECGobject.preprocess()
+        result["num_samples"] = len(ECGobject.time)
+        ECGobject.calculate_metrics()
+        metrics = ECGobject.metrics()
+        for key in ["duration", "mean_hr_bpm"]:
+            metrics[key] = finite_or_none(metrics[key])
+        metrics["voltage_extremes"] = [
+            finite_or_none(v) for v in metrics["voltage_extremes"]]
+        result["metrics"] = metrics
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+    finally:
+        ECGobject.close_log()
+    if profile:
+        result["stages"] = ECGobject.stage_stats
+    result["latency_s"] = time.perf_counter() - start
+    return result
+
+
+def run_batch(filenames, workers=None, quiet=False, profile=False,
+              trace_memory=False):
+    """Analyze many ECG files over a process pool
+
+    Fans the files out over a ProcessPoolExecutor. A worker that dies
+    is reported as a failure for its file rather than ending the run.
+
+    :param filenames: list of paths to CSV files
+    :param workers: int, number of worker processes (None for one per
+                    CPU)
+    :param quiet: if True, do not write a log file per ECG file
+    :param profile: if True, record the cost of each stage per file
+    :param trace_memory: if True, profile the bytes allocated as well
+
+    :returns: list of result dicts sorted by filename
+    :returns: dict of the throughput summary
+    """
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(analyze_file, filename, quiet,
+                                   profile, trace_memory): filename
+                   for filename in filenames}
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append({"filename": futures[future],
+                                "status": "failed", "metrics": None,
+                                "error": "{}: {}".format(type(e).__name__,
+                                                         e),
+                                "num_samples": 0, "latency_s": 0.0})
+    elapsed = time.perf_counter() - start
+    results.sort(key=lambda result: result["filename"])
+    return results, summarize_batch(results, elapsed)
+
+
+def summarize_batch(results, elapsed):
+    """Summarize the throughput of a batch run
+
+    :param results: list of result dicts from analyze_file
+    :param elapsed: float, wall time of the whole batch in seconds
+
+    :returns: dict with entries:
+            `files`: number of files
+            `failed`: number of failed files
+            `elapsed_s`: wall time of the batch
+            `files_per_s`: files analyzed per second
+            `samples_per_s`: samples analyzed per second
+            `latency_p50_s`: median per-file latency
+            `latency_p95_s`: 95th percentile per-file latency
+            `stages`: wall and CPU seconds per stage summed over the
+                      files that were profiled
+    """
+    latency = [result["latency_s"] for result in results]
+    num_samples = sum(result["num_samples"] for result in results)
+    summary = {
+        "files": len(results),
+        "failed": sum(result["status"] != "ok" for result in results),
+        "elapsed_s": elapsed,
+        "files_per_s": len(results) / elapsed if elapsed > 0 else 0.0,
+        "samples_per_s": num_samples / elapsed if elapsed > 0 else 0.0,
+        "latency_p50_s": float(np.percentile(latency, 50)) if latency
+        else 0.0,
+        "latency_p95_s": float(np.percentile(latency, 95)) if latency
+        else 0.0,
+        "stages": {},
+    }
+    for result in results:
+        for name, stats in result.get("stages", {}).items():
+            total = summary["stages"].setdefault(
+                name, {"wall_s": 0.0, "cpu_s": 0.0})
+            total["wall_s"] += stats["wall_s"]
+            total["cpu_s"] += stats["cpu_s"]
+    return summary
+
+
+def write_results(results, summary, filename):
+    """Write the per-file results and the summary to a JSON file
+
+    :param results: list of result dicts from analyze_file
+    :param summary: dict from summarize_batch
+    :param filename: str, output filename
+
+    :returns: None
+    """
+    with open(filename, "w") as out_file:
+        json.dump({"summary": summary, "results": results}, out_file,
+                  indent=2, allow_nan=False)
+
+
+def main(argv=None):
+    """Command line entry point for batch analysis
+
+    :param argv: list of command line arguments (defaults to sys.argv)
+
+    :returns: integer exit code, 1 if any file failed
+    """
+    parser = argparse.ArgumentParser(
+        description="Analyze many ECG CSV files in parallel")
+    parser.add_argument("path", help="directory or glob of CSV files")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="number of worker processes")
+    parser.add_argument("-o", "--output", default="batch_results.json",
+                        help="JSON file for the per-file metrics")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="do not write a .log file per ECG file")
+    parser.add_argument("-p", "--profile", action="store_true",
+                        help="record the time spent per pipeline stage")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="with --profile, also record the bytes "
+                        "allocated per stage (slow)")
+    args = parser.parse_args(argv)
+
+    filenames = find_ecg_files(args.path)
+    results, summary = run_batch(filenames, workers=args.workers,
+                                 quiet=args.quiet, profile=args.profile,
+                                 trace_memory=args.trace_memory)
+    write_results(results, summary, args.output)
+    for result in results:
+        if result["status"] != "ok":
+            print("FAILED {}: {}".format(result["filename"],
+                                         result["error"]))
+    print("{files} files ({failed} failed) in {elapsed_s:.2f} s: "
+          "{files_per_s:.1f} files/s, {samples_per_s:.0f} samples/s, "
+          "p50 {latency_p50_s:.3f} s, p95 {latency_p95_s:.3f} s"
+          .format(**summary))
+    for name, total in summary["stages"].items():
+        print("  {:<18} {:8.3f} s wall {:8.3f} s cpu".format(
+            name, total["wall_s"], total["cpu_s"]))
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
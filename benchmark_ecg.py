@@ -0,0 +1,221 @@
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from ECG import ECG
+
+STAGES = ["load_csv", "read_csv", "parse_string", "filter", "find_peaks",
+          "calculate_metrics", "exportJSON", "make_plots"]
+
+
+def make_synthetic_csv(filename, n, sampling_rate=360, hr_bpm=72):
+    """Write a synthetic ECG recording to a CSV file
+
+    The trace is a train of narrow spikes at hr_bpm on top of a little
+    noise and baseline wander, sampled at sampling_rate.
+
+    :param filename: str, CSV file to write
+    :param n: integer number of samples
+    :param sampling_rate: float of the sampling rate in Hz
+    :param hr_bpm: heart rate of the spike train in bpm
+
+    :returns: None
+    """
+    rng = np.random.default_rng(0)
+    time = np.arange(n) / sampling_rate
+    voltage = 0.05 * rng.standard_normal(n) + 0.2 * np.sin(0.5 * time)
+    phase = (time * hr_bpm / 60) % 1
+    voltage += np.exp(-((phase - 0.5) * 60) ** 2)
+    np.savetxt(filename, np.column_stack((time, voltage)), fmt="%.4f",
+               delimiter=",")
+
+
+def max_rss_bytes():
+    """Peak resident set size of this process so far
+
+    :returns: integer of bytes, None where the resource module is missing
+    """
+    try:
+        import resource
+    except ImportError:  # pragma: no cover
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def run_stages(filename, measure):
+    """Run every stage of the pipeline once on one file
+
+    Stages run in pipeline order on the same ECG object, so each one
+    sees the output of the one before, as in ecg_analysis.analyze.
+
+    :param filename: path to the CSV file
+    :param measure: function(stage, callable) that runs and records a
+                    stage
+
+    :returns: integer number of samples in the file
+    """
+    ECGobject = ECG(filename, quiet=True)
+    try:
+        measure("load_csv", ECGobject.load_csv)
+        measure("read_csv", ECGobject.read_csv)
+        measure("parse_string", ECGobject.parse_string)
+        measure("filter", ECGobject.filter)
+        measure("find_peaks", ECGobject.find_peaks)
+        measure("calculate_metrics", ECGobject.calculate_metrics)
+        measure("exportJSON", ECGobject.exportJSON)
+        measure("make_plots", ECGobject.make_plots)
+    finally:
+        ECGobject.close_log()
+    return len(ECGobject.time)
+
+
+def bench_file(filename, repeat=3):
+    """Time and measure each stage of the pipeline on one file
+
+    Each stage is timed repeat times and the fastest run is kept. One
+    more run is made under tracemalloc for the peak bytes allocated by
+    each stage, since tracing slows the timed runs down.
+
+    :param filename: path to the CSV file
+    :param repeat: integer number of timed runs
+
+    :returns: dict of stage name to dict with entries:
+            `seconds`: fastest wall time
+            `samples_per_s`: samples processed per second
+            `peak_alloc_bytes`: peak bytes allocated during the stage
+            `max_rss_bytes`: peak RSS of the process after the stage
+    """
+    results = {stage: {"seconds": float("inf")} for stage in STAGES}
+
+    def timed(stage, func):
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+        results[stage]["seconds"] = min(results[stage]["seconds"], seconds)
+        results[stage]["max_rss_bytes"] = max_rss_bytes()
+
+    def traced(stage, func):
+        tracemalloc.start()
+        func()
+        results[stage]["peak_alloc_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    for i in range(repeat):
+        num_samples = run_stages(filename, timed)
+    run_stages(filename, traced)
+    for stage in STAGES:
+        seconds = results[stage]["seconds"]
+        results[stage]["samples_per_s"] = num_samples / seconds \
+            if seconds > 0 else float("inf")
+    return results
+
+
+def run_benchmarks(filenames, sizes, repeat=3):
+    """Benchmark the fixture files and synthetic recordings
+
+    Works in a temporary directory, so the .json and images/ecg.jpg
+    outputs of the pipeline do not land in the repository.
+
+    :param filenames: list of CSV files to benchmark
+    :param sizes: list of integer sample counts for synthetic recordings
+    :param repeat: integer number of timed runs per stage
+
+    :returns: dict of case name to the bench_file results
+    """
+    results = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.mkdir(os.path.join(workdir, "images"))
+        cases = []
+        for filename in filenames:
+            copy = os.path.join(workdir, os.path.basename(filename))
+            shutil.copy(filename, copy)
+            cases.append((os.path.basename(filename), copy))
+        for n in sizes:
+            synthetic = os.path.join(workdir, "synthetic_{}.csv".format(n))
+            make_synthetic_csv(synthetic, n)
+            cases.append(("synthetic_{}".format(n), synthetic))
+        os.chdir(workdir)
+        try:
+            for name, filename in cases:
+                results[name] = bench_file(filename, repeat=repeat)
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def compare(results, baseline, tolerance=0.25):
+    """Find stages that got slower than the baseline
+
+    :param results: dict from run_benchmarks
+    :param baseline: dict from an earlier run_benchmarks
+    :param tolerance: allowed relative slowdown, 0.25 for 25%
+
+    :returns: list of str describing each regression
+    """
+    regressions = []
+    for case, stages in results.items():
+        for stage, result in stages.items():
+            try:
+                before = baseline[case][stage]["seconds"]
+            except KeyError:
+                continue
+            if result["seconds"] > before * (1 + tolerance):
+                regressions.append("{} {}: {:.4f} s -> {:.4f} s".format(
+                    case, stage, before, result["seconds"]))
+    return regressions
+
+
+def main(argv=None):
+    """Command line entry point for the benchmarks
+
+    :param argv: list of command line arguments (defaults to sys.argv)
+
+    :returns: integer exit code, 1 if a stage regressed
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark each stage of the ECG pipeline")
+    parser.add_argument("--files", default="ecg_data/test_data*.csv",
+                        help="glob of CSV files to benchmark")
+    parser.add_argument("--sizes", default="10000,100000,1000000,10000000",
+                        help="comma separated synthetic sample counts")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="timed runs per stage")
+    parser.add_argument("--save", help="write the results to this file")
+    parser.add_argument("--compare", help="baseline results to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed relative slowdown per stage")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    results = run_benchmarks(sorted(glob.glob(args.files)), sizes,
+                             repeat=args.repeat)
+    for case, stages in results.items():
+        for stage, result in stages.items():
+            print("{:<24} {:<18} {:10.4f} s {:14.0f} samples/s "
+                  "{:10.1f} MB peak".format(
+                      case, stage, result["seconds"],
+                      result["samples_per_s"],
+                      result["peak_alloc_bytes"] / 1e6))
+    if args.save:
+        with open(args.save, "w") as out_file:
+            json.dump(results, out_file, indent=2)
+    if args.compare:
+        with open(args.compare) as in_file:
+            regressions = compare(results, json.load(in_file),
+                                  args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -48,3 +48,29 @@ def dummy_mongodb():
     yield
     for pt in Patient.objects.raw({}):
         pt.delete()
+
+
+@pytest.fixture
+def mock_mongodb():
+    """Connect pymodm to an empty in-memory mongomock database
+
+    The server's response cache is cleared to match the empty database.
+    The connection that was registered before is put back afterwards.
+    """
+    from unittest import mock
+    import mongomock
+    from pymodm import connection
+    from ImageBlob import ImageBlob, ImageChunk
+    from server import response_cache
+    models = [Patient, ImageBlob, ImageChunk]
+    saved = dict(connection._CONNECTIONS)
+    with mock.patch("pymodm.connection.MongoClient", mongomock.MongoClient):
+        connect("mongodb://localhost:27017/mock_db")
+    for model in models:
+        model._mongometa._indexes_created = False
+    response_cache.clear()
+    yield
+    connection._CONNECTIONS.clear()
+    connection._CONNECTIONS.update(saved)
+    for model in models:
+        model._mongometa._indexes_created = False
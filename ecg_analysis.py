@@ -1,21 +1,123 @@
 from ECG import ECG
+from ECGStream import ECGStream
 
 
-def analyze(filename):
+def analyze(filename, ingest="numpy", quiet=False, filter_method="fft",
+            instrument=None, trace_memory=False):
     """Main driver function
 
     Reads in CSV file, preprocess the CSV file, calculate
     the metrics, and exports the JSON file. Optional graphing
     allowed.
 
-    :param: None
+    :param filename: path to the CSV file
+    :param ingest: "numpy" for the one-pass parser or "csv" for the
+                   row by row parser
+    :param quiet: if True, do not write a log file
+    :param filter_method: "fft", "rfft", "sos" or "sos_causal", see
+                          ECG.filter
+    :param instrument: None, or a function(stage, record) called with
+                       the cost of each stage, see ECG.record_stage
+    :param trace_memory: if True, also record the bytes allocated by
+                         each stage (slow)
 
-    :returns: None
+    :returns: integer of heart rate in bpm
     """
-    ECGobject = ECG(filename)
-    ECGobject.preprocess()
-    ECGobject.calculate_metrics()
-    # Uncomment the line below if you want to plot the ECG signal
-    ECGobject.make_plots()
-    # ECGobject.exportJSON()
+    ECGobject = ECG(filename, ingest=ingest, quiet=quiet,
+                    filter_method=filter_method, instrument=instrument,
+                    trace_memory=trace_memory)
+    try:
+        ECGobject.preprocess()
+        ECGobject.calculate_metrics()
+        # Uncomment the line below if you want to plot the ECG signal
+        ECGobject.make_plots()
+        # ECGobject.exportJSON()
+    finally:
+        ECGobject.close_log()
     return int(ECGobject.mean_hr_bpm)
+
+
+def analyze_stream(filename, chunk_size=10000, quiet=False):
+    """Streaming driver function
+
+    Reads the CSV file in chunks of chunk_size rows, filtering and
+    finding beats as it goes, so memory use does not grow with the
+    length of the recording.
+
+    :param filename: path to the CSV file
+    :param chunk_size: number of rows read at a time
+    :param quiet: if True, do not write a log file
+
+    :returns: integer of heart rate in bpm
+    """
+    stream = ECGStream(filename, chunk_size=chunk_size, quiet=quiet)
+    stream.run()
+    return int(stream.mean_hr_bpm)
+
+
+def analyze_in_memory(ECGobject, plot=True, fmt="jpg", width=640,
+                      height=480):
+    """Analyze an ECG built from memory and return the results
+
+    :param ECGobject: ECG from ECG.from_arrays or ECG.from_buffer
+    :param plot: if True, also render the plot
+    :param fmt: image format of the plot
+    :param width: integer width of the plot in pixels
+    :param height: integer height of the plot in pixels
+
+    :returns: dict of the metrics, see ECG.metrics
+    :returns: bytes of the encoded plot, None if plot is False
+    """
+    try:
+        ECGobject.preprocess()
+        ECGobject.calculate_metrics()
+        image = None
+        if plot:
+            image = ECGobject.plot_bytes(fmt=fmt, width=width,
+                                         height=height)
+    finally:
+        ECGobject.close_log()
+    return ECGobject.metrics(), image
+
+
+def analyze_arrays(time, voltage, plot=True, fmt="jpg", width=640,
+                   height=480, **kwargs):
+    """Analyze an ECG given as time and voltage arrays
+
+    No file is read or written.
+
+    :param time: array of float of time
+    :param voltage: array of float of voltage
+    :param plot: if True, also render the plot
+    :param fmt: image format of the plot
+    :param width: integer width of the plot in pixels
+    :param height: integer height of the plot in pixels
+    :param kwargs: other keyword arguments of ECG.from_arrays
+
+    :returns: dict of the metrics, see ECG.metrics
+    :returns: bytes of the encoded plot, None if plot is False
+    """
+    ECGobject = ECG.from_arrays(time, voltage, **kwargs)
+    return analyze_in_memory(ECGobject, plot=plot, fmt=fmt, width=width,
+                             height=height)
+
+
+def analyze_buffer(data, plot=True, fmt="jpg", width=640, height=480,
+                   **kwargs):
+    """Analyze an ECG given as the contents of a CSV file
+
+    No file is read or written.
+
+    :param data: bytes or str of CSV text
+    :param plot: if True, also render the plot
+    :param fmt: image format of the plot
+    :param width: integer width of the plot in pixels
+    :param height: integer height of the plot in pixels
+    :param kwargs: other keyword arguments of ECG.from_buffer
+
+    :returns: dict of the metrics, see ECG.metrics
+    :returns: bytes of the encoded plot, None if plot is False
+    """
+    ECGobject = ECG.from_buffer(data, **kwargs)
+    return analyze_in_memory(ECGobject, plot=plot, fmt=fmt, width=width,
+                             height=height)
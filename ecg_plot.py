@@ -0,0 +1,66 @@
+import io
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+
+def decimate_minmax(time, voltage, n_columns):
+    """Reduce a trace to its minimum and maximum per pixel column
+
+    Splits the samples into n_columns bins of consecutive samples and
+    keeps the smallest and largest voltage of each bin, in time order.
+    Drawn n_columns pixels wide, the result looks the same as the full
+    trace, spikes included, but costs O(n_columns) to draw.
+
+    :param time: array of float of time
+    :param voltage: array of float of voltage
+    :param n_columns: integer number of pixel columns
+
+    :returns: array of float of time
+    :returns: array of float of voltage
+    """
+    time = np.asarray(time)
+    voltage = np.asarray(voltage)
+    n = len(voltage)
+    if n <= 2 * n_columns:
+        return time, voltage
+    per_column = -(-n // n_columns)
+    padded = np.pad(voltage, (0, per_column * n_columns - n), mode='edge')
+    bins = padded.reshape(n_columns, per_column)
+    start = np.arange(n_columns)[:, None] * per_column
+    index = np.hstack((start + bins.argmin(axis=1)[:, None],
+                       start + bins.argmax(axis=1)[:, None]))
+    index = np.minimum(np.sort(index, axis=1).ravel(), n - 1)
+    return time[index], voltage[index]
+
+
+def render_ecg(time, voltage, width=640, height=480, fmt="jpg", dpi=100,
+               title='Original ECG'):
+    """Render an ECG trace to an encoded image
+
+    Uses its own Figure and Agg canvas rather than the pyplot state
+    machine, so renders from several threads do not collide, and
+    nothing is written to disk. Long traces are decimated to the
+    minimum and maximum of each pixel column before drawing.
+
+    :param time: array of float of time
+    :param voltage: array of float of voltage
+    :param width: integer width of the image in pixels
+    :param height: integer height of the image in pixels
+    :param fmt: image format such as "jpg" or "png"
+    :param dpi: dots per inch, sets the size of the text
+    :param title: str, title of the plot
+
+    :returns: bytes of the encoded image
+    """
+    fig = Figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    ax.plot(*decimate_minmax(time, voltage, width))
+    ax.set_title(title)
+    ax.axis('equal')
+    ax.set_xlabel('time (s)')
+    ax.set_ylabel('voltage (mV)')
+    buf = io.BytesIO()
+    fig.savefig(buf, format=fmt, dpi=dpi)
+    return buf.getvalue()
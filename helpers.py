@@ -149,9 +149,9 @@ def get_medical_image_by_index(patient_record, index):
 
     :param patient_record: Patient object (MongoDB entry)
     :param index: int, index of medical record
-    :returns: Medical image data, None if not found
+    :returns: Medical image data, None if not found or index is negative
     """
-    if len(patient_record.medical_image) >= index:
+    if 0 <= index < len(patient_record.medical_image):
         return patient_record.medical_image[index]
     else:
         return None
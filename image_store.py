@@ -0,0 +1,504 @@
+import base64
+import binascii
+import io
+import tempfile
+from bson import ObjectId
+from PIL import Image
+from pymodm import errors as pymodm_errors
+from pymongo.errors import PyMongoError
+from ImageBlob import ImageBlob, ImageChunk
+
+CHUNK_SIZE = 255 * 1024
+
+CONTENT_TYPES = [(b"\xff\xd8\xff", "image/jpeg"), (b"\x89PNG", "image/png"),
+                 (b"GIF8", "image/gif"), (b"BM", "image/bmp")]
+
+# Smaller copies stored for each uploaded image, by name: the image is
+# scaled down, keeping its aspect ratio, to fit in (width, height)
+VARIANT_SIZES = {"thumbnail": (150, 150), "preview": (400, 400)}
+
+# While an image is written, a copy is spooled for making its smaller
+# copies: in memory up to SPOOL_MEMORY_BYTES, then in a temporary file.
+# Larger uploads than MAX_VARIANT_SOURCE_BYTES get no smaller copies.
+SPOOL_MEMORY_BYTES = 4 * CHUNK_SIZE
+MAX_VARIANT_SOURCE_BYTES = 64 * 1024 * 1024
+
+
+def encode_image(image):
+    """Turn an uploaded image string into the bytes to store
+
+    Clients upload images as base64 strings. A string that is valid
+    base64 and decodes back to itself is stored as the decoded bytes,
+    a quarter smaller. Anything else is stored as its UTF-8 text.
+
+    :param image: str of the uploaded image
+
+    :returns: bytes to store
+    :returns: str of the encoding, "base64" when the bytes are the image
+              itself (sent as base64 by the JSON routes), "text" when
+              they are the UTF-8 of a string that is not base64
+    """
+    try:
+        data = base64.b64decode(image, validate=True)
+    except (binascii.Error, ValueError):
+        return image.encode(), "text"
+    if base64.b64encode(data).decode() != image:
+        return image.encode(), "text"
+    return data, "base64"
+
+
+def guess_content_type(data):
+    """Guess the media type of an image from its first bytes
+
+    :param data: bytes at the start of the image
+
+    :returns: str, media type such as "image/jpeg"
+    """
+    for magic, content_type in CONTENT_TYPES:
+        if data.startswith(magic):
+            return content_type
+    return "application/octet-stream"
+
+
+def served_content_type(content_type):
+    """Media type to send a stored image with
+
+    Only the image types of CONTENT_TYPES are sent as such. Anything
+    else, such as text that was stored with a type the client claimed,
+    is sent as application/octet-stream, so a browser never runs it as
+    a page of this server.
+
+    :param content_type: str, media type stored with the image
+
+    :returns: str, media type for the response
+    """
+    for magic, image_type in CONTENT_TYPES:
+        if content_type == image_type:
+            return content_type
+    return "application/octet-stream"
+
+
+def put_image(mrn, kind, image, timestamp=None):
+    """Store an uploaded image in the blob store
+
+    Writes the image bytes in chunks of CHUNK_SIZE and the metadata
+    in an ImageBlob, which is what the Patient document refers to.
+
+    :param mrn: int, medical record number of the patient
+    :param kind: str, "ecg_image" or "medical_image"
+    :param image: str of the uploaded base64 image
+    :param timestamp: str, upload timestamp of an ECG image
+
+    :returns: ObjectId of the stored image
+    """
+    data, encoding = encode_image(image)
+    content_type = guess_content_type(data) if encoding == "base64" \
+        else "text/plain"
+    return put_image_stream(mrn, kind, io.BytesIO(data), timestamp,
+                            content_type, encoding)
+
+
+def put_image_stream(mrn, kind, stream, timestamp=None, content_type=None,
+                     encoding="base64", original=None, variant=None):
+    """Store an image read from a binary file object
+
+    Reads and writes one chunk of CHUNK_SIZE at a time, so large
+    images do not have to fit in memory. The ImageBlob is written
+    last, so a partly written image is never visible. The smaller
+    copies of VARIANT_SIZES are then made from a spooled copy of the
+    bytes, without reading the chunks back, see put_variants.
+
+    :param mrn: int, medical record number of the patient
+    :param kind: str, "ecg_image" or "medical_image"
+    :param stream: binary file object with a read method
+    :param timestamp: str, upload timestamp of an ECG image
+    :param content_type: str, media type, guessed from the first bytes
+                         if not given
+    :param encoding: str, "base64" for image bytes, see encode_image
+    :param original: ObjectId of the image this is a smaller copy of
+    :param variant: str, name in VARIANT_SIZES of this smaller copy
+
+    :returns: ObjectId of the stored image
+    """
+    blob_id = ObjectId()
+    length = 0
+    n = 0
+    spool = None
+    try:
+        while True:
+            data = stream.read(CHUNK_SIZE)
+            if not data:
+                break
+            if n == 0:
+                if content_type is None:
+                    content_type = guess_content_type(data)
+                if variant is None and encoding == "base64" and \
+                        content_type.startswith("image/"):
+                    spool = tempfile.SpooledTemporaryFile(
+                        max_size=SPOOL_MEMORY_BYTES)
+            ImageChunk(blob=blob_id, n=n, data=data).save()
+            length += len(data)
+            n += 1
+            if spool is not None and length > MAX_VARIANT_SOURCE_BYTES:
+                spool.close()
+                spool = None
+            if spool is not None:
+                spool.write(data)
+        blob = ImageBlob(_id=blob_id, mrn=mrn, kind=kind,
+                         timestamp=timestamp, encoding=encoding,
+                         length=length, chunk_count=n,
+                         content_type=content_type or
+                         "application/octet-stream",
+                         original=original, variant=variant)
+        blob.save()
+        if spool is not None:
+            spool.seek(0)
+            put_variants(blob, spool)
+    finally:
+        if spool is not None:
+            spool.close()
+    return blob.pk
+
+
+def put_variants(blob, source):
+    """Store the smaller copies of an uploaded image
+
+    Makes one JPEG per size in VARIANT_SIZES that is smaller than the
+    image. A JPEG is decoded in draft mode, already scaled down towards
+    the largest size. Nothing is stored for uploads that are not
+    images PIL can read.
+
+    :param blob: ImageBlob of the uploaded image
+    :param source: seekable binary file object of the image bytes
+
+    :returns: dict of the ObjectId of each stored copy by size name
+    """
+    refs = {}
+    if blob.encoding != "base64" or \
+            not (blob.content_type or "").startswith("image/"):
+        return refs
+    for name, data in make_variants(source).items():
+        refs[name] = put_image_stream(blob.mrn, blob.kind,
+                                      io.BytesIO(data), None, "image/jpeg",
+                                      original=blob.pk, variant=name)
+    return refs
+
+
+def make_variants(source):
+    """Make the smaller copies of an image, without storing them
+
+    :param source: seekable binary file object of the image bytes
+
+    :returns: dict of bytes of the JPEG of each copy by size name, empty
+              if PIL cannot read the image
+    """
+    variants = {}
+    try:
+        image = Image.open(source)
+        full_size = image.size
+        image.draft(None, max(VARIANT_SIZES.values()))
+        image.load()
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+        return variants
+    if image.mode not in ["RGB", "L"]:
+        image = image.convert("RGB")
+    for name, size in VARIANT_SIZES.items():
+        if full_size[0] <= size[0] and full_size[1] <= size[1]:
+            continue
+        variant = image.copy()
+        variant.thumbnail(size)
+        data = io.BytesIO()
+        variant.save(data, format="JPEG", quality=85)
+        variants[name] = data.getvalue()
+    return variants
+
+
+def put_images(images):
+    """Store many uploaded images with two database writes
+
+    Like put_image for each image, smaller copies included, but the
+    chunks of all the images go in one insert_many and their ImageBlobs
+    in a second one, after the chunks, so a partly written image is
+    never visible. If a write fails, whatever was written is deleted.
+
+    :param images: list of (mrn, kind, image, timestamp) tuples of the
+                   arguments of put_image
+
+    :returns: list of ObjectId of the stored images, in order
+    """
+    blobs = []
+    chunks = []
+    refs = []
+    for mrn, kind, image, timestamp in images:
+        data, encoding = encode_image(image)
+        content_type = guess_content_type(data) if encoding == "base64" \
+            else "text/plain"
+        blob, blob_chunks = image_documents(mrn, kind, data, timestamp,
+                                            content_type, encoding)
+        blobs.append(blob)
+        chunks.extend(blob_chunks)
+        refs.append(blob.pk)
+        if encoding != "base64" or not content_type.startswith("image/") \
+                or len(data) > MAX_VARIANT_SOURCE_BYTES:
+            continue
+        for name, variant in make_variants(io.BytesIO(data)).items():
+            blob, blob_chunks = image_documents(
+                mrn, kind, variant, None, "image/jpeg", original=refs[-1],
+                variant=name)
+            blobs.append(blob)
+            chunks.extend(blob_chunks)
+    if not blobs:
+        return refs
+    try:
+        if chunks:
+            ImageChunk.objects.bulk_create(chunks)
+        ImageBlob.objects.bulk_create(blobs)
+    except PyMongoError:
+        blob_ids = [blob.pk for blob in blobs]
+        ImageBlob.objects.raw({"_id": {"$in": blob_ids}}).delete()
+        ImageChunk.objects.raw({"blob": {"$in": blob_ids}}).delete()
+        raise
+    return refs
+
+
+def image_documents(mrn, kind, data, timestamp=None, content_type=None,
+                    encoding="base64", original=None, variant=None):
+    """Build the documents of an image without writing them
+
+    :param mrn: int, medical record number of the patient
+    :param kind: str, "ecg_image" or "medical_image"
+    :param data: bytes to store
+    :param timestamp: str, upload timestamp of an ECG image
+    :param content_type: str, media type, guessed from the bytes if not
+                         given
+    :param encoding: str, "base64" for image bytes, see encode_image
+    :param original: ObjectId of the image this is a smaller copy of
+    :param variant: str, name in VARIANT_SIZES of this smaller copy
+
+    :returns: ImageBlob of the image
+    :returns: list of its ImageChunks
+    """
+    blob_id = ObjectId()
+    chunks = [ImageChunk(blob=blob_id, n=n, data=data[start:start +
+                                                      CHUNK_SIZE])
+              for n, start in enumerate(range(0, len(data), CHUNK_SIZE))]
+    blob = ImageBlob(_id=blob_id, mrn=mrn, kind=kind, timestamp=timestamp,
+                     encoding=encoding, length=len(data),
+                     chunk_count=len(chunks),
+                     content_type=content_type or guess_content_type(data),
+                     original=original, variant=variant)
+    return blob, chunks
+
+
+def find_variant(ref, size):
+    """Find a smaller copy of a stored image
+
+    :param ref: ObjectId of the uploaded image
+    :param size: str, name in VARIANT_SIZES
+
+    :returns: ImageBlob, None if there is no copy of that size
+    """
+    try:
+        return ImageBlob.objects.raw({"original": ref,
+                                      "variant": size}).first()
+    except pymodm_errors.DoesNotExist:
+        return None
+
+
+def get_image_blob(ref, size=None):
+    """Get the metadata of a stored image at a size
+
+    Images smaller than the size, and images stored before the
+    smaller copies were made, have no copy of that size; the uploaded
+    image is returned for them.
+
+    :param ref: ObjectId from put_image
+    :param size: str, name in VARIANT_SIZES, None for the uploaded image
+
+    :returns: ImageBlob, None if not found
+    """
+    if size is not None:
+        blob = find_variant(ref, size)
+        if blob is not None:
+            return blob
+    return get_blob(ref)
+
+
+def get_blob(ref):
+    """Get the metadata of a stored image
+
+    :param ref: ObjectId from put_image
+
+    :returns: ImageBlob, None if not found
+    """
+    try:
+        return ImageBlob.objects.raw({"_id": ref}).first()
+    except pymodm_errors.DoesNotExist:
+        return None
+
+
+def load_image(ref, size=None):
+    """Get an image back as the string that was uploaded
+
+    Patient records made before the blob store hold the images inline,
+    so a str is returned as it is, whatever the size.
+
+    :param ref: ObjectId from put_image, or an inline image str
+    :param size: str, name in VARIANT_SIZES, None for the uploaded image
+
+    :returns: str of the image, None if ref is None or not found
+    """
+    if ref is None or isinstance(ref, str):
+        return ref
+    blob = get_image_blob(ref, size)
+    if blob is None:
+        return None
+    return read_blob(blob)
+
+
+def find_ecg_blob(mrn, timestamp):
+    """Find the ECG image of a patient uploaded at a timestamp
+
+    One read on the (mrn, kind, timestamp) index of the blobs, without
+    loading the patient. If two ECG images share the timestamp, the
+    first one uploaded is returned.
+
+    :param mrn: int, medical record number of the patient
+    :param timestamp: str, upload timestamp of the ECG image
+
+    :returns: ImageBlob, None if not found
+    """
+    query = ImageBlob.objects.raw({"mrn": mrn, "kind": "ecg_image",
+                                   "timestamp": timestamp})
+    try:
+        return query.order_by([("_id", 1)]).first()
+    except pymodm_errors.DoesNotExist:
+        return None
+
+
+def stored_ecg_timestamps(keys):
+    """Find which (mrn, timestamp) pairs already have an ECG image
+
+    One read on the (mrn, kind, timestamp) index of the blobs for all
+    the pairs, returning only those two fields.
+
+    :param keys: list of (int mrn, str timestamp)
+
+    :returns: set of the (mrn, timestamp) pairs of keys that have a
+              stored ECG image
+    """
+    keys = set(keys)
+    if not keys:
+        return set()
+    cursor = ImageBlob._mongometa.collection.find(
+        {"mrn": {"$in": list({mrn for mrn, timestamp in keys})},
+         "kind": "ecg_image",
+         "timestamp": {"$in": list({timestamp for mrn, timestamp in keys})}},
+        {"mrn": 1, "timestamp": 1, "_id": 0})
+    return keys & {(blob["mrn"], blob["timestamp"]) for blob in cursor}
+
+
+def load_ecg_by_timestamp(mrn, timestamp, size=None):
+    """Get the ECG image of a patient uploaded at a timestamp
+
+    :param mrn: int, medical record number of the patient
+    :param timestamp: str, upload timestamp of the ECG image
+    :param size: str, name in VARIANT_SIZES, None for the uploaded image
+
+    :returns: str of the image, None if not found
+    """
+    blob = find_ecg_blob(mrn, timestamp)
+    if blob is None:
+        return None
+    if size is not None:
+        blob = find_variant(blob.pk, size) or blob
+    return read_blob(blob)
+
+
+def read_blob(blob):
+    """Read the bytes of a stored image back into its uploaded string
+
+    :param blob: ImageBlob of the image
+
+    :returns: str of the image
+    """
+    data = b"".join(iter_blob(blob))
+    if blob.encoding == "base64":
+        return base64.b64encode(data).decode()
+    return data.decode()
+
+
+def iter_blob(blob, batch_size=4):
+    """Generate the stored bytes of an image one chunk at a time
+
+    The chunks are fetched batch_size at a time, so streaming an image
+    holds only a few chunks in memory whatever its size.
+
+    :param blob: ImageBlob of the image
+    :param batch_size: int, chunks fetched per round trip
+
+    :returns: generator of bytes
+    """
+    cursor = ImageChunk._mongometa.collection.find(
+        {"blob": blob.pk}, {"data": 1}, sort=[("n", 1)],
+        batch_size=batch_size)
+    for chunk in cursor:
+        yield bytes(chunk["data"])
+
+
+def delete_blobs(refs):
+    """Delete stored images and their smaller copies
+
+    The ImageBlobs are deleted before their chunks, so no image is
+    left visible without its bytes.
+
+    :param refs: list of ObjectId from put_image
+
+    :returns: int, number of ImageBlobs deleted
+    """
+    if not refs:
+        return 0
+    query = {"$or": [{"_id": {"$in": refs}}, {"original": {"$in": refs}}]}
+    blob_ids = [blob.pk for blob in ImageBlob.objects.raw(query)]
+    ImageBlob.objects.raw({"_id": {"$in": blob_ids}}).delete()
+    ImageChunk.objects.raw({"blob": {"$in": blob_ids}}).delete()
+    return len(blob_ids)
+
+
+def delete_images(mrn):
+    """Delete every stored image of a patient
+
+    :param mrn: int, medical record number of the patient
+
+    :returns: int, number of images deleted
+    """
+    blob_ids = [blob.pk for blob in ImageBlob.objects.raw({"mrn": mrn})]
+    ImageChunk.objects.raw({"blob": {"$in": blob_ids}}).delete()
+    ImageBlob.objects.raw({"_id": {"$in": blob_ids}}).delete()
+    return len(blob_ids)
+
+
+def move_inline_images(patient):
+    """Move the inline images of an older Patient into the blob store
+
+    Replaces each image str in the ecg_image and medical_image lists
+    with the ObjectId of a stored copy and saves the patient.
+
+    :param patient: Patient object (MongoDB entry)
+
+    :returns: int, number of images moved
+    """
+    moved = 0
+    for kind in ["ecg_image", "medical_image"]:
+        images = getattr(patient, kind)
+        for index, image in enumerate(images):
+            if not isinstance(image, str):
+                continue
+            timestamp = None
+            if kind == "ecg_image" and index < len(patient.entry_time):
+                timestamp = patient.entry_time[index]
+            images[index] = put_image(patient.mrn, kind, image, timestamp)
+            moved += 1
+    if moved:
+        patient.save()
+    return moved
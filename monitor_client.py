@@ -1,15 +1,65 @@
 import requests
 import base64
 import io
+import json
+import threading
 import matplotlib.image as mpimg
 from matplotlib import pyplot as plt
 from skimage.io import imsave
 import pdb
 from PIL import Image, ImageTk
 import numpy as np
+from HttpClient import session
+from ResponseCache import ResponseCache
 
 server_address = 'http://vcm-17598.vm.duke.edu:5000'
 
+# url: (ETag, Last-Modified, JSON body) of the last full response
+validators = {}
+
+THUMBNAIL_SIZE = (300, 300)
+
+# Copy of the images made by the server that thumbnails are made from,
+# the smallest one at least as large as THUMBNAIL_SIZE
+THUMBNAIL_SOURCE = "preview"
+
+# Decoded thumbnails by ("ecg_image", mrn, timestamp) or
+# ("medical_image", mrn, image id). A stored image never changes, so
+# entries do not expire and are only evicted for space.
+image_cache = ResponseCache(maxsize=64, ttl=float("inf"))
+
+
+def conditional_get(url):
+    """GET request that reuses the last response if unchanged
+
+    Sends the ETag and Last-Modified of the last response for this url
+    as If-None-Match and If-Modified-Since. On 304 Not Modified the
+    stored JSON is returned without downloading it again.
+
+    :param url: str, full url of the request
+
+    :returns: JSON decoded body of the response
+    """
+    headers = {}
+    stored = validators.get(url)
+    if stored is not None:
+        etag, last_modified, body = stored
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if last_modified is not None:
+            headers["If-Modified-Since"] = last_modified
+    r = session.get(url, headers=headers)
+    if r.status_code == 304 and stored is not None:
+        return stored[2]
+    body = r.json()
+    etag = r.headers.get("ETag")
+    last_modified = r.headers.get("Last-Modified")
+    if etag is not None or last_modified is not None:
+        validators[url] = (etag, last_modified, body)
+    else:
+        validators.pop(url, None)
+    return body
+
 
 def load_all_patients():  # pragma: no cover
     """GET request to server to load all patient MRNs
@@ -21,16 +71,96 @@ def load_all_patients():  # pragma: no cover
 
     :returns: list of patient MRNs
     """
-    r = requests.get(server_address+"/mrn_list").json()
+    r = session.get(server_address+"/mrn_list").json()
     return r['data']
 
 
+def parse_sse(lines):
+    """Parse a text/event-stream into events
+
+    :param lines: iterable of str lines of the stream, without newlines
+
+    :returns: generator of (str event name, decoded JSON data)
+    """
+    name, data = "message", []
+    for line in lines:
+        if line == "":
+            if data:
+                yield name, json.loads("\n".join(data))
+            name, data = "message", []
+        elif line.startswith(":"):
+            continue
+        else:
+            field, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            if field == "event":
+                name = value
+            elif field == "data":
+                data.append(value)
+
+
+def listen_for_updates(events, stop, mrn=None,
+                       reconnect_delay=3.0):  # pragma: no cover
+    """Put the server's patient update notifications on a queue
+
+    Reads the /events server-sent event stream until stop is set,
+    reconnecting after reconnect_delay seconds if it drops. Each
+    "patient" notification is put on events as a dict. A {"type":
+    "resync"} is put on events on every (re)connection, as updates may
+    have been missed while disconnected.
+
+    :param events: queue.Queue the notifications are put on
+    :param stop: threading.Event that ends the loop
+    :param mrn: int, only listen to this patient, None for all
+    :param reconnect_delay: float, seconds to wait before reconnecting
+
+    :returns: None
+    """
+    url = server_address + "/events"
+    params = {} if mrn is None else {"mrn": mrn}
+    while not stop.is_set():
+        try:
+            with session.get(url, params=params, stream=True,
+                             timeout=(5, 60), retries=0) as r:
+                r.raise_for_status()
+                lines = r.iter_lines(decode_unicode=True)
+                for name, data in parse_sse(lines):
+                    if name == "hello":
+                        events.put({"type": "resync"})
+                    elif name in ["patient", "resync"]:
+                        events.put(data)
+                    if stop.is_set():
+                        return
+        except (requests.RequestException, ValueError):
+            pass
+        stop.wait(reconnect_delay)
+
+
+def subscribe_updates(events, mrn=None):  # pragma: no cover
+    """Start listening for patient updates in a background thread
+
+    The Tk loop should read events with get_nowait, since the
+    notifications are put on it from another thread.
+
+    :param events: queue.Queue the notifications are put on
+    :param mrn: int, only listen to this patient, None for all
+
+    :returns: threading.Event, set it to stop listening
+    """
+    stop = threading.Event()
+    thread = threading.Thread(target=listen_for_updates,
+                              args=(events, stop, mrn), daemon=True)
+    thread.start()
+    return stop
+
+
 def load_patient_latest(mrn):  # pragma: no cover
     """GET request to the server, retrieve latest patient data
 
     Sends a GET request to the server for a specific patient MRN.
     Expects a JSON string containing the patient name, last measured
-    heart rate/ECG image, and the timestamp for this ECG.
+    heart rate/ECG image, and the timestamp for this ECG. Unchanged
+    data is not downloaded again, see conditional_get.
 
     :param mrn: int, patient MRN
     :return: dict, latest patient data:
@@ -38,7 +168,29 @@ def load_patient_latest(mrn):  # pragma: no cover
              `latest_hr`: last recorded patient heart rate
              `latest_ecg`: last uploaded ECG image
     """
-    r = requests.get(server_address+f"/{mrn}/most_recent").json()
+    r = conditional_get(server_address+f"/{mrn}/most_recent")
+    return r
+
+
+def load_patient_snapshot(mrn):  # pragma: no cover
+    """GET request to the server, retrieve everything shown for a patient
+
+    Sends one GET request to the server for a specific patient MRN,
+    in place of load_patient_latest, load_list_of_ecg_timestamps and
+    load_list_of_medical_images. The latest ECG image is not included,
+    fetch it with load_ecg_by_timestamp when entry_time changes.
+
+    :param mrn: int, patient MRN
+    :return: dict, patient snapshot:
+             `name`: patient name
+             `latest_hr`: last recorded patient heart rate
+             `entry_time`: timestamp of the last ECG image
+             `latest_ecg_id`: id of the last ECG image, or None
+             `has_ecg`: True if the patient has an ECG image
+             `ecg_timestamps`: list of ECG entry timestamps
+             `medical_images`: list of medical image entry indices
+    """
+    r = conditional_get(server_address + f"/{mrn}/snapshot")
     return r
 
 
@@ -52,7 +204,7 @@ def load_list_of_ecg_timestamps(mrn):  # pragma: no cover
     :param mrn: int, patient MRN
     :return: list of ECG entry timestamps
     """
-    r = requests.get(server_address+f"/{mrn}/ecg/timestamps").json()
+    r = conditional_get(server_address+f"/{mrn}/ecg/timestamps")
     return r
 
 
@@ -66,7 +218,7 @@ def load_list_of_medical_images(mrn):  # pragma: no cover
     :param mrn: int, patient MRN
     :return: list of medical image entry indices
     """
-    r = requests.get(server_address + f"/{mrn}/images").json()
+    r = conditional_get(server_address + f"/{mrn}/images")
     return r['result']
 
 
@@ -81,7 +233,7 @@ def load_ecg_by_timestamp(mrn, timestamp):  # pragma: no cover
     :param timestamp: string, ECG image timestamp
     :return: string, encoded image data
     """
-    r = requests.get(server_address + f"/{mrn}/ecg/{timestamp}").json()
+    r = session.get(server_address + f"/{mrn}/ecg/{timestamp}").json()
     return r['result']
 
 
@@ -96,10 +248,114 @@ def load_img_by_id(mrn, img_id):  # pragma: no cover
     :param img_id: int, medical image id
     :return: string, encoded image data
     """
-    r = requests.get(server_address + f"/{mrn}/images/{img_id}").json()
+    r = session.get(server_address + f"/{mrn}/images/{img_id}").json()
     return r['result']
 
 
+def load_ecg_image(mrn, timestamp, size=None):  # pragma: no cover
+    """GET request to the server, retrieve ECG image bytes by timestamp
+
+    Binary counterpart of load_ecg_by_timestamp: the image comes as
+    image/jpeg bytes rather than base64 in JSON.
+
+    :param mrn: int, patient MRN
+    :param timestamp: string, ECG image timestamp
+    :param size: str, "thumbnail" or "preview" for a smaller copy made
+                 by the server, None for the uploaded image
+    :return: bytes of the image
+    """
+    r = session.get(server_address + f"/{mrn}/ecg/{timestamp}/image",
+                    params=None if size is None else {"size": size})
+    r.raise_for_status()
+    return r.content
+
+
+def load_medical_image(mrn, img_id, size=None):  # pragma: no cover
+    """GET request to the server, retrieve medical image bytes by ID
+
+    Binary counterpart of load_img_by_id: the image comes as
+    image/jpeg bytes rather than base64 in JSON.
+
+    :param mrn: int, patient MRN
+    :param img_id: int, medical image id
+    :param size: str, "thumbnail" or "preview" for a smaller copy made
+                 by the server, None for the uploaded image
+    :return: bytes of the image
+    """
+    r = session.get(server_address + f"/{mrn}/images/{img_id}/image",
+                    params=None if size is None else {"size": size})
+    r.raise_for_status()
+    return r.content
+
+
+def decode_thumbnail(image_bytes, size=THUMBNAIL_SIZE):
+    """Decode image file bytes into a PIL image sized for display
+
+    A JPEG is decoded in draft mode, which scales it down by 1/2, 1/4
+    or 1/8 while decoding, as far as it stays at least as large as the
+    thumbnail, so a large JPEG is never decoded at full size.
+
+    :param image_bytes: bytes of an image file
+    :param size: tuple (width, height) of the thumbnail
+
+    :returns: PIL Image of the given size
+    """
+    img_obj = Image.open(io.BytesIO(image_bytes))
+    img_obj.draft(None, size)
+    return img_obj.resize(size)
+
+
+def fetch_thumbnail(loader, *args):
+    """Download an image and decode it into a thumbnail
+
+    :param loader: function returning image bytes, such as load_ecg_image
+    :param args: arguments for loader
+
+    :returns: PIL Image, see decode_thumbnail
+    """
+    return decode_thumbnail(loader(*args))
+
+
+def load_ecg_thumbnail(mrn, timestamp):
+    """Get the decoded thumbnail of an ECG image by timestamp
+
+    Downloads the server's THUMBNAIL_SOURCE copy rather than the full
+    image. Served from image_cache when the image was loaded before,
+    without downloading or decoding it again.
+
+    :param mrn: int or str, patient MRN
+    :param timestamp: string, ECG image timestamp
+    :return: PIL Image, see decode_thumbnail
+    """
+    return image_cache.get_or_call(
+        ("ecg_image", str(mrn), str(timestamp)), fetch_thumbnail,
+        load_ecg_image, mrn, timestamp, THUMBNAIL_SOURCE)
+
+
+def load_medical_thumbnail(mrn, img_id):
+    """Get the decoded thumbnail of a medical image by ID
+
+    Downloads the server's THUMBNAIL_SOURCE copy rather than the full
+    image. Served from image_cache when the image was loaded before,
+    without downloading or decoding it again.
+
+    :param mrn: int or str, patient MRN
+    :param img_id: int, medical image id
+    :return: PIL Image, see decode_thumbnail
+    """
+    return image_cache.get_or_call(
+        ("medical_image", str(mrn), str(img_id)), fetch_thumbnail,
+        load_medical_image, mrn, img_id, THUMBNAIL_SOURCE)
+
+
+def image_cache_stats():
+    """Counters of the thumbnail cache
+
+    :return: dict, see ResponseCache.stats
+    """
+    return image_cache.stats()
+
+
 def convert_b64_string_to_ndarray(b64_string):
     """Converts a b64 string to an image ndarray
 
@@ -132,6 +388,17 @@ def download_image_from_server(b64_string, filename):
         out_file.write(image_bytes)
 
 
+def save_image_bytes(image_bytes, filename):
+    """Saves image bytes to file
+
+    :param image_bytes: bytes of the image file
+    :param filename: str, filename to save to
+    :return:
+    """
+    with open(filename, "wb") as out_file:
+        out_file.write(image_bytes)
+
+
 if __name__ == '__main__':  # pragma: no cover
     pt_list = load_all_patients()
     print(pt_list)
@@ -9,10 +9,70 @@ import base64
 from ecg_analysis import analyze
 import monitor_client as mc
 import io
-from skimage.io import imsave
+import queue
 from patient_client import convert_ndarray_to_b64_string
+from TaskRunner import TaskRunner
 
 first_load = True
+shown_ecg = None
+refreshing = False
+refresh_again = False
+
+
+def load_latest_ecg(mrn, pt_info):
+    """Download the latest ECG image of a patient
+
+    Fetches the image bytes by the snapshot's entry time. Older
+    records without an entry time fall back to the base64 image
+    of load_patient_latest.
+
+    :param mrn: str, patient MRN
+    :param pt_info: dict from mc.load_patient_snapshot
+
+    :returns: bytes of the image
+    """
+    if pt_info['entry_time'] is not None:
+        return mc.load_ecg_image(mrn, pt_info['entry_time'])
+    return base64.b64decode(mc.load_patient_latest(mrn)['latest_ecg'])
+
+
+def download_latest_ecg(mrn):
+    """Download the latest ECG image of a patient by its MRN
+
+    :param mrn: str, patient MRN
+
+    :returns: bytes of the image
+    """
+    return load_latest_ecg(mrn, mc.load_patient_snapshot(mrn))
+
+
+def fetch_patient(mrn, shown):
+    """Download what the monitor shows for a patient
+
+    Runs on a TaskRunner thread. Makes one snapshot request, and
+    gets the thumbnail of the latest ECG image only when it is not
+    the one already shown. The thumbnail comes from the monitor_client
+    image cache if that image was loaded before.
+
+    :param mrn: str, patient MRN
+    :param shown: tuple (mrn, latest_ecg_id, entry_time) of the ECG
+                  image shown, or None
+
+    :returns: str, the patient MRN
+    :returns: dict from mc.load_patient_snapshot
+    :returns: PIL Image of the latest ECG, see mc.decode_thumbnail,
+              None if it has not changed
+              or the patient has no ECG image
+    """
+    pt_info = mc.load_patient_snapshot(mrn)
+    latest_ecg = (mrn, pt_info['latest_ecg_id'], pt_info['entry_time'])
+    ecg_img = None
+    if pt_info['has_ecg'] and latest_ecg != shown:
+        if pt_info['entry_time'] is not None:
+            ecg_img = mc.load_ecg_thumbnail(mrn, pt_info['entry_time'])
+        else:
+            ecg_img = mc.decode_thumbnail(load_latest_ecg(mrn, pt_info))
+    return mrn, pt_info, ecg_img
 
 
 def main_window():
@@ -25,39 +85,114 @@ def main_window():
     :returns: None
     """
 
-    def refresh_data():
-        """Refresh data on a loop
+    def check_updates():
+        """Apply the update notifications pushed by the server
 
-        Every 5 seconds, refresh all the loaded data and schedule
-        another call to this method.
+        Every 100 ms, show the results of finished background
+        requests, then empty the local queue filled by the
+        monitor_client subscriber thread, and reload only what the
+        notifications say has changed: the patient list when a patient
+        was added, the selected patient when it got an upload, and
+        everything on a resync. No request is made while nothing
+        changes, and none is made on the Tk thread.
 
         :param None:
 
         :returns: None
         """
-        if not first_load:
+        runner.process()
+        reload_list = reload_patient = False
+        while True:
+            try:
+                event = updates.get_nowait()
+            except queue.Empty:
+                break
+            if event["type"] == "resync":
+                reload_list = reload_patient = True
+            elif event["type"] == "patient":
+                reload_list = reload_list or event["new"]
+                if str(event["mrn"]) == mrn_dropdown.get():
+                    reload_patient = True
+        if reload_list:
+            runner.submit(mc.load_all_patients, show_patient_list)
+        if reload_patient and not first_load:
             get_latest_data()
-        mrn_dropdown['values'] = mc.load_all_patients()
-        root.after(5000, refresh_data)
+        root.after(100, check_updates)
+
+    def show_patient_list(mrn_list):
+        """Show the downloaded list of patient MRNs
+
+        :param mrn_list: list of patient MRNs
+
+        :returns: None
+        """
+        mrn_dropdown['values'] = mrn_list
 
     def get_latest_data():
         """Retrieve latest data for the selected patient
 
-        Poll database for the most recent data for the selected patient.
-        If no patient selected, do nothing.
+        Poll database for the most recent data for the selected patient
+        in the background, see fetch_patient, and show it when it
+        arrives. Only one refresh runs at a time; a refresh asked for
+        meanwhile starts when it finishes. If no patient selected, do
+        nothing.
 
         :param None:
 
         :returns: None
         """
+        global refreshing, refresh_again
         mrn = mrn_dropdown.get()
         if mrn == '':
             return
         mrn_value.set(mrn)
-        pt_info = mc.load_patient_latest(mrn)
-        ecg_images = mc.load_list_of_ecg_timestamps(mrn)
+        if refreshing:
+            refresh_again = True
+            return
+        refreshing = True
+        runner.submit(fetch_patient, show_latest_data, mrn, shown_ecg,
+                      errback=refresh_failed)
+
+    def refresh_done():
+        """Start the refresh asked for while the last one ran
+
+        :param None:
+
+        :returns: None
+        """
+        global refreshing, refresh_again
+        refreshing = False
+        if refresh_again:
+            refresh_again = False
+            get_latest_data()
+
+    def refresh_failed(error):
+        """Keep showing the last data when a refresh fails
+
+        :param error: Exception raised by fetch_patient
+
+        :returns: None
+        """
+        print(f"Could not load patient data: {error!r}")
+        refresh_done()
+
+    def show_latest_data(result):
+        """Show the data downloaded by fetch_patient
+
+        Data for a patient that is no longer selected is dropped.
+
+        :param result: tuple returned by fetch_patient
+
+        :returns: None
+        """
+        global shown_ecg
+        mrn, pt_info, ecg_img = result
+        if mrn != mrn_value.get():
+            refresh_done()
+            return
+        ecg_images = pt_info['ecg_timestamps']
         ecg_dropdown['values'] = ecg_images
-        pt_med_images = mc.load_list_of_medical_images(int(mrn))
+        pt_med_images = pt_info['medical_images']
         med_image_dropdown['values'] = pt_med_images
         if pt_med_images is []:
             med_img_load_btn.state(['disabled'])
@@ -82,14 +217,16 @@ def main_window():
         else:
             pt_name.set(pt_info['name'])
 
-        if pt_info['latest_ecg'] is None:
+        if not pt_info['has_ecg']:
             ecg_img_label.image = ''
-        else:
-            img_data = mc.convert_b64_string_to_ndarray(pt_info['latest_ecg'])
-            ecg_img = load_img_data(img_data)
+            shown_ecg = None
+        elif ecg_img is not None:
+            shown_ecg = (mrn, pt_info['latest_ecg_id'], pt_info['entry_time'])
+            ecg_img = ImageTk.PhotoImage(ecg_img)
             ecg_img_label.image = ecg_img
             ecg_img_label.configure(image=ecg_img)
             save_ecg_btn.state(['!disabled'])
+        refresh_done()
 
     def load_btn_cmd():
         """Load latest information for selected patient
@@ -103,8 +240,9 @@ def main_window():
         """
         mrn = mrn_dropdown.get()
         if mrn != '':
-            global first_load
+            global first_load, shown_ecg
             first_load = False
+            shown_ecg = None
             heart_rate_value.set("")
             timestamp_value.set("")
             pt_name.set("")
@@ -119,33 +257,15 @@ def main_window():
 
             get_latest_data()
 
-    def load_img_data(ndarray_img):
-        """Convert ndarray image data to TKinter object
-
-        Accepts an ndarray with image data, and returns
-        the TKinter object for the data.
-
-        :param ndarray_img: ndarray with image data
-
-        :returns: TKinter Image object
-        """
-        f = io.BytesIO()
-        imsave(f, ndarray_img, plugin='pil')
-        img = io.BytesIO()
-        img.write(f.getvalue())
-        img_obj = Image.open(img)
-        pil_image_resize = img_obj.resize((300, 300))
-        return ImageTk.PhotoImage(pil_image_resize)
-
     def save_image(image, template_name):
         """Save image to file
 
-        Accepts a b64 image string as input, along with
+        Accepts image file bytes as input, along with
         the template filename to use, and writes this image out
         to a file.
 
         :param template_name: str, image file name to save to
-        :param image: base 64 image data
+        :param image: bytes of the image file
 
         :returns: None
         """
@@ -154,12 +274,12 @@ def main_window():
             defaultextension=".jpg")
         if file == "":
             return
-        mc.download_image_from_server(image, file)
+        mc.save_image_bytes(image, file)
 
     def save_cur_ecg():
         """Save current ECG image to file
 
-        Download base64 image data from server for
+        Download the image data from server for
         current ECG image, and saves to a .jpg file.
 
         :param None:
@@ -167,15 +287,15 @@ def main_window():
         :returns: None
         """
         mrn = mrn_value.get()
-        patient_latest = mc.load_patient_latest(mrn)
-        cur_ecg_img = patient_latest['latest_ecg']
-        # print(cur_ecg_img)
-        save_image(cur_ecg_img, f"Patient_{mrn}_current_ecg.jpg")
+        runner.submit(download_latest_ecg,
+                      lambda image: save_image(
+                          image, f"Patient_{mrn}_current_ecg.jpg"),
+                      mrn)
 
     def save_hist_ecg():
         """Save historical ECG image to file
 
-        Download base64 image data from server, for
+        Download the image data from server, for
         selected historical ECG image, and saves
         to a .jpg file.
 
@@ -185,15 +305,15 @@ def main_window():
         """
         timestamp = ecg_dropdown.get()
         mrn = mrn_value.get()
-        old_ecg = mc.load_ecg_by_timestamp(mrn, timestamp)
-        save_image(old_ecg,
-                   f"Patient_{mrn}_ECG_{timestamp}.jpg".replace(
-                       ":", "_"))
+        filename = f"Patient_{mrn}_ECG_{timestamp}.jpg".replace(":", "_")
+        runner.submit(mc.load_ecg_image,
+                      lambda image: save_image(image, filename),
+                      mrn, timestamp)
 
     def save_medical_img():
         """Save current medical image to file
 
-        Download base64 image data from server for
+        Download the image data from server for
         current medical image, and saves to a .jpg file.
 
         :param None:
@@ -202,15 +322,17 @@ def main_window():
         """
         med_img_id = int(med_image_dropdown.get())
         mrn = mrn_value.get()
-        med_img = mc.load_img_by_id(mrn, med_img_id)
-
-        save_image(med_img, f"Patient_{mrn}_Medical_Image_{med_img_id}.jpg")
+        filename = f"Patient_{mrn}_Medical_Image_{med_img_id}.jpg"
+        runner.submit(mc.load_medical_image,
+                      lambda image: save_image(image, filename),
+                      mrn, med_img_id)
 
     def compare_ecg_cmd():
         """Load a historical ECG image side-by-side current
 
         Loads the selected historical ECG image (in the dropdown)
-        alongside the existing, current ECG image, for user comparison.
+        in the background, and shows it alongside the existing,
+        current ECG image, for user comparison.
 
         :param None:
 
@@ -218,18 +340,17 @@ def main_window():
         """
         timestamp = ecg_dropdown.get()
         if timestamp != '':
-            old_ecg = mc.load_ecg_by_timestamp(mrn_value.get(), timestamp)
-            historical_data = mc.convert_b64_string_to_ndarray(old_ecg)
-            historical_img = load_img_data(historical_data)
-            ecg_historical.image = historical_img
-            ecg_historical.configure(image=historical_img)
-            save_ecg_btn2.state(['!disabled'])
+            mrn = mrn_value.get()
+            runner.submit(mc.load_ecg_thumbnail,
+                          lambda img: show_image(img, mrn, ecg_historical,
+                                                 save_ecg_btn2),
+                          mrn, timestamp)
 
     def load_medical_image():
         """Load the selected medical image
 
-        Loads the selected medical image from the database, and
-        displays it in the UI.
+        Loads the selected medical image from the database in the
+        background, and displays it in the UI.
 
         :param None:
 
@@ -237,13 +358,28 @@ def main_window():
         """
         med_img_id = med_image_dropdown.get()
         if med_img_id != '':
-            med_img_id = int(med_img_id)
-            med_img_enc = mc.load_img_by_id(int(mrn_value.get()), med_img_id)
-            med_img_data = mc.convert_b64_string_to_ndarray(med_img_enc)
-            med_img = load_img_data(med_img_data)
-            med_img_label.image = med_img
-            med_img_label.configure(image=med_img)
-            save_med_img_btn.state(['!disabled'])
+            mrn = mrn_value.get()
+            runner.submit(mc.load_medical_thumbnail,
+                          lambda img: show_image(img, mrn, med_img_label,
+                                                 save_med_img_btn),
+                          int(mrn), int(med_img_id))
+
+    def show_image(img, mrn, label, save_btn):
+        """Show a downloaded image if its patient is still selected
+
+        :param img: PIL Image, see mc.decode_thumbnail
+        :param mrn: str, MRN of the patient the image belongs to
+        :param label: ttk.Label to show the image in
+        :param save_btn: ttk.Button that saves the image
+
+        :returns: None
+        """
+        if mrn != mrn_value.get():
+            return
+        photo = ImageTk.PhotoImage(img)
+        label.image = photo
+        label.configure(image=photo)
+        save_btn.state(['!disabled'])
 
     root = tk.Tk()
     root.title('Monitor GUI client')
@@ -258,9 +394,7 @@ def main_window():
     ttk.Label(mainframe,
               text="Available Medical Records",
               font=myfont).grid(column=0, row=0)
-    mrn_dropdown = ttk.Combobox(mainframe,
-                                state='readonly',
-                                values=mc.load_all_patients())
+    mrn_dropdown = ttk.Combobox(mainframe, state='readonly')
     mrn_dropdown.grid(column=1, row=0)
 
     load_btn = ttk.Button(mainframe, text="Load Patient",
@@ -349,8 +483,14 @@ def main_window():
     med_img_load_btn.state(['disabled'])
     ecg_compare_button.state(['disabled'])
 
-    root.after(5000, refresh_data)
+    runner = TaskRunner()
+    runner.submit(mc.load_all_patients, show_patient_list)
+    updates = queue.Queue()
+    stop_updates = mc.subscribe_updates(updates)
+    root.after(100, check_updates)
     root.mainloop()
+    stop_updates.set()
+    runner.shutdown()
     return
 
 
@@ -7,6 +7,7 @@ from skimage.io import imsave
 import pdb
 from PIL import Image, ImageTk
 import numpy as np
+from HttpClient import session
 
 server_address = 'http://vcm-17598.vm.duke.edu:5000'
 
@@ -20,17 +21,17 @@ def upload_patient_info(patient_name, mrn, heart_rate, med_img, ecg_img):
     :param patient_name: patient name
     :param mrn: patient medical record number
     :param heart_rate: patient heart rate from ecg trace
-    :param med_img: PIL image of medical image from the GUI
-    :param ecg_img: PIL image of ecg image from the GUI
+    :param med_img: bytes of the medical image file, or a PIL image
+    :param ecg_img: bytes of the ecg image file, or a PIL image
 
     :returns: server status code
     """
     if(med_img is not None):
-        med_img_b64_string = convert_ndarray_to_b64_string(np.array(med_img))
+        med_img_b64_string = convert_image_to_b64_string(med_img)
     else:
         med_img_b64_string = ''
     if(ecg_img is not None):
-        ecg_img_b64_string = convert_ndarray_to_b64_string(np.array(ecg_img))
+        ecg_img_b64_string = convert_image_to_b64_string(ecg_img)
     else:
         ecg_img_b64_string = ''
     new_patient_info = {"patient_name": patient_name, "mrn": mrn,
@@ -38,11 +39,67 @@ def upload_patient_info(patient_name, mrn, heart_rate, med_img, ecg_img):
                         "ecg_image": ecg_img_b64_string,
                         "heart_rate": heart_rate, }
 
-    r = requests.post(server_address+"/new_patient_info",
-                      json=new_patient_info)
+    r = session.post(server_address+"/new_patient_info",
+                     json=new_patient_info)
     return r.status_code
 
 
+def upload_patient_files(patient_name, mrn, heart_rate, med_img, ecg_img):
+    """Post request to server to upload the patient information as files
+
+    Sends the same information as upload_patient_info as
+    multipart/form-data to /new_patient_files, with the images as
+    file bytes instead of base64 strings in JSON. Image file bytes are
+    sent as they are, without decoding and encoding them again; the
+    server tells their type from their first bytes.
+
+    :param patient_name: patient name
+    :param mrn: patient medical record number
+    :param heart_rate: patient heart rate from ecg trace
+    :param med_img: bytes of the medical image file, or a PIL image
+    :param ecg_img: bytes of the ecg image file, or a PIL image
+
+    :returns: server status code
+    """
+    data = {"patient_name": patient_name, "mrn": mrn,
+            "heart_rate": heart_rate}
+    files = {}
+    for kind, img in [("medical_image", med_img), ("ecg_image", ecg_img)]:
+        if isinstance(img, bytes):
+            files[kind] = (kind + ".jpg", img, "application/octet-stream")
+        elif img is not None:
+            files[kind] = (kind + ".jpg", convert_image_to_jpeg_bytes(img),
+                           "image/jpeg")
+    r = session.post(server_address+"/new_patient_files", data=data,
+                     files=files)
+    return r.status_code
+
+
+def convert_image_to_jpeg_bytes(img):
+    """Encode a PIL image as JPEG bytes
+
+    :param img: PIL image
+
+    :returns: bytes of the JPEG file
+    """
+    f = io.BytesIO()
+    img.convert("RGB").save(f, format="JPEG", quality=90)
+    return f.getvalue()
+
+
+def convert_image_to_b64_string(img):
+    """Convert an image to a base64 string for upload_patient_info
+
+    :param img: bytes of an image file, sent as they are, or a PIL
+                image, encoded as JPEG
+
+    :returns: base64 string of the image file
+    """
+    if not isinstance(img, bytes):
+        img = convert_image_to_jpeg_bytes(img)
+    return base64.b64encode(img).decode()
+
+
 def convert_ndarray_to_b64_string(img_ndarray):
     """Convert ndarray to base64 string
 
@@ -66,7 +123,7 @@ if __name__ == '__main__':
                    "ecg_image": 'abc',
                    "heart_rate": '72.0', }
 
-    r = requests.post(
+    r = session.post(
         server_address+"/new_patient_info", json=new_patient)
     print(r.status_code)
     print(r.text)
@@ -76,7 +133,7 @@ if __name__ == '__main__':
                    "ecg_image": 'abc',
                    "heart_rate": 70}
 
-    r = requests.post(
+    r = session.post(
         server_address+"/new_patient_info", json=new_patient)
     print(r.status_code)
     print(r.text)
@@ -86,7 +143,7 @@ if __name__ == '__main__':
                    "ecg_image": 'abc',
                    "heart_rate": 70}
 
-    r = requests.post(
+    r = session.post(
         server_address+"/new_patient_info", json=new_patient)
     print(r.status_code)
     print(r.text)
@@ -96,7 +153,7 @@ if __name__ == '__main__':
                    "ecg_image": '',
                    "heart_rate": ''}
 
-    r = requests.post(
+    r = session.post(
         server_address+"/new_patient_info", json=new_patient)
     print(r.status_code)
     print(r.text)
@@ -5,11 +5,13 @@ from flask import request
 import pdb
 from PIL import Image, ImageTk
 import base64
-from ecg_analysis import analyze
-from patient_client import upload_patient_info
+import io
+from ecg_analysis import analyze_buffer
+from patient_client import upload_patient_files
+from monitor_client import decode_thumbnail
 
-ecg_pil_image = None
-med_pil_image = None
+ecg_image_bytes = None
+med_image_bytes = None
 
 
 def design_window():
@@ -36,21 +38,23 @@ def design_window():
         """Command to select medical image file and display on GUI
 
         User selects image file from dialog box and the image is
-        resized and displayed on the GUI. File must be in .jpg format
+        resized and displayed on the GUI. File must be in .jpg format.
+        The file bytes are kept as they are for the upload.
 
         :param None:
 
         :returns: None
         """
-        global med_pil_image
+        global med_image_bytes
         newsize = (200, 200)
         med_img_filename = filedialog.askopenfilename(
             filetypes=[("jpeg files", "*.jpg")])
         if med_img_filename == "":
             return
-        med_pil_image = Image.open(med_img_filename)
-        pil_image_resize = med_pil_image.resize(newsize)
-        tk_image = ImageTk.PhotoImage(pil_image_resize)
+        with open(med_img_filename, 'rb') as med_img_file:
+            med_image_bytes = med_img_file.read()
+        tk_image = ImageTk.PhotoImage(decode_thumbnail(med_image_bytes,
+                                                       newsize))
         med_img_label.image = tk_image
         med_img_label.configure(image=tk_image)
 
@@ -65,16 +69,18 @@ def design_window():
 
         :returns: None
         """
-        global ecg_pil_image
+        global ecg_image_bytes
         newsize = (300, 200)
         ecg_filename = filedialog.askopenfilename(
             filetypes=[("csv files", "*.csv")])
         if ecg_filename == "":
             return
-        heart_rate.set(analyze(ecg_filename))
-        ecg_pil_image = Image.open('images/ecg.jpg')
-        pil_image_resize = ecg_pil_image.resize(newsize)
-        tk_image = ImageTk.PhotoImage(pil_image_resize)
+        with open(ecg_filename, 'rb') as ecg_file:
+            metrics, image = analyze_buffer(ecg_file.read(),
+                                            name=ecg_filename, quiet=False)
+        heart_rate.set(int(metrics["mean_hr_bpm"]))
+        ecg_image_bytes = image
+        tk_image = ImageTk.PhotoImage(decode_thumbnail(image, newsize))
         ecg_img_label.image = tk_image
         ecg_img_label.configure(image=tk_image)
 
@@ -91,8 +97,9 @@ def design_window():
         if mrn.get() == "":
             return
         # pdb.set_trace()
-        upload_patient_info(patient_name.get(), mrn.get(),
-                            heart_rate.get(), med_pil_image, ecg_pil_image)
+        upload_patient_files(patient_name.get(), mrn.get(),
+                             heart_rate.get(), med_image_bytes,
+                             ecg_image_bytes)
 
     def clear_cmd():
         """Clears all entries in the GUI
@@ -103,11 +110,11 @@ def design_window():
 
         :returns: None
         """
-        global med_pil_image
-        global ecg_pil_image
+        global med_image_bytes
+        global ecg_image_bytes
 
-        med_pil_image = None
-        ecg_pil_image = None
+        med_image_bytes = None
+        ecg_image_bytes = None
         patient_name.set("")
         mrn.set("")
         ecg_img_label.image = ''
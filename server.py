@@ -1,19 +1,32 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, Response
 import logging
 from pymodm import connect, MongoModel, fields
 import pymodm
 from pymodm import errors as pymodm_errors
 from Patient import Patient
+from ImageBlob import ImageBlob
+from ResponseCache import ResponseCache
+from UpdateBroker import UpdateBroker
 from helpers import validate_post_input, validate_mrn
 from helpers import get_last_ecg, get_last_hr, get_patient_name
 from helpers import get_patient_timestamp
 from helpers import get_ecg_timestamps, get_ecg_by_timestamp
 from helpers import get_medical_image_by_index
+from image_store import put_image, load_image, load_ecg_by_timestamp
+from image_store import put_image_stream, get_blob, find_ecg_blob
+from image_store import iter_blob, encode_image, get_image_blob
+from image_store import find_variant, served_content_type, VARIANT_SIZES
+from image_store import stored_ecg_timestamps, put_images, delete_blobs
 import json
 import requests
 import base64
 import io
 import datetime
+import hashlib
+import queue
+import zlib
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
 import matplotlib.image as mpimg
 from matplotlib import pyplot as plt
 from skimage.io import imsave
@@ -21,6 +34,22 @@ import pdb
 import os
 
 app = Flask(__name__)
+response_cache = ResponseCache()
+update_broker = UpdateBroker()
+
+MAX_BULK_RECORDS = 1000
+
+MAX_REQUEST_BYTES = 64 * 1024 * 1024
+
+CONDITIONAL_ENDPOINTS = {"get_name_and_latest_for_pt", "get_patient_ecg_times",
+                         "get_all_images", "get_patient_snapshot"}
+
+LATEST_PROJECTION = {
+    "patient_name": 1,
+    "heart_rate": {"$slice": -1},
+    "ecg_image": {"$slice": -1},
+    "entry_time": {"$slice": -1},
+}
 
 
 def init_db():
@@ -40,6 +69,44 @@ def init_db():
     print("Connected")
 
 
+def gunzip_request_body(wsgi_app):
+    """Wrap the WSGI app to accept gzip compressed request bodies
+
+    Clients send large JSON uploads with Content-Encoding: gzip (see
+    HttpClient). The body is decompressed before Flask reads it, so
+    the routes see plain JSON. A body that is not valid gzip, or that
+    decompresses to more than MAX_REQUEST_BYTES, gets 400 Bad Request.
+
+    :param wsgi_app: WSGI application to wrap
+
+    :returns: WSGI application
+    """
+    def app_with_gunzip(environ, start_response):
+        if environ.get("HTTP_CONTENT_ENCODING", "").lower() != "gzip":
+            return wsgi_app(environ, start_response)
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        body = environ["wsgi.input"].read(length)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            data = decompressor.decompress(body, MAX_REQUEST_BYTES)
+            valid = decompressor.eof and not decompressor.unconsumed_tail
+        except zlib.error:
+            valid = False
+        if not valid:
+            start_response("400 BAD REQUEST",
+                           [("Content-Type", "text/plain")])
+            return [b"Request body is not valid gzip or is too large"]
+        environ = dict(environ)
+        del environ["HTTP_CONTENT_ENCODING"]
+        environ["wsgi.input"] = io.BytesIO(data)
+        environ["CONTENT_LENGTH"] = str(len(data))
+        return wsgi_app(environ, start_response)
+    return app_with_gunzip
+
+
+app.wsgi_app = gunzip_request_body(app.wsgi_app)
+
+
 @app.route("/new_patient_info", methods=["POST"])
 def post_new_patient_info():
     """Server post request for adding new patient information to the patient
@@ -66,7 +133,7 @@ def process_patient_info(in_data):
 
     Processes the new patient in_data by first validating. If validation passes
     the patient is added to the mongodb database by calling
-    add_patient_to_database. Adds logging if added succesfully
+    upsert_patient_info. Adds logging if added succesfully
 
     :param in_data: dict of the input data from the post request
     /api/new_patient_info
@@ -76,11 +143,199 @@ def process_patient_info(in_data):
     validate_input, server_status = validate_patient_info(in_data)
     if validate_input is not True:
         return validate_input, server_status
-    patient = find_patient_in_db(int(in_data['mrn']))
-    if patient is False:
-        patient = add_new_patient_to_database(int(in_data['mrn']))
-    patient = add_patient_info_to_database(patient, in_data)
-    return "Patient information successfully added", 200
+    return upsert_patient_info(int(in_data['mrn']), in_data)
+
+
+@app.route("/new_patient_info/bulk", methods=["POST"])
+def post_bulk_patient_info():
+    """Server post request for adding many patient records at once
+
+    Accepts a JSON list of records in the /new_patient_info format,
+    such as the readings a bedside gateway queued while offline.
+    Every record is validated on its own and the valid ones are
+    written with one bulk database operation, in list order.
+
+    :param: None
+
+    :returns: JSON with a status per record, server status
+    """
+    in_data = request.get_json()
+    return process_bulk_patient_info(in_data)
+
+
+def process_bulk_patient_info(records):
+    """Validate and write a list of patient records
+
+    Each record gets its own entry time, so that every ECG image of a
+    batch can be fetched back by its timestamp: the record's optional
+    `timestamp` (acquisition time, "YYYY-MM-DD HH:MM:SS" with optional
+    microseconds), else the current time to the microsecond, kept
+    increasing within the batch. A record whose patient already has an
+    ECG image stored at its timestamp, by an earlier request or earlier
+    in the batch, is not written again but reported as 409, so a
+    gateway can safely send its queue again after reconnecting.
+
+    The images of all the records are stored together, see put_images,
+    then the patient updates are sent in one bulk write. The images of
+    records whose update fails are deleted again.
+
+    :param records: list of dicts of the input data, each as for
+                    /api/new_patient_info, with an optional `timestamp`
+
+    :returns: dict with entries:
+            `results`: list of dicts with the `index`, `status` and
+                       `message` of each record
+            `written`: number of records written
+            `failed`: number of records not written
+             and the server status
+             OR error message and failure code
+    """
+    if type(records) is not list:
+        return "Expected a list of patient records", 400
+    if len(records) > MAX_BULK_RECORDS:
+        return "At most {} records per request".format(
+            MAX_BULK_RECORDS), 413
+    results = [None] * len(records)
+    accepted = []
+    last = None
+    for i, record in enumerate(records):
+        if type(record) is not dict:
+            results[i] = ("Record is not an object", 400)
+            continue
+        validate_input, server_status = validate_patient_info(record)
+        if validate_input is not True:
+            results[i] = (validate_input, server_status)
+            continue
+        timestamp = record.get("timestamp")
+        if timestamp is None:
+            now = datetime.datetime.now()
+            if last is not None and now <= last:
+                now = last + datetime.timedelta(microseconds=1)
+            last = now
+            timestamp = str(now)
+        elif not valid_timestamp(timestamp):
+            results[i] = ("timestamp is not valid", 400)
+            continue
+        accepted.append((i, int(record['mrn']), record, timestamp))
+    used = stored_ecg_timestamps([(mrn, timestamp)
+                                  for i, mrn, record, timestamp in accepted
+                                  if record['ecg_image'] != ''])
+    writes = []
+    images = []
+    for i, mrn, record, timestamp in accepted:
+        if (mrn, timestamp) in used:
+            results[i] = ("Already stored for this patient at this "
+                          "timestamp", 409)
+            continue
+        used.add((mrn, timestamp))
+        writes.append((i, mrn, record, timestamp))
+        for kind in ["medical_image", "ecg_image"]:
+            if record[kind] != '':
+                images.append((mrn, kind, record[kind], timestamp
+                               if kind == "ecg_image" else None))
+    try:
+        refs = iter(put_images(images))
+    except PyMongoError as e:
+        logging.error("Storing bulk images failed: {}".format(e))
+        for i, mrn, record, timestamp in writes:
+            results[i] = ("Database error: {}".format(e), 500)
+        writes = []
+    updates = []
+    stored = []
+    for i, mrn, record, timestamp in writes:
+        ref = {kind: next(refs) if record[kind] != '' else None
+               for kind in ["medical_image", "ecg_image"]}
+        updates.append(patient_update(mrn, record['patient_name'],
+                                      record['heart_rate'],
+                                      ref["medical_image"],
+                                      ref["ecg_image"], timestamp))
+        stored.append([value for value in ref.values() if value is not None])
+    failed = []
+    for (i, mrn, record, timestamp), refs, result in zip(
+            writes, stored, write_patient_updates(updates)):
+        results[i] = result
+        if result[1] != 200:
+            failed.extend(refs)
+    delete_blobs(failed)
+    written = sum(status == 200 for message, status in results)
+    return {
+        "results": [{"index": i, "status": status, "message": message}
+                    for i, (message, status) in enumerate(results)],
+        "written": written,
+        "failed": len(records) - written,
+    }, 200
+
+
+def valid_timestamp(timestamp):
+    """Check the format of a client supplied entry timestamp
+
+    :param timestamp: str such as "2020-11-20 10:15:00"
+    :returns: True if it is a "YYYY-MM-DD HH:MM:SS" time, with optional
+              microseconds
+    """
+    if type(timestamp) is not str:
+        return False
+    for fmt in ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M:%S.%f"]:
+        try:
+            datetime.datetime.strptime(timestamp, fmt)
+            return True
+        except ValueError:
+            pass
+    return False
+
+
+@app.route("/new_patient_files", methods=["POST"])
+def post_new_patient_files():
+    """Server post request for adding patient information with image files
+
+    Same as /new_patient_info, but sent as multipart/form-data: the
+    mrn, patient_name and heart_rate are form fields and the
+    medical_image and ecg_image are binary file parts (JPEG bytes),
+    all optional except the mrn. The images are streamed into the blob
+    store a chunk at a time, without base64 or JSON. Empty file parts,
+    sent by a browser form with no file chosen, are ignored. The media
+    type of each image is found from its first bytes; the type the
+    client sent with the part is not trusted.
+
+    :param: None
+
+    :returns: message after posting new patient information, server status
+    """
+    in_data = {"patient_name": request.form.get("patient_name", ""),
+               "mrn": request.form.get("mrn", ""),
+               "heart_rate": request.form.get("heart_rate", ""),
+               "medical_image": "", "ecg_image": ""}
+    validate_input, server_status = validate_patient_info(in_data)
+    if validate_input is not True:
+        return validate_input, server_status
+    mrn = int(in_data['mrn'])
+    timestamp = str(datetime.datetime.now()).split('.')[0]
+    refs = {}
+    for kind in ["medical_image", "ecg_image"]:
+        image_file = request.files.get(kind)
+        if not has_file_data(image_file):
+            refs[kind] = None
+            continue
+        refs[kind] = put_image_stream(
+            mrn, kind, image_file.stream,
+            timestamp if kind == "ecg_image" else None)
+    return push_patient_info(mrn, in_data['patient_name'],
+                             in_data['heart_rate'], refs["medical_image"],
+                             refs["ecg_image"], timestamp)
+
+
+def has_file_data(image_file):
+    """Check that an uploaded file part holds a file
+
+    :param image_file: werkzeug FileStorage of the part, or None
+    :returns: False if the part is missing, has no filename or no data
+    """
+    if image_file is None or not image_file.filename:
+        return False
+    if not image_file.stream.read(1):
+        return False
+    image_file.stream.seek(0)
+    return True
 
 
 def validate_patient_info(in_data):
@@ -113,23 +368,49 @@ def validate_patient_info(in_data):
     return True, 200
 
 
-def find_patient_in_db(mrn):
+def find_patient_in_db(mrn, projection=None):
     """Find the patient in the database or return False
 
     Finds the patient in the database by the mrn. If the patient
-    does not exist, return False
+    does not exist, return False. With a projection, only the fields
+    it names are fetched and the rest of the patient is left empty
 
     :param mrn: medical record number of the patient in integer format
+    :param projection: dict, MongoDB projection of the fields to fetch,
+                       None for the whole patient
 
     :returns: patient object
     """
+    query = Patient.objects.raw({"_id": mrn})
+    if projection is not None:
+        query = query.project(projection)
     try:
-        db_item = Patient.objects.raw({"_id": mrn}).first()
+        db_item = query.first()
     except pymodm_errors.DoesNotExist:
         return False
     return db_item
 
 
+def count_patient_images(mrn, kind):
+    """Count the images of a patient without fetching them
+
+    Gets the length of the image list from a MongoDB aggregation, so
+    no image reference leaves the database
+
+    :param mrn: medical record number of the patient in integer format
+    :param kind: str, "medical_image" or "ecg_image"
+
+    :returns: int, number of images, None if the patient is not found
+    """
+    pipeline = [
+        {"$match": {"_id": mrn}},
+        {"$project": {"count": {"$size": {"$ifNull": ["$" + kind, []]}}}},
+    ]
+    for result in Patient._mongometa.collection.aggregate(pipeline):
+        return result["count"]
+    return None
+
+
 def add_new_patient_to_database(mrn):
     """Adds the new patient to the database by primary key mrn
 
@@ -141,6 +422,10 @@ def add_new_patient_to_database(mrn):
     """
     new_patient = Patient(mrn=mrn)
     saved_patient = new_patient.save()
+    response_cache.invalidate(mrn)
+    response_cache.invalidate()
+    update_broker.publish({"type": "patient", "mrn": mrn, "new": True,
+                           "entry_time": None})
     logging.info("Added patient {}".format(mrn))
     return saved_patient
 
@@ -148,7 +433,8 @@ def add_new_patient_to_database(mrn):
 def add_patient_info_to_database(patient, in_data):
     """Adds the new patient info to the database
 
-    Adds the new patient information to the MongoDB database. If the entry
+    Adds the new patient information to the MongoDB database with
+    upsert_patient_info and fetches the updated patient. If the entry
     is empty (GUI client did not provide any valid information), the
     information will not be added
 
@@ -158,18 +444,282 @@ def add_patient_info_to_database(patient, in_data):
 
     :returns: Updated patient
     """
-    timestamp = str(datetime.datetime.now()).split('.')[0]
-    if in_data['patient_name'] is not '' and patient.patient_name is None:
-        patient.patient_name = in_data['patient_name']
-    if in_data['medical_image'] is not '':
-        patient.medical_image.append(in_data['medical_image'])
-    if in_data['ecg_image'] is not '':
-        patient.ecg_image.append(in_data['ecg_image'])
-        patient.entry_time.append(timestamp)
-    if in_data['heart_rate'] is not '':
-        patient.heart_rate.append(int(in_data['heart_rate']))
-    updated_patient = patient.save()
-    return updated_patient
+    upsert_patient_info(patient.mrn, in_data)
+    return find_patient_in_db(patient.mrn)
+
+
+def upsert_patient_info(mrn, in_data):
+    """Adds the patient info to the database in one atomic update
+
+    Pushes the new heart rate, ECG image reference with its timestamp
+    and medical image reference onto the patient's lists with a single
+    upsert, which creates the patient if needed. Uploads for the same
+    patient that arrive at once are all kept, since nothing is read
+    and written back. Images go to the blob store first and the
+    patient keeps a reference to each. The name is only set if the
+    patient has none yet, by a second update guarded on that and sent
+    in the same bulk write. See patient_update
+
+    :param mrn: int, medical record number of the patient
+    :param in_data: dict of the input data from the post request
+    /api/new_patient_info
+
+    :returns: message after writing, server status
+    """
+    return write_patient_updates([stored_patient_update(mrn, in_data)])[0]
+
+
+def stored_patient_update(mrn, in_data, timestamp=None):
+    """Store the images of an upload and build its patient update
+
+    :param mrn: int, medical record number of the patient
+    :param in_data: dict of validated input data, as for
+                    /api/new_patient_info
+    :param timestamp: str, upload timestamp, now if not given
+
+    :returns: dict from patient_update
+    """
+    if timestamp is None:
+        timestamp = str(datetime.datetime.now()).split('.')[0]
+    medical_image = ecg_image = None
+    if in_data['medical_image'] != '':
+        medical_image = put_image(mrn, "medical_image",
+                                  in_data['medical_image'])
+    if in_data['ecg_image'] != '':
+        ecg_image = put_image(mrn, "ecg_image", in_data['ecg_image'],
+                              timestamp)
+    return patient_update(mrn, in_data['patient_name'],
+                          in_data['heart_rate'], medical_image, ecg_image,
+                          timestamp)
+
+
+def push_patient_info(mrn, patient_name, heart_rate, medical_image,
+                      ecg_image, timestamp):
+    """Append stored images and a heart rate to a patient atomically
+
+    One upsert pushes the values onto the patient's lists, and a
+    second update sets the name if the patient has none yet, sent
+    together by write_patient_updates
+
+    :param mrn: int, medical record number of the patient
+    :param patient_name: str, patient name, '' for none
+    :param heart_rate: int, str heart rate, '' for none
+    :param medical_image: ObjectId of a stored medical image, or None
+    :param ecg_image: ObjectId of a stored ECG image, or None
+    :param timestamp: str, upload timestamp of the ECG image
+
+    :returns: message after writing, server status
+    """
+    update = patient_update(mrn, patient_name, heart_rate, medical_image,
+                            ecg_image, timestamp)
+    return write_patient_updates([update])[0]
+
+
+def patient_update(mrn, patient_name, heart_rate, medical_image, ecg_image,
+                   timestamp):
+    """Build the database operations that add info to a patient
+
+    The first operation is an upsert that pushes the values onto the
+    patient's lists, creating the patient if needed. If a name is
+    given, a second operation sets it only if the patient has none
+    yet. Each operation bumps the patient's version and last_modified
+    time. Nothing is read, so concurrent uploads are all kept.
+
+    :param mrn: int, medical record number of the patient
+    :param patient_name: str, patient name, '' for none
+    :param heart_rate: int, str heart rate, '' for none
+    :param medical_image: ObjectId of a stored medical image, or None
+    :param ecg_image: ObjectId of a stored ECG image, or None
+    :param timestamp: str, upload timestamp of the ECG image
+
+    :returns: dict with entries:
+            `mrn`: medical record number
+            `ops`: list of pymongo UpdateOne
+            `entry_time`: ECG timestamp, None if no ECG image
+    """
+    push = {}
+    if medical_image is not None:
+        push["medical_image"] = medical_image
+    if ecg_image is not None:
+        push["ecg_image"] = ecg_image
+        push["entry_time"] = timestamp
+    if heart_rate != '':
+        push["heart_rate"] = int(heart_rate)
+    now = datetime.datetime.now(datetime.timezone.utc).replace(
+        microsecond=0, tzinfo=None)
+    update = {"$setOnInsert": {"_cls": Patient._mongometa.object_name},
+              "$set": {"last_modified": now},
+              "$inc": {"version": 1}}
+    if push:
+        update["$push"] = push
+    ops = [UpdateOne({"_id": mrn}, update, upsert=True)]
+    if patient_name != '':
+        ops.append(UpdateOne({"_id": mrn, "patient_name": None},
+                             {"$set": {"patient_name": patient_name,
+                                       "last_modified": now},
+                              "$inc": {"version": 1}}))
+    return {"mrn": mrn, "ops": ops, "entry_time": push.get("entry_time")}
+
+
+def write_patient_updates(updates):
+    """Write patient updates with one ordered bulk operation
+
+    Sends the operations of every update in one bulk_write, in order,
+    so several updates of the same patient apply in the order given.
+    If the database rejects an operation, that update and the ones
+    after it are reported as failed. The cached responses of each
+    written patient are dropped afterwards and the /events subscribers
+    are notified
+
+    :param updates: list of dicts from patient_update
+
+    :returns: list of (message, server status), one per update
+    """
+    ops = []
+    owners = []
+    if not updates:
+        return []
+    for i, update in enumerate(updates):
+        ops.extend(update["ops"])
+        owners.extend([i] * len(update["ops"]))
+    results = [("Patient information successfully added", 200)] * \
+        len(updates)
+    try:
+        upserted = Patient._mongometa.collection.bulk_write(
+            ops, ordered=True).upserted_ids
+    except BulkWriteError as e:
+        upserted = {item["index"]: item["_id"]
+                    for item in e.details.get("upserted", [])}
+        error = e.details["writeErrors"][0]
+        failed = owners[error["index"]]
+        logging.error("Patient update failed: {}".format(error["errmsg"]))
+        results[failed] = ("Database error: {}".format(error["errmsg"]),
+                           500)
+        for i in range(failed + 1, len(updates)):
+            results[i] = ("Not written after an earlier database error",
+                          500)
+    new = {owners[index] for index in upserted}
+    for i, update in enumerate(updates):
+        if results[i][1] != 200:
+            continue
+        response_cache.invalidate(update["mrn"])
+        if i in new:
+            logging.info("Added patient {}".format(update["mrn"]))
+        update_broker.publish({"type": "patient", "mrn": update["mrn"],
+                               "new": i in new,
+                               "entry_time": update["entry_time"]})
+    if new:
+        response_cache.invalidate()
+    return results
+
+
+def process_get_patient_version(mrn):
+    """Compute the validators of a patient for conditional GETs
+
+    Reads the version counter, last modified time, name, list lengths
+    and latest entry time of the patient with an aggregation, without
+    any image, and hashes them into an ETag. The lengths and entry
+    time also cover records written before the version counter.
+
+    :param mrn: int, medical record number
+    :returns: (str ETag, datetime last modified or None), server status
+             OR error message and failure code
+    """
+    pipeline = [
+        {"$match": {"_id": mrn}},
+        {"$project": {
+            "version": {"$ifNull": ["$version", 0]},
+            "last_modified": "$last_modified",
+            "patient_name": "$patient_name",
+            "heart_rate": {"$size": {"$ifNull": ["$heart_rate", []]}},
+            "ecg_image": {"$size": {"$ifNull": ["$ecg_image", []]}},
+            "medical_image": {"$size": {"$ifNull": ["$medical_image",
+                                                    []]}},
+            "entry_time": {"$arrayElemAt": [{"$ifNull": ["$entry_time",
+                                                         []]}, -1]},
+        }},
+    ]
+    for doc in Patient._mongometa.collection.aggregate(pipeline):
+        version = [doc.get(key) for key in
+                   ["_id", "version", "patient_name", "heart_rate",
+                    "ecg_image", "medical_image", "entry_time"]]
+        etag = hashlib.sha1(json.dumps(version).encode()).hexdigest()[:20]
+        return (etag, doc.get("last_modified")), 200
+    return "Patient not found", 400
+
+
+def is_not_modified(etag, last_modified):
+    """Check the request's validators against the patient's
+
+    If-None-Match is used when the request has it, otherwise
+    If-Modified-Since, as in RFC 7232.
+
+    :param etag: str, current ETag of the patient
+    :param last_modified: datetime, UTC time of the last change, or None
+    :returns: bool, True if the client's copy is current
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    if since is None or last_modified is None:
+        return False
+    if since.tzinfo is not None:
+        since = since.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return last_modified <= since
+
+
+def set_validators(response, etag, last_modified):
+    """Add the ETag and Last-Modified headers to a response
+
+    :param response: flask Response
+    :param etag: str, current ETag of the patient
+    :param last_modified: datetime, UTC time of the last change, or None
+    :returns: None
+    """
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+
+
+@app.before_request
+def check_patient_validators():
+    """Answer 304 Not Modified to unchanged conditional patient GETs
+
+    For the routes in CONDITIONAL_ENDPOINTS, looks up the patient's
+    validators (from the response cache) and, if the client's
+    If-None-Match or If-Modified-Since shows its copy is current,
+    replies 304 without running the route.
+
+    :returns: 304 response, or None to run the route
+    """
+    if request.endpoint not in CONDITIONAL_ENDPOINTS:
+        return None
+    mrn = validate_mrn(request.view_args["mrn"])
+    if mrn is False:
+        return None
+    validators, status_code = response_cache.get_or_call(
+        ("version", mrn), process_get_patient_version, mrn)
+    if status_code != 200:
+        return None
+    g.patient_validators = validators
+    if is_not_modified(*validators):
+        response = app.response_class(status=304)
+        set_validators(response, *validators)
+        return response
+    return None
+
+
+@app.after_request
+def add_patient_validators(response):
+    """Add the patient's ETag and Last-Modified to a full response
+
+    :param response: flask Response of the route
+    :returns: the response
+    """
+    validators = g.get("patient_validators")
+    if validators is not None and response.status_code == 200:
+        set_validators(response, *validators)
+    return response
 
 
 @app.route("/mrn_list", methods=["GET"])
@@ -182,7 +732,8 @@ def get_available_mrns():
 
     :returns: jsonified list of valid MRNs contained in database
     """
-    patients = process_get_available_mrns()
+    patients = response_cache.get_or_call(("mrn_list",),
+                                          process_get_available_mrns)
     # print(patients)
     return jsonify(data=patients, code=200)
 
@@ -197,8 +748,8 @@ def process_get_available_mrns():
     :returns: list of valid MRNs contained in database
     """
     patients = []
-    for patient in Patient.objects.raw({}):
-        patients.append(patient.mrn)
+    for patient in Patient._mongometa.collection.find({}, {"_id": 1}):
+        patients.append(patient["_id"])
     return patients
 
 
@@ -216,13 +767,85 @@ def get_name_and_latest_for_pt(mrn):
             `latest_hr`: last recorded patient heart rate
             `latest_ecg`: last uploaded ECG image
     """
-    patient = validate_get_patient_by_mrn(mrn)
-    if type(patient) is str:
-        return patient, 400
+    return cached_route("most_recent", mrn, process_get_latest_for_pt)
+
+
+def process_get_latest_for_pt(mrn):
+    """Fetch the latest data for a patient from the database
+
+    :param mrn: int, medical record number
+    :returns: dict from extract_latest_from_pt, server status
+             OR error message and failure code
+    """
+    patient = find_patient_in_db(mrn, LATEST_PROJECTION)
+    if patient is False:
+        return "Patient not found", 400
     return_info = extract_latest_from_pt(patient)
     return return_info, 200
 
 
+@app.route("/<mrn>/snapshot", methods=["GET"])
+def get_patient_snapshot(mrn):
+    """Route to fetch everything a monitor shows for a patient
+
+    Combines /most_recent, /ecg/timestamps and /images in one request
+    answered from one database read. The latest ECG image itself is
+    not included; it is identified by latest_ecg_id and entry_time so
+    the monitor only downloads it (with /<mrn>/ecg/<timestamp>) when
+    it changed.
+
+    :param mrn: int, str, valid medical record number for a patient
+    :returns: JSON with entries:
+            `name`: patient name
+            `latest_hr`: last recorded patient heart rate
+            `entry_time`: last entry timestamp
+            `latest_ecg_id`: id of the last ECG image in the blob store,
+                             None if none or stored inline
+            `has_ecg`: True if the patient has an ECG image
+            `ecg_timestamps`: list of ECG timestamps
+            `medical_images`: list of medical image ids (indices)
+    """
+    return cached_route("snapshot", mrn, process_get_snapshot)
+
+
+def process_get_snapshot(mrn):
+    """Read the snapshot of a patient with one aggregation
+
+    :param mrn: int, medical record number
+    :returns: dict of the snapshot, server status
+             OR error message and failure code
+    """
+    def last(field):
+        return {"$arrayElemAt": [{"$ifNull": ["$" + field, []]}, -1]}
+
+    pipeline = [
+        {"$match": {"_id": mrn}},
+        {"$project": {
+            "patient_name": "$patient_name",
+            "latest_hr": last("heart_rate"),
+            "latest_ecg": last("ecg_image"),
+            "entry_time": {"$ifNull": ["$entry_time", []]},
+            "medical_images": {"$size": {"$ifNull": ["$medical_image",
+                                                     []]}},
+        }},
+    ]
+    for doc in Patient._mongometa.collection.aggregate(pipeline):
+        latest_ecg = doc.get("latest_ecg")
+        snapshot = {
+            "name": doc.get("patient_name"),
+            "latest_hr": doc.get("latest_hr"),
+            "entry_time": doc["entry_time"][-1] if doc["entry_time"]
+            else None,
+            "latest_ecg_id": None if latest_ecg is None or
+            isinstance(latest_ecg, str) else str(latest_ecg),
+            "has_ecg": latest_ecg is not None,
+            "ecg_timestamps": doc["entry_time"],
+            "medical_images": list(range(doc["medical_images"])),
+        }
+        return snapshot, 200
+    return "Patient not found", 400
+
+
 def extract_latest_from_pt(patient):
     """Accepts a patient object, returns most recent information
 
@@ -237,7 +860,7 @@ def extract_latest_from_pt(patient):
             `entry_time`: last entry timestamp
     """
     patient_hr = get_last_hr(patient)
-    patient_ecg = get_last_ecg(patient)
+    patient_ecg = load_image(get_last_ecg(patient))
     patient_name = get_patient_name(patient)
     patient_timestamp = get_patient_timestamp(patient)
 
@@ -250,7 +873,25 @@ def extract_latest_from_pt(patient):
     return return_info
 
 
-def validate_get_patient_by_mrn(mrn):
+def cached_route(route, mrn, func):
+    """Validate the mrn and serve a route for it from the response cache
+
+    Invalid MRNs are answered without touching the cache. Otherwise
+    the result of func(mrn) is cached under (route, mrn) until it
+    expires or a write to the patient invalidates it.
+
+    :param route: str, name of the route
+    :param mrn: int, str medical record number
+    :param func: function(mrn) returning the result and server status
+    :returns: result, server status
+    """
+    valid_mrn = validate_mrn(mrn)
+    if valid_mrn is False:
+        return "Invalid MRN format", 400
+    return response_cache.get_or_call((route, valid_mrn), func, valid_mrn)
+
+
+def validate_get_patient_by_mrn(mrn, projection=None):
     """Validate supplied mrn, retrieve patient if valid.
 
     Checks if the supplied medical record number is valid,
@@ -259,12 +900,14 @@ def validate_get_patient_by_mrn(mrn):
     error message. Otherwise, returns the patient object.
 
     :param mrn: int, str medical record number
+    :param projection: dict, MongoDB projection of the fields to fetch,
+                       None for the whole patient
     :returns: str, error message or Patient object
     """
     mrn = validate_mrn(mrn)
     if mrn is False:
         return "Invalid MRN format"
-    patient = find_patient_in_db(mrn)
+    patient = find_patient_in_db(mrn, projection)
     if patient is False:
         return "Patient not found"
     return patient
@@ -282,14 +925,42 @@ def get_patient_ecg_times(mrn):
     :returns: JSONified list of timestamps, server code
              OR returns error message and failure code
     """
-    patient = validate_get_patient_by_mrn(mrn)
-    if type(patient) is str:
-        return patient, 400
-    timestamps = get_ecg_timestamps(patient)
+    timestamps, status_code = cached_route("ecg_timestamps", mrn,
+                                           process_get_ecg_times)
+    if status_code != 200:
+        return timestamps, status_code
     return jsonify(timestamps), 200
 
 
-def process_get_ecg_by_timestamp(patient, timestamp):
+def process_get_ecg_times(mrn):
+    """Fetch the ECG timestamps of a patient from the database
+
+    :param mrn: int, medical record number
+    :returns: list of timestamps, server status
+             OR error message and failure code
+    """
+    patient = find_patient_in_db(mrn, {"entry_time": 1})
+    if patient is False:
+        return "Patient not found", 400
+    return get_ecg_timestamps(patient), 200
+
+
+def validate_image_size(size):
+    """Validate the ?size= argument of the image routes
+
+    :param size: str, "thumbnail" or "preview" (see VARIANT_SIZES),
+                 "original" or None for the uploaded image
+    :returns: str name in VARIANT_SIZES, None for the uploaded image,
+              or False if the size is not known
+    """
+    if size is None or size == "original":
+        return None
+    if size in VARIANT_SIZES:
+        return size
+    return False
+
+
+def process_get_ecg_by_timestamp(patient, timestamp, size=None):
     """Return specific ECG image based on selected timestamp.
 
     Accepts validated patient object and a timestamp. Returns
@@ -298,9 +969,10 @@ def process_get_ecg_by_timestamp(patient, timestamp):
 
     :param patient: Patient object (MongoDB entry)
     :param timestamp: str representation of a valid timestamp
+    :param size: str, name in VARIANT_SIZES, None for the uploaded image
     :returns: ECG image corresponding to timestamp, error message if not found
     """
-    ecg = get_ecg_by_timestamp(patient, timestamp)
+    ecg = load_image(get_ecg_by_timestamp(patient, timestamp), size)
     if ecg is not None:
         return ecg, 200
     else:
@@ -312,21 +984,35 @@ def get_ecg_at_timestamp(mrn, timestamp):
     """Return specific ECG image based on selected timestamp.
 
     Validates the MRN and the timestamp, then returns the
-    selected image data corresponding to that timestamp.
+    selected image data corresponding to that timestamp. The image is
+    looked up by (mrn, timestamp) in the blob store; the patient is
+    only loaded for ECG images still stored inline in older records.
+    ?size=thumbnail or ?size=preview returns a smaller copy, see
+    validate_image_size.
 
     :param mrn: int, str medical record number
     :param timestamp: str, timestamp
     :returns: None if no image found, appropriate error message if there
              are errors, or image data corresponding to input
     """
-    patient = validate_get_patient_by_mrn(mrn)
+    size = validate_image_size(request.args.get("size"))
+    if size is False:
+        return "Invalid image size", 400
+    valid_mrn = validate_mrn(mrn)
+    if valid_mrn is not False:
+        ecg = load_ecg_by_timestamp(valid_mrn, timestamp, size)
+        if ecg is not None:
+            return jsonify(result=ecg, code=200)
+    patient = validate_get_patient_by_mrn(mrn, {"entry_time": 1,
+                                                "ecg_image": 1})
     if type(patient) is str:
         return patient, 400
-    result, status_code = process_get_ecg_by_timestamp(patient, timestamp)
+    result, status_code = process_get_ecg_by_timestamp(patient, timestamp,
+                                                       size)
     return jsonify(result=result, code=status_code)
 
 
-def process_get_image_by_id(patient, img_id):
+def process_get_image_by_id(patient, img_id, size=None):
     """Process the validated patient object, return requested image.
 
     Returns a medical image from the patient record by id (index).
@@ -335,10 +1021,11 @@ def process_get_image_by_id(patient, img_id):
 
     :param patient: Patient object (MongoDB entry)
     :param img_id: int, index of medical image requested
+    :param size: str, name in VARIANT_SIZES, None for the uploaded image
     :returns: None if no image found, appropriate error message if there
              are errors, or image data corresponding to input
     """
-    img = get_medical_image_by_index(patient, int(img_id))
+    img = load_image(get_medical_image_by_index(patient, int(img_id)), size)
     if img is not None:
         return img, 200
     else:
@@ -351,16 +1038,21 @@ def get_image_by_id(mrn, img_id):
 
     Return the medical image for a given patient, by 'image id',
     or the index of the image in the patient record for medical images.
+    ?size=thumbnail or ?size=preview returns a smaller copy, see
+    validate_image_size.
 
     :param mrn: int, str medical record number
     :param img_id: int, index of medical image requested
     :returns: None if no image found, appropriate error message if there
              are errors, or image data corresponding to input
     """
-    patient = validate_get_patient_by_mrn(mrn)
+    size = validate_image_size(request.args.get("size"))
+    if size is False:
+        return "Invalid image size", 400
+    patient = validate_get_patient_by_mrn(mrn, {"medical_image": 1})
     if type(patient) is str:
         return patient, 400
-    result, status_code = process_get_image_by_id(patient, img_id)
+    result, status_code = process_get_image_by_id(patient, img_id, size)
     # print(result)
     return jsonify(result=result, code=status_code)
 
@@ -388,17 +1080,189 @@ def get_all_images(mrn):
     """Return all medical images for a patient
 
     Return all medical images for a given patient, or an empty list
-    if none found.
+    if none found. Only the number of images is read from the database
 
     :param mrn: int, str medical record number
     :returns: Empty list if no images found, list of image files
              otherwise
     """
-    patient = validate_get_patient_by_mrn(mrn)
+    result, status_code = cached_route("images", mrn,
+                                       process_get_medical_img_ids)
+    if status_code != 200:
+        return result, status_code
+    return jsonify(result=result, code=200)
+
+
+def process_get_medical_img_ids(mrn):
+    """Fetch the ids of the medical images of a patient
+
+    :param mrn: int, medical record number
+    :returns: list of image ids (indices), server status
+             OR error message and failure code
+    """
+    count = count_patient_images(mrn, "medical_image")
+    if count is None:
+        return "Patient not found", 400
+    return list(range(count)), 200
+
+
+def format_event(event, name=None):
+    """Format a notification as a server-sent event
+
+    :param event: dict, the notification, sent as JSON
+    :param name: str, event name, taken from event["type"] if not given
+    :returns: str of the event in text/event-stream format
+    """
+    name = name or event["type"]
+    return "event: {}\ndata: {}\n\n".format(name, json.dumps(event))
+
+
+def event_stream(mrn=None, keepalive=15.0):
+    """Generate the server-sent events for one /events client
+
+    Subscribes to update_broker when the stream starts and sends a
+    "hello" event, then each patient notification as it arrives, and
+    a comment line after keepalive seconds of silence so proxies keep
+    the connection open. The subscription ends when the client leaves.
+
+    :param mrn: int, only send notifications of this patient, None for
+                all patients
+    :param keepalive: float, seconds between keepalive comments
+    :returns: generator of str
+    """
+    subscriber = update_broker.subscribe()
+    try:
+        yield "retry: 3000\n" + format_event({"type": "hello"})
+        while True:
+            try:
+                event = subscriber.get(timeout=keepalive)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            if mrn is None or event.get("mrn") in (None, mrn):
+                yield format_event(event)
+    finally:
+        update_broker.unsubscribe(subscriber)
+
+
+@app.route("/events", methods=["GET"])
+def get_events():
+    """Stream patient update notifications as server-sent events
+
+    Each stored upload sends a "patient" event with the JSON data
+    {"type": "patient", "mrn": ..., "new": ..., "entry_time": ...},
+    so monitors reload a patient only when it changed. A "resync"
+    event means notifications were dropped and everything should be
+    reloaded. The optional ?mrn= query limits the stream to one
+    patient.
+
+    :returns: text/event-stream response
+    """
+    mrn = request.args.get("mrn")
+    if mrn is not None:
+        mrn = validate_mrn(mrn)
+        if mrn is False:
+            return "Invalid MRN format", 400
+    return Response(event_stream(mrn),
+                    mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache",
+                             "X-Accel-Buffering": "no"})
+
+
+def image_response(ref, size=None):
+    """Stream a stored image as a binary response
+
+    Images in the blob store are sent a chunk at a time with their
+    media type if it is an image type, see served_content_type. Inline
+    images of older records are sent decoded if they are base64, always
+    at their uploaded size. Browsers are told not to sniff the type.
+
+    :param ref: ObjectId, ImageBlob, inline image str, or None
+    :param size: str, name in VARIANT_SIZES, None for the uploaded image
+    :returns: flask Response of the image bytes, or error message and
+             failure code
+    """
+    if ref is None:
+        return "Error finding image", 404
+    if isinstance(ref, str):
+        data, encoding = encode_image(ref)
+        if encoding != "base64":
+            return "Error finding image", 404
+        response = Response(data, mimetype="image/jpeg")
+        response.headers["X-Content-Type-Options"] = "nosniff"
+        return response
+    if not isinstance(ref, ImageBlob):
+        blob = get_image_blob(ref, size)
+    elif size is not None:
+        blob = find_variant(ref.pk, size) or ref
+    else:
+        blob = ref
+    if blob is None:
+        return "Error finding image", 404
+    response = Response(iter_blob(blob),
+                        mimetype=served_content_type(blob.content_type))
+    response.headers["Content-Length"] = str(blob.length)
+    response.headers["X-Content-Type-Options"] = "nosniff"
+    return response
+
+
+@app.route("/<mrn>/ecg/<timestamp>/image", methods=["GET"])
+def get_ecg_image_at_timestamp(mrn, timestamp):
+    """Return the ECG image at a timestamp as binary image data
+
+    Binary counterpart of /<mrn>/ecg/<timestamp>, for clients that do
+    not need base64 in JSON. Takes the same ?size= argument.
+
+    :param mrn: int, str medical record number
+    :param timestamp: str, timestamp
+    :returns: image/jpeg response, or error message and failure code
+    """
+    size = validate_image_size(request.args.get("size"))
+    if size is False:
+        return "Invalid image size", 400
+    mrn = validate_mrn(mrn)
+    if mrn is False:
+        return "Invalid MRN format", 400
+    blob = find_ecg_blob(mrn, timestamp)
+    if blob is not None:
+        return image_response(blob, size)
+    patient = find_patient_in_db(mrn, {"entry_time": 1, "ecg_image": 1})
+    if patient is False:
+        return "Patient not found", 400
+    return image_response(get_ecg_by_timestamp(patient, timestamp), size)
+
+
+@app.route("/<mrn>/images/<img_id>/image", methods=["GET"])
+def get_image_file_by_id(mrn, img_id):
+    """Return a medical image by ID as binary image data
+
+    Binary counterpart of /<mrn>/images/<img_id>, for clients that do
+    not need base64 in JSON. Takes the same ?size= argument.
+
+    :param mrn: int, str medical record number
+    :param img_id: int, index of medical image requested
+    :returns: image/jpeg response, or error message and failure code
+    """
+    size = validate_image_size(request.args.get("size"))
+    if size is False:
+        return "Invalid image size", 400
+    patient = validate_get_patient_by_mrn(mrn, {"medical_image": 1})
     if type(patient) is str:
         return patient, 400
-    result = process_get_all_medical_img(patient)
-    return jsonify(result=result, code=200)
+    try:
+        ref = get_medical_image_by_index(patient, int(img_id))
+    except ValueError:
+        ref = None
+    return image_response(ref, size)
+
+
+@app.route("/cache_stats", methods=["GET"])
+def get_cache_stats():
+    """Return the hit and miss counters of the response cache
+
+    :returns: JSON of ResponseCache.stats
+    """
+    return jsonify(response_cache.stats())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,44 @@
+from BandpassFilter import BandpassFilter, bandpass_sos
+import numpy as np
+from scipy import signal
+import pytest
+
+
+def test_bandpass_sos_cached():
+    sos = bandpass_sos(360, 3, 50)
+    assert bandpass_sos(360, 3, 50) is sos
+    assert bandpass_sos(360, 3, 40) is not sos
+    assert sos.shape == (4, 6)
+
+
+def test_bandpass_sos_below_nyquist():
+    sos = bandpass_sos(60, 5, 50)
+    w, h = signal.sosfreqz(sos, fs=60)
+    assert abs(h[np.argmin(abs(w - 10))]) > 0.9
+
+
+@pytest.mark.parametrize("block_sizes", [
+    [1200],
+    [100] * 12,
+    [1, 7, 500, 2, 690],
+])
+def test_process_blocks_match_one_pass(block_sizes):
+    rng = np.random.default_rng(1)
+    voltage = rng.standard_normal(sum(block_sizes))
+    one_pass = BandpassFilter(360).process(voltage)
+    bandpass = BandpassFilter(360)
+    out = []
+    start = 0
+    for size in block_sizes:
+        out.append(bandpass.process(voltage[start:start + size]))
+        start += size
+    assert np.allclose(np.concatenate(out), one_pass)
+
+
+def test_reset():
+    bandpass = BandpassFilter(360)
+    voltage = np.sin(np.linspace(0, 20, 500))
+    first = bandpass.process(voltage)
+    bandpass.reset()
+    assert bandpass.zi is None
+    assert np.allclose(bandpass.process(voltage), first)
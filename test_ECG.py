@@ -2,6 +2,8 @@ from ECG import ECG
 import numpy as np
 from testfixtures import LogCapture
 import pytest
+import io
+import os
 import matplotlib.pyplot as plt
 
 
@@ -14,6 +16,36 @@ def test_read_csv():
     assert len(voltage) == len(time)
 
 
+def test_parse_csv_lines():
+    from ECG import parse_csv_lines
+    lines = ['0,1', ',1', 'bad data,1', '1,1', 'NaN,1', '2,']
+    time, voltage, n_bad = parse_csv_lines(lines)
+    assert (time == [0, 1]).all()
+    assert (voltage == [1, 1]).all()
+    assert time.dtype == np.float32
+    assert n_bad == 4
+
+
+@pytest.mark.parametrize("filename", [
+    'ecg_data/test_data1.csv',
+    'ecg_data/test_data11.csv',
+    'ecg_data/test_data20.csv',
+    'ecg_data/test_data28.csv',
+    'ecg_data/test_data31.csv',
+])
+def test_load_csv_matches_parse_string(filename):
+    ECG_legacy = ECG(filename, ingest="csv")
+    ECG_legacy.read_csv()
+    with LogCapture() as log_legacy:
+        ECG_legacy.parse_string()
+    ECG_object = ECG(filename)
+    with LogCapture() as log_c:
+        time, voltage = ECG_object.load_csv()
+    assert np.array_equal(time, ECG_legacy.time)
+    assert np.array_equal(voltage, ECG_legacy.voltage)
+    assert len(log_c.records) == len(log_legacy.records)
+
+
 def test_parse_string_return():
     filename = ''
     ECG_object = ECG(filename)
@@ -32,9 +64,9 @@ def test_parse_string_log():
         ECG_object.time = ['1,' '0', 'bad data', '1', 'NaN']
         ECG_object.parse_string()
     log_msg = "Bad or empty entry"
-    log_c.check(("root", "ERROR", log_msg),
-                ("root", "ERROR", log_msg),
-                ("root", "ERROR", log_msg))
+    log_c.check(("ECG.", "ERROR", log_msg),
+                ("ECG.", "ERROR", log_msg),
+                ("ECG.", "ERROR", log_msg))
 
 
 def test_log_if_abnormal_range():
@@ -47,7 +79,7 @@ def test_log_if_abnormal_range():
         ECG_object.parse_string()
         ECG_object.log_if_abnormal_range()
     log_msg = filename + ": Voltage exceeds normal range"
-    log_c.check(("root", "WARNING", log_msg))
+    log_c.check(("ECG.", "WARNING", log_msg))
     with LogCapture() as log_c:
         ECG_object.voltage = ['299', '40']
         ECG_object.time = ['0', '1']
@@ -72,6 +104,73 @@ def test_bandpass_filter():
     assert (ECG_object.bandpass_filter(f, f1, f2) == expected_f).all()
 
 
+def test_bandpass_filter_leaves_input():
+    ECG_object = ECG('', quiet=True)
+    f = np.asarray([0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10])
+    ECG_object.bandpass_filter(f, 3, 7)
+    assert (f == np.arange(11)).all()
+
+
+def legacy_filter(time, voltage, f1=3, f2=50):
+    sampling_rate = len(time)/(np.max(time))
+    signal_fft = np.fft.fftshift(np.fft.fft(voltage))
+    f_max = 2*sampling_rate
+    f = np.linspace(-f_max, f_max, len(time))
+    f[abs(f) < f1] = 0
+    f[abs(f) > f2] = 0
+    signal_fft_filter = signal_fft * (f != 0).astype(float)
+    return abs(np.fft.ifft(signal_fft_filter))
+
+
+@pytest.mark.parametrize("filename", [
+    'ecg_data/test_data1.csv',
+    'ecg_data/test_data2.csv',
+    'ecg_data/test_data11.csv',
+    'ecg_data/test_data20.csv',
+    'ecg_data/test_data23.csv',
+    'ecg_data/test_data28.csv',
+    'ecg_data/test_data31.csv',
+])
+def test_filter_matches_legacy(filename):
+    ECG_object = ECG(filename, quiet=True)
+    ECG_object.load_csv()
+    expected = legacy_filter(ECG_object.time, ECG_object.voltage)
+    assert np.array_equal(ECG_object.filter(), expected)
+    assert np.array_equal(ECG_object.filter(), expected)
+
+
+def test_filter_rfft():
+    ECG_object = ECG('', quiet=True)
+    ECG_object.time = np.linspace(0, 20, 1200, endpoint=False) + 1/60
+    ECG_object.voltage = np.random.default_rng(2).standard_normal(1200)
+    voltage_filter = ECG_object.filter(f1=5, f2=20, method="rfft")
+    f = np.fft.fftfreq(1200, 1/60)
+    mask = (abs(f) >= 5) & (abs(f) <= 20)
+    expected = abs(np.fft.ifft(np.fft.fft(ECG_object.voltage) * mask))
+    assert np.allclose(voltage_filter, expected)
+
+
+def test_filter_peak_memory():
+    import tracemalloc
+    ECG_object = ECG('', quiet=True)
+    ECG_object.time = np.linspace(0, 1000, 360000, dtype=np.float32)
+    ECG_object.voltage = np.random.default_rng(3).standard_normal(
+        360000).astype(np.float32)
+
+    def peak(func):
+        tracemalloc.start()
+        func()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak_bytes
+    legacy = peak(lambda: legacy_filter(ECG_object.time, ECG_object.voltage))
+    ECG_object.filter()
+    fft = peak(lambda: ECG_object.filter())
+    rfft = peak(lambda: ECG_object.filter(method="rfft"))
+    assert fft < legacy
+    assert rfft < 0.6 * fft
+
+
 def test_filter():
     def f(x):
         return np.sin(x)+np.sin(5*x)+np.sin(10*x)
@@ -86,6 +185,45 @@ def test_filter():
     assert abs(voltage_filter_fft[603]) < abs(voltage_fft[603])
 
 
+@pytest.mark.parametrize("method", ["fft", "sos", "sos_causal"])
+def test_filter_methods(method):
+    def f(x):
+        return np.sin(x)+np.sin(5*x)+np.sin(10*x)
+    ECG_object = ECG('', quiet=True)
+    ECG_object.time = np.linspace(0, 20, 1200)
+    ECG_object.voltage = f(ECG_object.time)
+    voltage_filter = ECG_object.filter(f1=5, f2=20, method=method)
+    voltage_filter_fft = np.fft.fftshift(np.fft.fft(voltage_filter))
+    voltage_fft = np.fft.fftshift(np.fft.fft(ECG_object.voltage))
+    assert abs(voltage_filter_fft[603]) < abs(voltage_fft[603])
+
+
+def test_filter_sos_causal_continues():
+    ECG_object = ECG('', quiet=True, filter_method="sos_causal")
+    ECG_object.time = np.linspace(0, 20, 1200)
+    ECG_object.voltage = np.sin(ECG_object.time * 60)
+    ECG_object.filter()
+    one_pass = ECG_object.bandpass.process(np.ones(10))
+    ECG_object.filter()
+    ECG_object.bandpass.process(np.ones(5))
+    assert np.allclose(ECG_object.bandpass.process(np.ones(5)),
+                       one_pass[5:])
+
+
+@pytest.mark.parametrize("ingest", ["pandas", "", None])
+def test_unknown_ingest(ingest):
+    with pytest.raises(ValueError):
+        ECG('', ingest=ingest, quiet=True)
+
+
+def test_filter_unknown_method():
+    ECG_object = ECG('', quiet=True)
+    ECG_object.time = np.linspace(0, 20, 1200)
+    ECG_object.voltage = np.zeros(1200)
+    with pytest.raises(ValueError):
+        ECG_object.filter(method="wavelet")
+
+
 def test_calculate_voltage_extremes():
     ECG_object = ECG('')
     ECG_object.voltage_filter = np.linspace(0, 20, 1200)
@@ -152,3 +290,125 @@ def test_calculate_mean_hr_bpm():
     bpm = ECG_object.calculate_mean_hr_bpm()
     expected_bpm = 12
     assert bpm == expected_bpm
+
+
+def test_init_log_per_instance(tmp_path):
+    first = ECG(str(tmp_path / 'first.csv'))
+    second = ECG(str(tmp_path / 'second.csv'))
+    first.logger.info("first only")
+    second.logger.info("second only")
+    first.close_log()
+    second.close_log()
+    first_log = (tmp_path / 'first.log').read_text()
+    second_log = (tmp_path / 'second.log').read_text()
+    assert "first only" in first_log and "second only" not in first_log
+    assert "second only" in second_log and "first only" not in second_log
+    assert first.logger.handlers == []
+
+
+def test_init_log_quiet(tmp_path):
+    filename = str(tmp_path / 'quiet.csv')
+    ECG_object = ECG(filename, quiet=True)
+    with LogCapture() as log_c:
+        ECG_object.logger.error("Bad or empty entry")
+    ECG_object.close_log()
+    log_c.check(("ECG." + filename, "ERROR", "Bad or empty entry"))
+    assert not (tmp_path / 'quiet.log').exists()
+
+
+def test_instrument_disabled():
+    ECG_object = ECG('ecg_data/test_data1.csv', quiet=True)
+    ECG_object.preprocess()
+    ECG_object.calculate_metrics()
+    assert ECG_object.stage_stats == {}
+
+
+def test_instrument_records_stages():
+    calls = []
+    ECG_object = ECG('ecg_data/test_data1.csv', quiet=True,
+                     instrument=lambda name, record: calls.append(name))
+    ECG_object.preprocess()
+    ECG_object.calculate_metrics()
+    ECG_object.close_log()
+    assert calls == ["load_csv", "filter", "preprocess", "find_peaks",
+                     "calculate_metrics"]
+    stats = ECG_object.stage_stats
+    assert stats["load_csv"]["calls"] == 1
+    assert stats["preprocess"]["wall_s"] >= stats["load_csv"]["wall_s"]
+    assert stats["filter"]["cpu_s"] >= 0
+
+
+def test_instrument_trace_memory():
+    import tracemalloc
+    records = {}
+    ECG_object = ECG('', quiet=True, trace_memory=True,
+                     instrument=lambda name, record:
+                     records.update({name: record}))
+    ECG_object.time = np.linspace(0, 100, 36000)
+    ECG_object.voltage = np.zeros(36000, dtype=np.float32)
+    ECG_object.filter()
+    ECG_object.close_log()
+    assert not tracemalloc.is_tracing()
+    assert records["filter"]["peak_bytes"] >= 36000 * 16
+    assert records["filter"]["alloc_bytes"] >= 36000 * 8
+
+
+def test_from_arrays_matches_file():
+    ECG_file = ECG('ecg_data/test_data11.csv', quiet=True)
+    ECG_file.preprocess()
+    ECG_file.calculate_metrics()
+    data = np.genfromtxt('ecg_data/test_data11.csv', delimiter=',')
+    with LogCapture() as log_c:
+        ECG_object = ECG.from_arrays(data[:, 0], data[:, 1])
+    errors = [r for r in log_c.records if r.levelname == "ERROR"]
+    assert len(errors) == 2
+    ECG_object.preprocess()
+    ECG_object.calculate_metrics()
+    assert ECG_object.metrics() == ECG_file.metrics()
+
+
+def test_from_buffer_matches_file():
+    ECG_file = ECG('ecg_data/test_data20.csv', quiet=True)
+    ECG_file.preprocess()
+    ECG_file.calculate_metrics()
+    with open('ecg_data/test_data20.csv', 'rb') as in_file:
+        ECG_object = ECG.from_buffer(in_file.read())
+    ECG_object.preprocess()
+    ECG_object.calculate_metrics()
+    assert ECG_object.metrics() == ECG_file.metrics()
+
+
+def test_analyze_buffer_no_files(tmp_path, monkeypatch):
+    from ecg_analysis import analyze_buffer, analyze_arrays
+    with open('ecg_data/test_data1.csv', 'rb') as in_file:
+        data = in_file.read()
+    monkeypatch.chdir(tmp_path)
+    metrics, image = analyze_buffer(data)
+    assert metrics["mean_hr_bpm"] == 74
+    assert image[:2] == b'\xff\xd8'
+    time = np.arange(1, 11, 1/360)
+    voltage = np.zeros(time.shape)
+    voltage[180::360] = 1
+    metrics, image = analyze_arrays(time, voltage, plot=False)
+    assert metrics["mean_hr_bpm"] == 60
+    assert image is None
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize("out, fmt", [
+    ("ecg_test_plot.png", None),
+    (io.BytesIO(), "png"),
+])
+def test_make_plots(out, fmt):
+    from PIL import Image
+    time = np.arange(3600) / 360
+    ECGobject = ECG.from_arrays(time, np.sin(time))
+    ECGobject.make_plots(out, fmt=fmt, width=320, height=240)
+    if isinstance(out, str):
+        with open(out, "rb") as in_file:
+            image = in_file.read()
+        os.remove(out)
+    else:
+        image = out.getvalue()
+    assert Image.open(io.BytesIO(image)).size == (320, 240)
+    assert image == ECGobject.plot_bytes("png", width=320, height=240)
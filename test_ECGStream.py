@@ -0,0 +1,92 @@
+from ECGStream import ECGStream
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize("chunk_sizes", [
+    [1000],
+    [97] * 11,
+    [1, 2, 300, 5, 400, 292],
+])
+def test_filter_chunk_matches_full_convolution(chunk_sizes):
+    rng = np.random.default_rng(0)
+    voltage = rng.standard_normal(sum(chunk_sizes))
+    stream = ECGStream('', quiet=True)
+    taps = stream.design_filter(360)
+    out = []
+    start = 0
+    for size in chunk_sizes:
+        out.append(stream.filter_chunk(voltage[start:start + size]))
+        start += size
+    expected = np.convolve(voltage, taps)[:len(voltage)]
+    assert np.allclose(np.concatenate(out), expected)
+
+
+@pytest.mark.parametrize("chunk_size", [50, 97, 360, 10000])
+def test_process_chunk_beats_across_seams(chunk_size):
+    sampling_rate = 360
+    time = np.arange(0, 20, 1 / sampling_rate)
+    voltage = np.zeros(time.shape)
+    voltage[sampling_rate // 2::sampling_rate] = 1
+    stream = ECGStream('', quiet=True)
+    for start in range(0, len(time), chunk_size):
+        stream.process_chunk(time[start:start + chunk_size],
+                             voltage[start:start + chunk_size])
+    stream.finish()
+    assert stream.num_beats == 20
+    assert np.allclose(stream.beats, time[sampling_rate // 2::sampling_rate])
+    assert stream.mean_hr_bpm == 60
+    assert stream.duration == time[-1]
+
+
+def test_run_chunk_size_invariant():
+    filename = 'ecg_data/test_data1.csv'
+    small = ECGStream(filename, chunk_size=997)
+    small.run()
+    large = ECGStream(filename, chunk_size=100000)
+    large.run()
+    assert small.num_samples == large.num_samples == 10000
+    assert small.num_beats == large.num_beats
+    assert np.allclose(small.beats, large.beats)
+    assert small.mean_hr_bpm == large.mean_hr_bpm == 74
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 999])
+def test_run_small_first_chunks(chunk_size):
+    filename = 'ecg_data/test_data1.csv'
+    stream = ECGStream(filename, chunk_size=chunk_size, quiet=True)
+    assert stream.run() == 74
+    assert stream.num_samples == 10000
+    large = ECGStream(filename, chunk_size=100000, quiet=True)
+    large.run()
+    assert np.allclose(stream.beats, large.beats)
+
+
+@pytest.mark.parametrize("time", [
+    [],
+    [0.0],
+    [1.0, 1.0, 1.0],
+])
+def test_process_chunk_too_short(time):
+    stream = ECGStream('', quiet=True)
+    for t in time:
+        stream.process_chunk(np.array([t]), np.array([0.5]))
+    stream.finish()
+    assert stream.taps is None
+    assert stream.num_samples == 0
+    assert stream.mean_hr_bpm == -1
+
+
+def test_process_chunk_short_recording():
+    time = np.arange(0, 2, 1 / 360)
+    stream = ECGStream('', quiet=True)
+    stream.process_chunk(time, np.sin(time))
+    assert stream.taps is None
+    stream.finish()
+    assert stream.sampling_rate == pytest.approx(360)
+    assert stream.num_samples == len(time)
+
+
+def test_analyze_stream():
+    from ecg_analysis import analyze_stream
+    assert analyze_stream('ecg_data/test_data2.csv', chunk_size=1000) == 68
@@ -0,0 +1,133 @@
+from HttpClient import HttpClient
+import gzip
+import json
+import pytest
+import requests
+import socket
+from urllib3.exceptions import NewConnectionError
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def request(self, method, url, timeout=None, **kwargs):
+        self.calls.append((method, url, timeout, kwargs))
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return FakeResponse(outcome)
+
+
+def make_client(outcomes, **kwargs):
+    client = HttpClient(**kwargs)
+    client.session = FakeSession(outcomes)
+    client.sleeps = []
+    client.sleep = client.sleeps.append
+    client.random = lambda: 1.0
+    return client
+
+
+@pytest.mark.parametrize("method, outcomes, expected, sleeps", [
+    ("GET", [200], 200, []),
+    ("GET", [503, 200], 200, [0.25]),
+    ("GET", [requests.ConnectionError(), requests.ReadTimeout(), 200], 200,
+     [0.25, 0.5]),
+    ("GET", [502, 504, 429, 503], 503, [0.25, 0.5, 1.0]),
+    ("GET", [404], 404, []),
+    ("POST", [503, 200], 503, []),
+    ("POST", [requests.ConnectTimeout(), 200], 200, [0.25]),
+    ("POST", [requests.ConnectionError(NewConnectionError(None, "refused")),
+              201], 201, [0.25]),
+])
+def test_request_retries(method, outcomes, expected, sleeps):
+    client = make_client(outcomes)
+    r = client.request(method, "http://server/x")
+    assert r.status_code == expected
+    assert client.sleeps == sleeps
+    assert len(client.session.calls) == len(sleeps) + 1
+
+
+@pytest.mark.parametrize("method, outcomes", [
+    ("GET", [requests.ConnectionError()] * 4),
+    ("POST", [requests.ConnectionError()]),
+    ("POST", [requests.ReadTimeout()]),
+])
+def test_request_retries_exhausted(method, outcomes):
+    client = make_client(outcomes)
+    with pytest.raises(requests.RequestException):
+        client.request(method, "http://server/x")
+    assert len(client.session.calls) == len(outcomes)
+
+
+def test_request_overrides():
+    client = make_client([503, 200])
+    r = client.get("http://server/x", retries=0, timeout=1.0)
+    assert r.status_code == 503
+    assert client.session.calls[0][2] == 1.0
+
+
+@pytest.mark.parametrize("attempt, random, expected", [
+    (0, 1.0, 0.25),
+    (2, 0.5, 0.5),
+    (10, 1.0, 4.0),
+    (3, 0.0, 0.0),
+])
+def test_backoff_delay(attempt, random, expected):
+    client = HttpClient()
+    client.random = lambda: random
+    assert client.backoff_delay(attempt) == expected
+
+
+@pytest.mark.parametrize("body, compress, min_size, compressed", [
+    ({"ecg_image": "a" * 2000}, None, None, False),
+    ({"ecg_image": "a" * 2000}, None, 1024, True),
+    ({"mrn": 1}, None, 1024, False),
+    ({"mrn": 1}, True, None, True),
+    ({"ecg_image": "a" * 2000}, False, 1024, False),
+])
+def test_post_gzip(body, compress, min_size, compressed):
+    client = make_client([200], gzip_min_size=min_size)
+    client.post("http://server/x", json=body, compress=compress)
+    kwargs = client.session.calls[0][3]
+    data = kwargs["data"]
+    assert kwargs["headers"]["Content-Type"] == "application/json"
+    if compressed:
+        assert kwargs["headers"]["Content-Encoding"] == "gzip"
+        data = gzip.decompress(data)
+    else:
+        assert "Content-Encoding" not in kwargs["headers"]
+    assert json.loads(data) == body
+
+
+def test_post_retries_refused_connection():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    client = HttpClient(retries=2)
+    sleeps = []
+    client.sleep = sleeps.append
+    calls = []
+    request = client.session.request
+
+    def counting_request(*args, **kwargs):
+        calls.append(args)
+        return request(*args, **kwargs)
+
+    client.session.request = counting_request
+    with pytest.raises(requests.ConnectionError):
+        client.post("http://127.0.0.1:{}/new_patient_info".format(port),
+                    json={"mrn": 1})
+    assert len(calls) == 3
+    assert len(sleeps) == 2
+    client.close()
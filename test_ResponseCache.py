@@ -0,0 +1,77 @@
+from ResponseCache import ResponseCache
+import pytest
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def counting(results):
+    calls = []
+
+    def func(*args):
+        calls.append(args)
+        return results[len(calls) - 1]
+    return func, calls
+
+
+def test_get_or_call_hit_and_miss():
+    cache = ResponseCache()
+    func, calls = counting(["a", "b"])
+    assert cache.get_or_call(("most_recent", 1), func, 1) == "a"
+    assert cache.get_or_call(("most_recent", 1), func, 1) == "a"
+    assert calls == [(1,)]
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (1, 1, 1)
+    assert stats["hit_rate"] == 0.5
+
+
+def test_ttl_expires():
+    clock = FakeClock()
+    cache = ResponseCache(ttl=5, clock=clock)
+    func, calls = counting(["a", "b"])
+    cache.get_or_call(("mrn_list",), func)
+    clock.now = 4.9
+    assert cache.get_or_call(("mrn_list",), func) == "a"
+    clock.now = 5.0
+    assert cache.get_or_call(("mrn_list",), func) == "b"
+
+
+def test_lru_eviction():
+    cache = ResponseCache(maxsize=2)
+    cache.get_or_call(("images", 1), str, 1)
+    cache.get_or_call(("images", 2), str, 2)
+    cache.get_or_call(("images", 1), str, 1)
+    cache.get_or_call(("images", 3), str, 3)
+    func, calls = counting(["new"])
+    assert cache.get_or_call(("images", 1), func) == "1"
+    assert cache.get_or_call(("images", 2), func) == "new"
+    assert cache.stats()["evictions"] == 2
+
+
+@pytest.mark.parametrize("mrn, kept", [
+    (1, [("mrn_list",), ("images", 2)]),
+    (None, [("images", 1), ("most_recent", 1), ("images", 2)]),
+])
+def test_invalidate(mrn, kept):
+    cache = ResponseCache()
+    keys = [("mrn_list",), ("images", 1), ("most_recent", 1), ("images", 2)]
+    for key in keys:
+        cache.get_or_call(key, str, key)
+    assert cache.invalidate(mrn) == len(keys) - len(kept)
+    assert list(cache._entries) == kept
+
+
+def test_invalidate_during_call_not_cached():
+    cache = ResponseCache()
+
+    def stale_read():
+        cache.invalidate(1)
+        return "stale"
+
+    assert cache.get_or_call(("most_recent", 1), stale_read) == "stale"
+    assert cache.stats()["size"] == 0
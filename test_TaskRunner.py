@@ -0,0 +1,52 @@
+from TaskRunner import TaskRunner
+import threading
+import pytest
+
+
+def test_submit_and_process():
+    runner = TaskRunner()
+    results = []
+    future = runner.submit(pow, results.append, 2, 10)
+    future.result(timeout=5)
+    assert results == []
+    assert runner.process() == 1
+    assert results == [1024]
+    assert runner.process() == 0
+    runner.shutdown()
+
+
+@pytest.mark.parametrize("use_errback", [True, False])
+def test_process_error(use_errback):
+    runner = TaskRunner()
+    results = []
+    errors = []
+    errback = errors.append if use_errback else None
+    future = runner.submit(int, results.append, "x", errback=errback)
+    with pytest.raises(ValueError):
+        future.result(timeout=5)
+    assert runner.process() == 1
+    assert results == []
+    assert len(errors) == (1 if use_errback else 0)
+    runner.shutdown()
+
+
+def test_concurrent_and_callback_thread():
+    runner = TaskRunner(max_workers=3)
+    barrier = threading.Barrier(3, timeout=5)
+    threads = []
+
+    def work(i):
+        barrier.wait()
+        return i
+
+    def done(i):
+        threads.append((i, threading.current_thread()))
+
+    futures = [runner.submit(work, done, i) for i in range(3)]
+    for future in futures:
+        future.result(timeout=5)
+    runner.process()
+    assert sorted(i for i, thread in threads) == [0, 1, 2]
+    assert all(thread is threading.current_thread()
+               for i, thread in threads)
+    runner.shutdown()
@@ -0,0 +1,38 @@
+from UpdateBroker import UpdateBroker
+import queue
+import pytest
+
+
+def drain(subscriber):
+    events = []
+    while True:
+        try:
+            events.append(subscriber.get_nowait())
+        except queue.Empty:
+            return events
+
+
+def test_publish_to_subscribers():
+    broker = UpdateBroker()
+    first, second = broker.subscribe(), broker.subscribe()
+    assert broker.publish({"type": "patient", "mrn": 1}) == 2
+    broker.unsubscribe(second)
+    assert broker.publish({"type": "patient", "mrn": 2}) == 1
+    assert len(broker) == 1
+    assert drain(first) == [{"type": "patient", "mrn": 1},
+                            {"type": "patient", "mrn": 2}]
+    assert drain(second) == [{"type": "patient", "mrn": 1}]
+
+
+@pytest.mark.parametrize("published, expected", [
+    (4, [0, 1, 2, 3]),
+    (5, ["resync", 4]),
+    (7, ["resync", 4, 5, 6]),
+])
+def test_publish_overflow(published, expected):
+    broker = UpdateBroker(maxsize=4)
+    subscriber = broker.subscribe()
+    for mrn in range(published):
+        broker.publish({"type": "patient", "mrn": mrn})
+    events = drain(subscriber)
+    assert [event.get("mrn", event["type"]) for event in events] == expected
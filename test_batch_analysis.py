@@ -0,0 +1,88 @@
+import json
+import pytest
+
+
+def test_find_ecg_files():
+    from batch_analysis import find_ecg_files
+    by_dir = find_ecg_files('ecg_data')
+    by_glob = find_ecg_files('ecg_data/test_data*.csv')
+    assert len(by_dir) == 16
+    assert by_dir == by_glob
+    assert find_ecg_files('ecg_data/test_data1.csv') == \
+        ['ecg_data/test_data1.csv']
+
+
+def test_analyze_file():
+    from batch_analysis import analyze_file
+    result = analyze_file('ecg_data/test_data1.csv')
+    assert result["status"] == "ok"
+    assert result["num_samples"] == 10000
+    assert result["metrics"]["mean_hr_bpm"] == 74
+    assert set(result["metrics"]) == {"duration", "voltage_extremes",
+                                      "num_beats", "mean_hr_bpm", "beats"}
+    json.dumps(result)
+
+
+def test_analyze_file_profile():
+    from batch_analysis import analyze_file, summarize_batch
+    result = analyze_file('ecg_data/test_data1.csv', quiet=True,
+                          profile=True)
+    assert set(result["stages"]) == {"load_csv", "filter", "preprocess",
+                                     "find_peaks", "calculate_metrics"}
+    summary = summarize_batch([result, result], 1.0)
+    assert summary["stages"]["filter"]["wall_s"] == \
+        2 * result["stages"]["filter"]["wall_s"]
+    json.dumps(result)
+
+
+def test_analyze_file_failure():
+    from batch_analysis import analyze_file
+    result = analyze_file('ecg_data/no_such_file.csv')
+    assert result["status"] == "failed"
+    assert result["metrics"] is None
+    assert "FileNotFoundError" in result["error"]
+
+
+def test_analyze_file_no_beats(tmp_path):
+    from batch_analysis import analyze_file
+    filename = str(tmp_path / "flat.csv")
+    with open(filename, "w") as f:
+        for i in range(1800):
+            f.write("{},0.0\n".format(i / 360))
+    result = analyze_file(filename, quiet=True)
+    assert result["status"] == "ok"
+    assert result["metrics"]["num_beats"] == 0
+    assert result["metrics"]["mean_hr_bpm"] is None
+    assert "NaN" not in json.dumps(result, allow_nan=False)
+
+
+def test_summarize_batch():
+    from batch_analysis import summarize_batch
+    results = [{"status": "ok", "num_samples": 100, "latency_s": i}
+               for i in range(1, 101)]
+    results[0]["status"] = "failed"
+    summary = summarize_batch(results, 10.0)
+    assert summary["files"] == 100
+    assert summary["failed"] == 1
+    assert summary["files_per_s"] == 10
+    assert summary["samples_per_s"] == 1000
+    assert summary["latency_p50_s"] == pytest.approx(50.5)
+    assert summary["latency_p95_s"] == pytest.approx(95.05)
+
+
+def test_main(tmp_path):
+    from batch_analysis import main
+    output = tmp_path / "results.json"
+    pattern = str(tmp_path / "*.csv")
+    with open('ecg_data/test_data2.csv') as in_file:
+        (tmp_path / "good.csv").write_text(in_file.read())
+    (tmp_path / "empty.csv").write_text("")
+    exit_code = main([pattern, "--workers", "2", "-o", str(output)])
+    with open(output) as in_file:
+        written = json.load(in_file)
+    assert exit_code == 1
+    assert written["summary"]["files"] == 2
+    assert written["summary"]["failed"] == 1
+    status = {r["filename"]: r["status"] for r in written["results"]}
+    assert status[str(tmp_path / "good.csv")] == "ok"
+    assert status[str(tmp_path / "empty.csv")] == "failed"
@@ -0,0 +1,52 @@
+import json
+import os
+import numpy as np
+
+
+def test_make_synthetic_csv(tmp_path):
+    from benchmark_ecg import make_synthetic_csv
+    from ecg_analysis import analyze_stream
+    filename = str(tmp_path / "synthetic.csv")
+    make_synthetic_csv(filename, 3600)
+    data = np.loadtxt(filename, delimiter=",")
+    assert data.shape == (3600, 2)
+    assert analyze_stream(filename, quiet=True) == 72
+
+
+def test_run_benchmarks():
+    from benchmark_ecg import run_benchmarks, STAGES
+    cwd = os.getcwd()
+    results = run_benchmarks(['ecg_data/test_data1.csv'], [2000], repeat=1)
+    assert os.getcwd() == cwd
+    assert set(results) == {"test_data1.csv", "synthetic_2000"}
+    for stages in results.values():
+        assert list(stages) == STAGES
+        for result in stages.values():
+            assert result["seconds"] > 0
+            assert result["samples_per_s"] > 0
+            assert result["peak_alloc_bytes"] >= 0
+    assert not os.path.exists('ecg_data/test_data1.json')
+
+
+def test_compare():
+    from benchmark_ecg import compare
+    baseline = {"a": {"filter": {"seconds": 1.0},
+                      "find_peaks": {"seconds": 1.0}}}
+    results = {"a": {"filter": {"seconds": 1.2},
+                     "find_peaks": {"seconds": 1.3},
+                     "make_plots": {"seconds": 9.0}},
+               "b": {"filter": {"seconds": 5.0}}}
+    regressions = compare(results, baseline, tolerance=0.25)
+    assert regressions == ["a find_peaks: 1.0000 s -> 1.3000 s"]
+
+
+def test_main_save_and_compare(tmp_path):
+    from benchmark_ecg import main
+    baseline = str(tmp_path / "baseline.json")
+    assert main(["--files", "", "--sizes", "1000", "--repeat", "1",
+                 "--save", baseline]) == 0
+    with open(baseline) as in_file:
+        saved = json.load(in_file)
+    assert list(saved) == ["synthetic_1000"]
+    assert main(["--files", "", "--sizes", "1000", "--repeat", "1",
+                 "--compare", baseline, "--tolerance", "100"]) == 0
@@ -1,9 +1,11 @@
+import pytest
 from pymodm import connect, MongoModel, fields
 from pymongo import MongoClient
 import requests
 from PIL import Image, ImageTk
 import numpy as np
 import base64
+import io
 
 server_address = 'http://127.0.0.1:5000'
 
@@ -39,3 +41,136 @@ def test_download_image_from_server():
                          "images/test_image2.jpg")
     os.remove("images/test_image2.jpg")
     assert result is True
+
+
+def test_conditional_get(mock_mongodb, monkeypatch):
+    import monitor_client
+    from server import app, upsert_patient_info
+    client = app.test_client()
+    statuses = []
+
+    class Response(object):
+        def __init__(self, response):
+            self.status_code = response.status_code
+            self.headers = response.headers
+            self.json = response.get_json
+            statuses.append(response.status_code)
+
+    def get(url, headers=None):
+        path = url[len(monitor_client.server_address):]
+        return Response(client.get(path, headers=headers))
+
+    monkeypatch.setattr(monitor_client.session, "get", get)
+    monkeypatch.setattr(monitor_client, "validators", {})
+    upsert_patient_info(500, {"patient_name": "Ann", "medical_image": "",
+                              "ecg_image": "ecg1", "heart_rate": 60})
+    latest = monitor_client.load_patient_latest(500)
+    assert monitor_client.load_patient_latest(500) == latest
+    upsert_patient_info(500, {"patient_name": "", "medical_image": "",
+                              "ecg_image": "", "heart_rate": 61})
+    assert monitor_client.load_patient_latest(500)["latest_hr"] == 61
+    assert statuses == [200, 304, 200]
+
+
+@pytest.mark.parametrize("lines, expected", [
+    (["retry: 3000", "event: hello", 'data: {"type": "hello"}', ""],
+     [("hello", {"type": "hello"})]),
+    ([": keepalive", "", "event: patient", 'data: {"mrn": 1}', "",
+      'data: [1,', "data: 2]", ""],
+     [("patient", {"mrn": 1}), ("message", [1, 2])]),
+    (["event: patient", 'data: {"mrn": 1}'], []),
+])
+def test_parse_sse(lines, expected):
+    from monitor_client import parse_sse
+    assert list(parse_sse(lines)) == expected
+
+
+def test_upload_patient_files(mock_mongodb, monkeypatch):
+    import io
+    import patient_client
+    from server import app, find_patient_in_db
+    from image_store import get_blob, iter_blob
+    client = app.test_client()
+
+    class Response(object):
+        def __init__(self, response):
+            self.status_code = response.status_code
+
+    def post(url, data=None, files=None):
+        path = url[len(patient_client.server_address):]
+        form = dict(data)
+        for kind, (filename, content, content_type) in files.items():
+            form[kind] = (io.BytesIO(content), filename, content_type)
+        return Response(client.post(path, data=form))
+
+    monkeypatch.setattr(patient_client.session, "post", post)
+    ecg_img = Image.new("RGB", (64, 48), (200, 10, 10))
+    status = patient_client.upload_patient_files("Ann", "440", "70", None,
+                                                 ecg_img)
+    assert status == 200
+    patient = find_patient_in_db(440)
+    assert patient.medical_image == []
+    with open("images/acl1.jpg", "rb") as f:
+        med_bytes = f.read()
+    status = patient_client.upload_patient_files("", "440", "", med_bytes,
+                                                 None)
+    assert status == 200
+    med_blob = get_blob(find_patient_in_db(440).medical_image[0])
+    assert med_blob.content_type == "image/jpeg"
+    assert b"".join(iter_blob(med_blob)) == med_bytes
+    blob = get_blob(patient.ecg_image[0])
+    assert blob.content_type == "image/jpeg"
+    image = Image.open(io.BytesIO(b"".join(iter_blob(blob))))
+    assert image.size == (64, 48)
+
+
+def test_thumbnail_cache(monkeypatch):
+    import monitor_client
+    from ResponseCache import ResponseCache
+    downloads = []
+
+    def load_ecg_image(mrn, timestamp, size=None):
+        assert size == "preview"
+        downloads.append((mrn, timestamp))
+        f = io.BytesIO()
+        Image.new("RGB", (64, 48)).save(f, format="JPEG")
+        return f.getvalue()
+
+    monkeypatch.setattr(monitor_client, "image_cache",
+                        ResponseCache(maxsize=2, ttl=float("inf")))
+    monkeypatch.setattr(monitor_client, "load_ecg_image", load_ecg_image)
+    first = monitor_client.load_ecg_thumbnail(1, "ts1")
+    assert first.size == monitor_client.THUMBNAIL_SIZE
+    assert monitor_client.load_ecg_thumbnail("1", "ts1") is first
+    monitor_client.load_ecg_thumbnail(1, "ts2")
+    monitor_client.load_ecg_thumbnail(1, "ts3")
+    monitor_client.load_ecg_thumbnail(1, "ts1")
+    assert downloads == [(1, "ts1"), (1, "ts2"), (1, "ts3"), (1, "ts1")]
+    stats = monitor_client.image_cache_stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (1, 4, 2)
+
+
+@pytest.mark.parametrize("size, fmt, image_size", [
+    ((1600, 1200), "JPEG", (300, 300)),
+    ((1600, 1200), "JPEG", (200, 200)),
+    ((100, 80), "JPEG", (300, 300)),
+    ((1600, 1200), "PNG", (300, 300)),
+])
+def test_decode_thumbnail(size, fmt, image_size):
+    from monitor_client import decode_thumbnail
+    f = io.BytesIO()
+    Image.new("RGB", size, (10, 200, 10)).save(f, format=fmt)
+    thumbnail = decode_thumbnail(f.getvalue(), image_size)
+    assert thumbnail.size == image_size
+    assert thumbnail.getpixel((0, 0))[1] > 150
+
+
+@pytest.mark.parametrize("img", [b"\xff\xd8\xff jpeg bytes", None])
+def test_convert_image_to_b64_string(img):
+    from patient_client import convert_image_to_b64_string
+    if img is None:
+        img = Image.new("RGB", (8, 8))
+        data = base64.b64decode(convert_image_to_b64_string(img))
+        assert Image.open(io.BytesIO(data)).format == "JPEG"
+    else:
+        assert base64.b64decode(convert_image_to_b64_string(img)) == img
@@ -0,0 +1,48 @@
+from ecg_plot import decimate_minmax, render_ecg
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import numpy as np
+import io
+import pytest
+
+
+@pytest.mark.parametrize("n, n_columns", [
+    (100000, 640),
+    (1001, 7),
+    (64, 640),
+])
+def test_decimate_minmax_keeps_extremes(n, n_columns):
+    rng = np.random.default_rng(2)
+    time = np.arange(n) / 360
+    voltage = rng.standard_normal(n)
+    voltage[n // 3] = 10
+    voltage[n // 2] = -10
+    dec_time, dec_voltage = decimate_minmax(time, voltage, n_columns)
+    assert len(dec_voltage) <= max(n, 2 * n_columns)
+    assert dec_voltage.max() == voltage.max()
+    assert dec_voltage.min() == voltage.min()
+    assert np.all(np.diff(dec_time) >= 0)
+    assert np.all(np.isin(dec_voltage, voltage))
+
+
+@pytest.mark.parametrize("fmt, width, height", [
+    ("jpg", 640, 480),
+    ("png", 300, 200),
+])
+def test_render_ecg_size(fmt, width, height):
+    time = np.arange(3600) / 360
+    image = render_ecg(time, np.sin(time), width=width, height=height,
+                       fmt=fmt)
+    with Image.open(io.BytesIO(image)) as pil_image:
+        assert pil_image.size == (width, height)
+        assert pil_image.format == {"jpg": "JPEG", "png": "PNG"}[fmt]
+
+
+def test_render_ecg_threads():
+    time = np.arange(3600) / 360
+    traces = [np.sin(time * k) for k in range(1, 9)]
+    expected = [render_ecg(time, voltage, fmt="png") for voltage in traces]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        images = list(executor.map(
+            lambda voltage: render_ecg(time, voltage, fmt="png"), traces))
+    assert images == expected
@@ -145,6 +145,8 @@ def test_get_ecg_timestamps(patient, expected):
     (dummy_pt_1, 0, "img1"),
     (dummy_pt_1, 1, "img2"),
     (dummy_pt_2, 1, None),
+    (dummy_pt_1, 2, None),
+    (dummy_pt_1, -1, None),
 ])
 def test_get_medical_image_by_index(patient, index, expected):
     from helpers import get_medical_image_by_index
@@ -0,0 +1,198 @@
+import base64
+import io
+import os
+import pytest
+from PIL import Image
+from Patient import Patient
+
+
+@pytest.mark.parametrize("image, encoding", [
+    (base64.b64encode(b"\xff\xd8\xff\xe0 jpeg").decode(), "base64"),
+    ("abc", "text"),
+    ("not base64!", "text"),
+    ("", "base64"),
+])
+def test_encode_image(image, encoding):
+    from image_store import encode_image
+    data, result = encode_image(image)
+    assert result == encoding
+    if encoding == "text":
+        assert data == image.encode()
+
+
+@pytest.mark.parametrize("size", [0, 10, 255 * 1024, 600000])
+def test_put_load_image(size, mock_mongodb):
+    from image_store import put_image, load_image, CHUNK_SIZE
+    from ImageBlob import ImageBlob, ImageChunk
+    image = base64.b64encode(os.urandom(size)).decode()
+    ref = put_image(1, "ecg_image", image, "ts1")
+    assert load_image(ref) == image
+    blob = ImageBlob.objects.raw({"_id": ref}).first()
+    assert blob.length == size
+    assert ImageChunk.objects.count() == -(-size // CHUNK_SIZE)
+
+
+@pytest.mark.parametrize("ref, expected", [
+    ("legacy inline", "legacy inline"),
+    (None, None),
+])
+def test_load_image_inline(ref, expected):
+    from image_store import load_image
+    assert load_image(ref) == expected
+
+
+def test_add_patient_info_stores_refs(mock_mongodb):
+    from server import add_new_patient_to_database
+    from server import add_patient_info_to_database
+    from server import get_name_and_latest_for_pt
+    from server import process_get_image_by_id
+    from ImageBlob import ImageBlob
+    image = base64.b64encode(b"ecg bytes").decode()
+    patient = add_new_patient_to_database(300)
+    for ecg_image in [image, "abc"]:
+        patient = add_patient_info_to_database(patient, {
+            "patient_name": "Ann", "mrn": 300, "medical_image": "cdf",
+            "ecg_image": ecg_image, "heart_rate": 70})
+    raw = Patient._mongometa.collection.find_one({"_id": 300})
+    assert all(not isinstance(ref, str) for ref in raw["ecg_image"])
+    assert ImageBlob.objects.raw({"mrn": 300}).count() == 4
+    result, status_code = get_name_and_latest_for_pt(300)
+    assert result["latest_ecg"] == "abc"
+    assert process_get_image_by_id(patient, 1) == ("cdf", 200)
+
+
+def test_move_inline_images(mock_mongodb):
+    from image_store import move_inline_images, load_image, delete_images
+    patient = Patient(mrn=301, ecg_image=["ecg1", "ecg2"],
+                      entry_time=["ts1", "ts2"],
+                      medical_image=["img1"]).save()
+    assert move_inline_images(patient) == 3
+    assert move_inline_images(patient) == 0
+    patient = Patient.objects.raw({"_id": 301}).first()
+    assert [load_image(ref) for ref in patient.ecg_image] == ["ecg1", "ecg2"]
+    assert load_image(patient.medical_image[0]) == "img1"
+    assert delete_images(301) == 3
+    assert load_image(patient.medical_image[0]) is None
+
+
+@pytest.mark.parametrize("mrn, timestamp, expected", [
+    (1, "ts1", "ecg1"),
+    (1, "ts2", "ecg3"),
+    (1, "ts3", None),
+    (2, "ts1", "ecg4"),
+])
+def test_load_ecg_by_timestamp(mrn, timestamp, expected, mock_mongodb):
+    from image_store import put_image, load_ecg_by_timestamp
+    put_image(1, "ecg_image", "ecg1", "ts1")
+    put_image(1, "ecg_image", "ecg2", "ts1")
+    put_image(1, "ecg_image", "ecg3", "ts2")
+    put_image(1, "medical_image", "img1", "ts3")
+    put_image(2, "ecg_image", "ecg4", "ts1")
+    assert load_ecg_by_timestamp(mrn, timestamp) == expected
+
+
+class ReadRecorder(object):
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+        self.sizes = []
+
+    def read(self, size=-1):
+        self.sizes.append(size)
+        return self.stream.read(size)
+
+
+@pytest.mark.parametrize("data, content_type", [
+    (b"\xff\xd8\xff\xe0" + os.urandom(600000), "image/jpeg"),
+    (b"\x89PNG" + os.urandom(10), "image/png"),
+    (b"", "application/octet-stream"),
+])
+def test_put_image_stream(data, content_type, mock_mongodb):
+    from image_store import put_image_stream, get_blob, iter_blob
+    from image_store import load_image, CHUNK_SIZE
+    stream = ReadRecorder(data)
+    ref = put_image_stream(1, "medical_image", stream)
+    assert set(stream.sizes) == {CHUNK_SIZE}
+    blob = get_blob(ref)
+    assert blob.content_type == content_type
+    assert blob.length == len(data)
+    chunks = list(iter_blob(blob))
+    assert len(chunks) == blob.chunk_count
+    assert max([len(chunk) for chunk in chunks] + [0]) <= CHUNK_SIZE
+    assert b"".join(chunks) == data
+    assert load_image(ref) == base64.b64encode(data).decode()
+
+
+@pytest.mark.parametrize("filename, variants", [
+    ("images/esophagus2.jpg", {"thumbnail": (123, 150),
+                               "preview": (329, 400)}),
+    ("images/synpic50411.jpg", {"thumbnail": (93, 150)}),
+    ("images/patient_gui2.jpg", {"thumbnail": (150, 134),
+                                 "preview": (400, 356)}),
+])
+def test_put_variants(filename, variants, mock_mongodb, monkeypatch):
+    from image_store import put_image_stream, find_variant, get_image_blob
+    from image_store import iter_blob, VARIANT_SIZES
+    from ImageBlob import ImageBlob, ImageChunk
+    with open(filename, "rb") as f:
+        data = f.read()
+    finds = []
+    find = ImageChunk._mongometa.collection.find
+    monkeypatch.setattr(ImageChunk._mongometa.collection, "find",
+                        lambda *args, **kwargs: finds.append(args) or
+                        find(*args, **kwargs))
+    ref = put_image_stream(1, "medical_image", io.BytesIO(data))
+    assert finds == []
+    assert ImageBlob.objects.count() == 1 + len(variants)
+    for size in VARIANT_SIZES:
+        blob = get_image_blob(ref, size)
+        stored = b"".join(iter_blob(blob))
+        if size in variants:
+            assert blob.pk == find_variant(ref, size).pk
+            assert blob.content_type == "image/jpeg"
+            assert Image.open(io.BytesIO(stored)).size == variants[size]
+            assert len(stored) < len(data)
+        else:
+            assert blob.pk == ref
+            assert stored == data
+    assert get_image_blob(ref).pk == ref
+
+
+def test_put_variants_too_large(mock_mongodb, monkeypatch):
+    import image_store
+    from image_store import put_image_stream
+    from ImageBlob import ImageBlob
+    with open("images/esophagus2.jpg", "rb") as f:
+        data = f.read()
+    monkeypatch.setattr(image_store, "MAX_VARIANT_SOURCE_BYTES",
+                        len(data) - 1)
+    put_image_stream(1, "medical_image", io.BytesIO(data))
+    assert ImageBlob.objects.count() == 1
+
+
+def test_put_images(mock_mongodb, monkeypatch):
+    from image_store import put_images, load_image, find_variant
+    from image_store import delete_blobs
+    from ImageBlob import ImageBlob, ImageChunk
+    with open("images/esophagus2.jpg", "rb") as f:
+        jpeg = base64.b64encode(f.read()).decode()
+    big = base64.b64encode(os.urandom(600000)).decode()
+    inserts = []
+    for model in [ImageBlob, ImageChunk]:
+        collection = model._mongometa.collection
+        monkeypatch.setattr(collection, "insert_many",
+                            lambda docs, insert=collection.insert_many,
+                            **kwargs: inserts.append(1) or
+                            insert(docs, **kwargs))
+        monkeypatch.setattr(model, "save", None)
+    refs = put_images([(1, "medical_image", jpeg, None),
+                       (1, "ecg_image", big, "ts1"),
+                       (2, "ecg_image", "not base64!", "ts2")])
+    assert len(inserts) == 2
+    assert [load_image(ref) for ref in refs] == [jpeg, big, "not base64!"]
+    assert find_variant(refs[0], "thumbnail") is not None
+    assert ImageBlob.objects.count() == 5
+    assert ImageBlob.objects.raw({"_id": refs[1]}).first().timestamp == \
+        "ts1"
+    assert delete_blobs(refs[:2]) == 4
+    assert ImageBlob.objects.count() == 1
+    assert ImageChunk.objects.count() == 1
@@ -12,6 +12,7 @@ import json
 import requests
 import base64
 import io
+import gzip
 import matplotlib.image as mpimg
 from matplotlib import pyplot as plt
 from skimage.io import imsave
@@ -92,9 +93,12 @@ def test_add_patient_info_in_db():
     patient = find_patient_in_db(mrn=104)
     updated_patient = add_patient_info_to_database(patient, new_patient)
     assert find_patient_in_db(mrn=104) is not False
-    assert new_patient['medical_image'] in updated_patient.medical_image
+    from image_store import load_image
+    assert new_patient['medical_image'] in [
+        load_image(ref) for ref in updated_patient.medical_image]
     assert new_patient['heart_rate'] in updated_patient.heart_rate
-    assert new_patient['ecg_image'] in updated_patient.ecg_image
+    assert new_patient['ecg_image'] in [
+        load_image(ref) for ref in updated_patient.ecg_image]
 
 
 def test_get_available_mrns():
@@ -262,3 +266,538 @@ def test_process_get_all_medical_img(patient, expected):
     from server import process_get_all_medical_img
     result = process_get_all_medical_img(patient)
     assert result == expected
+
+
+@pytest.fixture
+def mock_patients(mock_mongodb):
+    Patient(mrn=200, patient_name="James", medical_image=["img1", "img2"],
+            ecg_image=["ecg1", "ecg2"], entry_time=["ts1", "ts2"],
+            heart_rate=[123, 60]).save()
+    Patient(mrn=201).save()
+
+
+def test_process_get_available_mrns_projection(mock_patients):
+    from server import process_get_available_mrns
+    assert sorted(process_get_available_mrns()) == [200, 201]
+
+
+@pytest.mark.parametrize("mrn, kind, expected", [
+    (200, "medical_image", 2),
+    (200, "ecg_image", 2),
+    (201, "medical_image", 0),
+    (202, "medical_image", None),
+])
+def test_count_patient_images(mrn, kind, expected, mock_patients):
+    from server import count_patient_images
+    assert count_patient_images(mrn, kind) == expected
+
+
+@pytest.mark.parametrize("projection, fetched, empty", [
+    ({"entry_time": 1}, ["entry_time"],
+     ["ecg_image", "medical_image", "heart_rate"]),
+    ({"medical_image": 1}, ["medical_image"], ["ecg_image", "entry_time"]),
+])
+def test_find_patient_in_db_projection(projection, fetched, empty,
+                                       mock_patients):
+    from server import find_patient_in_db
+    patient = find_patient_in_db(200, projection)
+    for field in fetched:
+        assert len(getattr(patient, field)) == 2
+    for field in empty:
+        assert getattr(patient, field) == []
+    assert find_patient_in_db(202, projection) is False
+
+
+@pytest.mark.parametrize("mrn, expected, code", [
+    (200, {"name": "James", "latest_hr": 60, "latest_ecg": "ecg2",
+           "entry_time": "ts2"}, 200),
+    (201, {"name": None, "latest_hr": None, "latest_ecg": None,
+           "entry_time": None}, 200),
+    (202, "Patient not found", 400),
+])
+def test_get_name_and_latest_projection(mrn, expected, code,
+                                        mock_patients):
+    from server import get_name_and_latest_for_pt
+    assert get_name_and_latest_for_pt(mrn) == (expected, code)
+
+
+@pytest.mark.parametrize("url, expected, code", [
+    ("/200/images", {"result": [0, 1], "code": 200}, 200),
+    ("/201/images", {"result": [], "code": 200}, 200),
+    ("/202/images", "Patient not found", 400),
+    ("/abc/images", "Invalid MRN format", 400),
+    ("/200/ecg/timestamps", ["ts1", "ts2"], 200),
+    ("/200/ecg/ts1", {"result": "ecg1", "code": 200}, 200),
+    ("/200/images/1", {"result": "img2", "code": 200}, 200),
+])
+def test_projection_routes(url, expected, code, mock_patients):
+    from server import app
+    response = app.test_client().get(url)
+    assert response.status_code == code
+    if response.is_json:
+        assert response.get_json() == expected
+    else:
+        assert response.get_data(as_text=True) == expected
+
+
+@pytest.mark.parametrize("uploads, name, heart_rate, num_ecg", [
+    ([{"patient_name": "", "heart_rate": ""}], None, [], 0),
+    ([{"patient_name": "Ann", "heart_rate": 70},
+      {"patient_name": "Bob", "heart_rate": "71"}], "Ann", [70, 71], 0),
+    ([{"patient_name": "", "heart_rate": 70, "ecg_image": "ecg1"},
+      {"patient_name": "Bob", "heart_rate": "", "ecg_image": "ecg2"}],
+     "Bob", [70], 2),
+])
+def test_upsert_patient_info(uploads, name, heart_rate, num_ecg,
+                             mock_mongodb):
+    from server import upsert_patient_info, find_patient_in_db
+    for upload in uploads:
+        in_data = {"mrn": 400, "medical_image": "", "ecg_image": ""}
+        in_data.update(upload)
+        upsert_patient_info(400, in_data)
+    patient = find_patient_in_db(400)
+    assert patient.patient_name == name
+    assert patient.heart_rate == heart_rate
+    assert len(patient.ecg_image) == len(patient.entry_time) == num_ecg
+
+
+def test_process_patient_info_concurrent(mock_mongodb):
+    from concurrent.futures import ThreadPoolExecutor
+    from server import process_patient_info, find_patient_in_db
+    from image_store import load_image
+
+    def upload(i):
+        return process_patient_info({
+            "patient_name": "pt{}".format(i), "mrn": str(401 + i % 2),
+            "medical_image": "", "ecg_image": "ecg{}".format(i),
+            "heart_rate": i})
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        statuses = list(executor.map(upload, range(200)))
+    assert all(status == 200 for message, status in statuses)
+    for mrn, first in [(401, 0), (402, 1)]:
+        patient = find_patient_in_db(mrn)
+        assert sorted(patient.heart_rate) == list(range(first, 200, 2))
+        assert len(patient.entry_time) == 100
+        assert sorted(load_image(ref) for ref in patient.ecg_image) == \
+            sorted("ecg{}".format(i) for i in range(first, 200, 2))
+        assert patient.patient_name in \
+            ["pt{}".format(i) for i in range(first, 200, 2)]
+
+
+def test_get_ecg_at_timestamp_point_read(mock_mongodb, monkeypatch):
+    import server
+    from urllib.parse import quote
+    in_data = {"patient_name": "", "mrn": 410, "medical_image": "",
+               "ecg_image": "ecg1", "heart_rate": 60}
+    server.upsert_patient_info(410, in_data)
+    timestamp = server.find_patient_in_db(410).entry_time[0]
+
+    def no_patient_read(*args):
+        raise AssertionError("patient loaded")
+
+    monkeypatch.setattr(server, "find_patient_in_db", no_patient_read)
+    response = server.app.test_client().get(
+        "/410/ecg/" + quote(timestamp))
+    assert response.get_json() == {"result": "ecg1", "code": 200}
+
+
+def test_response_cache_invalidated_on_write(mock_patients, monkeypatch):
+    import server
+    calls = []
+    find_patient_in_db = server.find_patient_in_db
+
+    def counting_find(*args):
+        calls.append(args[0])
+        return find_patient_in_db(*args)
+
+    monkeypatch.setattr(server, "find_patient_in_db", counting_find)
+    client = server.app.test_client()
+    for i in range(3):
+        assert client.get("/200/most_recent").get_json()["latest_hr"] == 60
+        assert client.get("/mrn_list").get_json()["data"] == [200, 201]
+    assert calls == [200]
+    server.process_patient_info({"patient_name": "", "mrn": "200",
+                                 "medical_image": "", "ecg_image": "",
+                                 "heart_rate": 61})
+    server.process_patient_info({"patient_name": "", "mrn": "203",
+                                 "medical_image": "", "ecg_image": "",
+                                 "heart_rate": 70})
+    assert client.get("/200/most_recent").get_json()["latest_hr"] == 61
+    assert client.get("/mrn_list").get_json()["data"] == [200, 201, 203]
+    assert calls == [200, 200]
+    stats = client.get("/cache_stats").get_json()
+    assert (stats["hits"], stats["misses"]) == (6, 6)
+
+
+@pytest.mark.parametrize("url", [
+    "/200/most_recent",
+    "/200/ecg/timestamps",
+    "/200/images",
+])
+def test_conditional_get(url, mock_patients):
+    from server import app, upsert_patient_info
+    client = app.test_client()
+    first = client.get(url)
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.get_data() == b""
+    assert response.headers["ETag"] == etag
+    upsert_patient_info(200, {"patient_name": "", "medical_image": "img3",
+                              "ecg_image": "ecg3", "heart_rate": 61})
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    last_modified = response.headers["Last-Modified"]
+    response = client.get(url, headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+
+
+@pytest.mark.parametrize("url, code", [
+    ("/202/most_recent", 400),
+    ("/abc/most_recent", 400),
+    ("/mrn_list", 200),
+])
+def test_conditional_get_no_validators(url, code, mock_patients):
+    from server import app
+    response = app.test_client().get(url, headers={"If-None-Match": "*"})
+    assert response.status_code == code
+    assert "ETag" not in response.headers
+
+
+@pytest.mark.parametrize("mrn, expected", [
+    (None, [420, 421, 420]),
+    (420, [420, 420]),
+])
+def test_event_stream(mrn, expected, mock_mongodb):
+    from server import event_stream, upsert_patient_info, update_broker
+    import json
+    stream = event_stream(mrn, keepalive=0.01)
+    assert next(stream).endswith('event: hello\ndata: {"type": "hello"}\n\n')
+    assert next(stream) == ": keepalive\n\n"
+    for upload_mrn in [420, 421, 420]:
+        upsert_patient_info(upload_mrn, {
+            "patient_name": "", "medical_image": "", "ecg_image": "ecg",
+            "heart_rate": 60})
+    events = []
+    for text in stream:
+        if text.startswith(":"):
+            break
+        name, data = text.split("\n")[:2]
+        assert name == "event: patient"
+        events.append(json.loads(data[len("data: "):]))
+    assert [event["mrn"] for event in events] == expected
+    assert events[0]["new"] is True
+    assert events[-1]["new"] is False
+    assert events[-1]["entry_time"] is not None
+    assert len(update_broker) == 1
+    stream.close()
+    assert len(update_broker) == 0
+
+
+def test_events_route(mock_mongodb):
+    from server import app
+    client = app.test_client()
+    assert client.get("/events?mrn=abc").status_code == 400
+    response = client.get("/events", buffered=False)
+    assert response.mimetype == "text/event-stream"
+    assert b"event: hello" in next(response.response)
+    response.close()
+
+
+@pytest.mark.parametrize("mrn, expected, code", [
+    (200, {"name": "James", "latest_hr": 60, "entry_time": "ts2",
+           "latest_ecg_id": None, "has_ecg": True,
+           "ecg_timestamps": ["ts1", "ts2"], "medical_images": [0, 1]},
+     200),
+    (201, {"name": None, "latest_hr": None, "entry_time": None,
+           "latest_ecg_id": None, "has_ecg": False, "ecg_timestamps": [],
+           "medical_images": []}, 200),
+    (202, "Patient not found", 400),
+    ("abc", "Invalid MRN format", 400),
+])
+def test_get_patient_snapshot(mrn, expected, code, mock_patients):
+    from server import get_patient_snapshot
+    assert get_patient_snapshot(mrn) == (expected, code)
+
+
+def test_get_patient_snapshot_route(mock_patients):
+    from server import app, upsert_patient_info
+    from ImageBlob import ImageBlob
+    upsert_patient_info(200, {"patient_name": "", "medical_image": "",
+                              "ecg_image": "ecg3", "heart_rate": 61})
+    client = app.test_client()
+    response = client.get("/200/snapshot")
+    snapshot = response.get_json()
+    blob = ImageBlob.objects.raw({"mrn": 200}).first()
+    assert snapshot["latest_ecg_id"] == str(blob.pk)
+    assert snapshot["latest_hr"] == 61
+    assert snapshot["ecg_timestamps"][-1] == snapshot["entry_time"]
+    assert "ecg3" not in response.get_data(as_text=True)
+    response = client.get("/200/snapshot", headers={
+        "If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+
+
+def test_new_patient_files(mock_mongodb):
+    from server import app
+    import io
+    jpeg = b"\xff\xd8\xff\xe0" + bytes(range(256)) * 2000
+    client = app.test_client()
+    response = client.post("/new_patient_files", data={
+        "mrn": "430", "patient_name": "Ann", "heart_rate": "65",
+        "ecg_image": (io.BytesIO(jpeg), "ecg.jpg", "image/jpeg"),
+        "medical_image": (io.BytesIO(b"\x89PNG img"), "img.png")})
+    assert response.status_code == 200
+    snapshot = client.get("/430/snapshot").get_json()
+    assert snapshot["name"] == "Ann"
+    assert snapshot["latest_hr"] == 65
+    response = client.get("/430/ecg/{}/image".format(snapshot["entry_time"]))
+    assert response.mimetype == "image/jpeg"
+    assert response.headers["Content-Length"] == str(len(jpeg))
+    assert response.get_data() == jpeg
+    response = client.get("/430/images/0/image")
+    assert response.mimetype == "image/png"
+    assert response.get_data() == b"\x89PNG img"
+    ecg = client.get("/430/ecg/" + snapshot["entry_time"]).get_json()
+    assert base64.b64decode(ecg["result"]) == jpeg
+
+
+@pytest.mark.parametrize("data, code", [
+    ({"mrn": "abc"}, 400),
+    ({"mrn": "431", "heart_rate": "fast"}, 400),
+    ({"mrn": "431"}, 200),
+])
+def test_new_patient_files_validation(data, code, mock_mongodb):
+    from server import app
+    response = app.test_client().post("/new_patient_files", data=data)
+    assert response.status_code == code
+
+
+@pytest.mark.parametrize("url, code, data", [
+    ("/200/ecg/ts1/image", 200, base64.b64decode("ecg1")),
+    ("/200/ecg/ts3/image", 404, b"Error finding image"),
+    ("/202/ecg/ts1/image", 400, b"Patient not found"),
+    ("/abc/ecg/ts1/image", 400, b"Invalid MRN format"),
+    ("/200/images/1/image", 200, base64.b64decode("img2")),
+    ("/200/images/2/image", 404, b"Error finding image"),
+    ("/200/images/x/image", 404, b"Error finding image"),
+    ("/200/images/-1/image", 404, b"Error finding image"),
+])
+def test_image_routes_inline(url, code, data, mock_patients):
+    from server import app
+    response = app.test_client().get(url)
+    assert response.status_code == code
+    assert response.get_data() == data
+
+
+def test_bulk_patient_info(mock_mongodb):
+    from server import app, find_patient_in_db
+    records = [
+        {"patient_name": "Ann", "mrn": 450, "medical_image": "",
+         "ecg_image": "ecg1", "heart_rate": 60},
+        {"patient_name": "", "mrn": "abc", "medical_image": "",
+         "ecg_image": "", "heart_rate": ""},
+        "not a record",
+        {"patient_name": "Bob", "mrn": "450", "medical_image": "img1",
+         "ecg_image": "ecg2", "heart_rate": "61"},
+        {"patient_name": "", "mrn": 451, "medical_image": "",
+         "ecg_image": "", "heart_rate": 70},
+    ]
+    response = app.test_client().post("/new_patient_info/bulk",
+                                      json=records)
+    assert response.status_code == 200
+    answer = response.get_json()
+    assert [result["status"] for result in answer["results"]] == \
+        [200, 400, 400, 200, 200]
+    assert (answer["written"], answer["failed"]) == (3, 2)
+    patient = find_patient_in_db(450)
+    assert patient.patient_name == "Ann"
+    assert patient.heart_rate == [60, 61]
+    assert len(set(patient.entry_time)) == 2
+    client = app.test_client()
+    for timestamp, ecg in zip(patient.entry_time, ["ecg1", "ecg2"]):
+        response = client.get("/450/ecg/" + timestamp)
+        assert response.get_json()["result"] == ecg
+    assert len(patient.medical_image) == 1
+    assert find_patient_in_db(451).heart_rate == [70]
+    mrns = app.test_client().get("/mrn_list").get_json()["data"]
+    assert sorted(mrns) == [450, 451]
+
+
+def test_bulk_patient_info_ecg_timestamps(mock_mongodb):
+    from server import app
+    client = app.test_client()
+    ecgs = [base64.b64encode("ecg{}".format(i).encode()).decode()
+            for i in range(3)]
+    records = [{"patient_name": "", "mrn": 9, "medical_image": "",
+                "ecg_image": ecg, "heart_rate": ""} for ecg in ecgs]
+    records.append({"patient_name": "", "mrn": 9, "medical_image": "",
+                    "ecg_image": "acq", "heart_rate": "",
+                    "timestamp": "2020-11-20 10:15:00"})
+    records.append(dict(records[-1]))
+    records.append(dict(records[-1], timestamp="20/11/2020"))
+    answer = client.post("/new_patient_info/bulk", json=records).get_json()
+    assert [result["status"] for result in answer["results"]] == \
+        [200, 200, 200, 200, 409, 400]
+    timestamps = client.get("/9/ecg/timestamps").get_json()
+    assert len(set(timestamps)) == 4
+    assert "2020-11-20 10:15:00" in timestamps
+    for timestamp, ecg in zip(timestamps, ecgs + ["acq"]):
+        response = client.get("/9/ecg/" + timestamp)
+        assert response.get_json()["result"] == ecg
+        if ecg != "acq":
+            response = client.get("/9/ecg/{}/image".format(timestamp))
+            assert response.get_data() == base64.b64decode(ecg)
+
+
+def test_bulk_patient_info_replay(mock_mongodb):
+    from server import app, find_patient_in_db
+    from ImageBlob import ImageBlob
+    client = app.test_client()
+    ecg = base64.b64encode(b"ecg").decode()
+    records = [{"patient_name": "", "mrn": 8, "medical_image": "",
+                "ecg_image": ecg, "heart_rate": 60,
+                "timestamp": "2020-01-01 00:00:00"},
+               {"patient_name": "", "mrn": 8, "medical_image": "",
+                "ecg_image": ecg, "heart_rate": 61,
+                "timestamp": "2020-01-01 00:00:01"}]
+    answer = client.post("/new_patient_info/bulk",
+                         json=records[:1]).get_json()
+    assert answer["written"] == 1
+    answer = client.post("/new_patient_info/bulk", json=records).get_json()
+    assert [result["status"] for result in answer["results"]] == [409, 200]
+    patient = find_patient_in_db(8)
+    assert patient.entry_time == ["2020-01-01 00:00:00",
+                                  "2020-01-01 00:00:01"]
+    assert patient.heart_rate == [60, 61]
+    assert ImageBlob.objects.raw({"mrn": 8, "kind": "ecg_image"}).count() \
+        == 2
+
+
+@pytest.mark.parametrize("body, code", [
+    ({"mrn": 1}, 400),
+    ([{"patient_name": "", "mrn": 1, "medical_image": "", "ecg_image": "",
+       "heart_rate": ""}] * 1001, 413),
+    ([], 200),
+])
+def test_bulk_patient_info_rejected(body, code, mock_mongodb):
+    from server import app
+    response = app.test_client().post("/new_patient_info/bulk", json=body)
+    assert response.status_code == code
+
+
+def test_bulk_patient_info_write_error(mock_mongodb, monkeypatch):
+    import mongomock
+    from pymongo.errors import BulkWriteError
+    from server import process_bulk_patient_info
+    from ImageBlob import ImageBlob
+
+    def bulk_write(self, requests, ordered=True):
+        raise BulkWriteError({"writeErrors": [{"index": 2,
+                                               "errmsg": "disk full"}],
+                              "upserted": [{"index": 0, "_id": 460}]})
+
+    monkeypatch.setattr(mongomock.Collection, "bulk_write", bulk_write)
+    records = [{"patient_name": name, "mrn": mrn, "medical_image": "img1",
+                "ecg_image": "ecg1", "heart_rate": 60}
+               for name, mrn in [("Ann", 460), ("", 461), ("", 462)]]
+    answer, status_code = process_bulk_patient_info(records)
+    assert [(result["status"], result["message"])
+            for result in answer["results"]] == [
+        (200, "Patient information successfully added"),
+        (500, "Database error: disk full"),
+        (500, "Not written after an earlier database error")]
+    assert {blob.mrn for blob in ImageBlob.objects.all()} == {460}
+    assert ImageBlob.objects.count() == 2
+
+
+@pytest.mark.parametrize("body, code", [
+    (gzip.compress(json.dumps({"patient_name": "Ann", "mrn": 610,
+                               "medical_image": "", "ecg_image": "",
+                               "heart_rate": 60}).encode()), 200),
+    (b"not gzip", 400),
+    (gzip.compress(b"{}")[:-4], 400),
+])
+def test_gzip_request_body(body, code, mock_mongodb):
+    from server import app, find_patient_in_db
+    client = app.test_client()
+    r = client.post("/new_patient_info", data=body,
+                    headers={"Content-Encoding": "gzip",
+                             "Content-Type": "application/json"})
+    assert r.status_code == code
+    if code == 200:
+        assert find_patient_in_db(610).patient_name == "Ann"
+
+
+@pytest.mark.parametrize("size, code, dimensions", [
+    (None, 200, (1024, 1245)),
+    ("original", 200, (1024, 1245)),
+    ("preview", 200, (329, 400)),
+    ("thumbnail", 200, (123, 150)),
+    ("huge", 400, None),
+])
+def test_image_size_variants(size, code, dimensions, mock_mongodb):
+    from server import app
+    from PIL import Image
+    with open("images/esophagus2.jpg", "rb") as f:
+        jpeg = f.read()
+    client = app.test_client()
+    client.post("/new_patient_files", data={
+        "mrn": "450", "ecg_image": (io.BytesIO(jpeg), "ecg.jpg"),
+        "medical_image": (io.BytesIO(jpeg), "img.jpg")})
+    timestamp = client.get("/450/snapshot").get_json()["entry_time"]
+    query = "" if size is None else "?size=" + size
+    for url in ["/450/images/0", "/450/ecg/" + timestamp]:
+        response = client.get(url + "/image" + query)
+        assert response.status_code == code
+        if code == 200:
+            image = Image.open(io.BytesIO(response.get_data()))
+            assert image.size == dimensions
+        response = client.get(url + query)
+        assert response.status_code == code
+        if code == 200:
+            data = base64.b64decode(response.get_json()["result"])
+            assert Image.open(io.BytesIO(data)).size == dimensions
+
+
+@pytest.mark.parametrize("part", [
+    (io.BytesIO(b""), ""),
+    (io.BytesIO(b""), "ecg.jpg"),
+    (io.BytesIO(b"\xff\xd8\xff jpeg"), ""),
+])
+def test_new_patient_files_empty_part(part, mock_mongodb):
+    from server import app, find_patient_in_db
+    from ImageBlob import ImageBlob
+    client = app.test_client()
+    response = client.post("/new_patient_files", data={
+        "mrn": "460", "heart_rate": "70", "ecg_image": part,
+        "medical_image": (io.BytesIO(b""), "")})
+    assert response.status_code == 200
+    patient = find_patient_in_db(460)
+    assert patient.ecg_image == []
+    assert patient.entry_time == []
+    assert patient.medical_image == []
+    assert patient.heart_rate == [70]
+    assert ImageBlob.objects.count() == 0
+
+
+def test_new_patient_files_claimed_type(mock_mongodb):
+    from server import app
+    page = b"<script>alert(1)</script>"
+    client = app.test_client()
+    response = client.post("/new_patient_files", data={
+        "mrn": "470", "heart_rate": "70",
+        "ecg_image": (io.BytesIO(page), "ecg.html", "text/html"),
+        "medical_image": (io.BytesIO(page), "img.html", "text/html")})
+    assert response.status_code == 200
+    entry_time = client.get("/470/snapshot").get_json()["entry_time"]
+    for url in ["/470/images/0/image",
+                "/470/ecg/{}/image".format(entry_time)]:
+        response = client.get(url)
+        assert response.mimetype == "application/octet-stream"
+        assert response.headers["X-Content-Type-Options"] == "nosniff"
+        assert response.get_data() == page
+    assert client.get("/470/images/-1/image").status_code == 404